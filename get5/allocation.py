@@ -0,0 +1,281 @@
+import datetime
+
+from flask import has_request_context
+
+from get5 import app, db, cache, config_setting
+from models import GameServer, Match
+import jobs
+
+
+def usable_by(user_id):
+    return db.or_(GameServer.user_id == user_id,
+                  GameServer.public_server == True)
+
+
+def free_servers(user):
+    # Free servers the user may use, least loaded first: the ones that
+    # hosted the fewest matches get the next one, so wear and log volume
+    # are spread over the whole pool.
+    load = db.session.query(
+        Match.server_id, db.func.count(Match.id).label('matches')).filter(
+            Match.cancelled == False).group_by(Match.server_id).subquery()
+
+    return GameServer.query.outerjoin(
+        load, load.c.server_id == GameServer.id).filter(
+            GameServer.in_use == False, usable_by(user.id)).order_by(
+                db.func.coalesce(load.c.matches, 0), GameServer.id).all()
+
+
+def claim_server(server):
+    # Another request may be assigning the same server right now. The
+    # lease is handed to the match with GameServer.lease_to once it exists.
+    expires = GameServer.lease_expiry()
+    claimed = GameServer.query.filter_by(
+        id=server.id, in_use=False).update(
+            {'in_use': True, 'lease_match_id': None, 'lease_expires': expires},
+            synchronize_session=False)
+    db.session.commit()
+    if claimed == 1:
+        server.in_use = True
+        server.lease_match_id = None
+        server.lease_expires = expires
+    return claimed == 1
+
+
+def find_server(user):
+    """Claims the least loaded healthy server for a new match of user.
+
+    Returns the server and its availability reply, or (None, None) when
+    every server is busy or unreachable.
+    """
+    reap_leases()
+
+    for server in healthy_servers(free_servers(user)):
+        if claim_server(server):
+            json_reply = server.status.get_reply()[0] if server.status else None
+            return server, json_reply
+    return None, None
+
+
+def polled_status(server):
+    # The status stored by the server poller, or None when there is none
+    # newer than SERVER_STATUS_MAX_AGE. Servers are never contacted here.
+    max_age = datetime.timedelta(seconds=config_setting('SERVER_STATUS_MAX_AGE'))
+    if server.status and server.status.checked_since(
+            datetime.datetime.utcnow() - max_age):
+        return server.status
+    return None
+
+
+def healthy_servers(servers):
+    # The servers the poller recently found available
+    if config_setting('TESTING'):
+        return servers
+
+    healthy = []
+    for server in servers:
+        status = polled_status(server)
+        if status and status.available:
+            healthy.append(server)
+    return healthy
+
+
+def idle_servers(servers):
+    # The servers whose plugin recently answered with no match loaded, an
+    # unknown status keeps a server reserved
+    idle = []
+    for server in servers:
+        status = polled_status(server)
+        if status and status.available and status.gamestate == 0:
+            idle.append(server)
+    return idle
+
+
+def dispatch_free(user):
+    """Hands every free healthy server the user may use to queued matches.
+
+    Returns the matches that were dispatched.
+    """
+    reap_leases()
+    if not can_dispatch():
+        return []
+
+    dispatched = []
+    for server in healthy_servers(free_servers(user)):
+        match = dispatch(server)
+        if match is not None:
+            dispatched.append(match)
+    return dispatched
+
+
+def queue_match(match):
+    match.server_id = None
+    match.queued = True
+
+
+def dispatch(server):
+    """Loads the oldest queued match that may use server on it.
+
+    Called whenever a server is released. Matches scheduled for later are
+    left for the scheduler. Returns the match, or None if nothing was
+    waiting.
+    """
+    if server is None or server.in_use:
+        return None
+
+    while True:
+        query = Match.query.filter(
+            Match.queued == True, Match.cancelled == False,
+            db.or_(Match.scheduled_start == None,
+                   Match.scheduled_start <= datetime.datetime.utcnow()))
+        if not server.public_server:
+            query = query.filter_by(user_id=server.user_id)
+        match = query.order_by(Match.id).first()
+        if match is None:
+            return None
+
+        if claim_match(match, server):
+            break
+
+    if not claim_server(server):
+        # Lost the server to a new match in the meantime, back in line
+        unclaim_match(match)
+        return None
+
+    load_match(match, server)
+    return match
+
+
+def start_match(match):
+    """Gives a queued match the least loaded free server right away.
+
+    Used for scheduled matches once they are due. Returns False if there
+    was no free server, the match then waits for the next released one.
+    """
+    server, _ = find_server(match.get_user())
+    if server is None:
+        return False
+
+    if not claim_match(match, server):
+        # Started or cancelled by somebody else
+        release(server)
+        return False
+
+    load_match(match, server)
+    return True
+
+
+def claim_match(match, server):
+    claimed = Match.query.filter_by(id=match.id, queued=True).update(
+        {'queued': False, 'server_id': server.id},
+        synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def unclaim_match(match):
+    Match.query.filter_by(id=match.id).update(
+        {'queued': True, 'server_id': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def load_match(match, server):
+    # The load commands go to the server as a background job, after ending
+    # whatever match the plugin still has loaded.
+    db.session.refresh(match)
+    server.lease_to(match)
+    db.session.commit()
+    jobs.enqueue(match, server, 'load',
+                 ['get5_endmatch'] + match.get_load_commands())
+
+
+def can_dispatch():
+    # The load commands include the config url, which outside of a request
+    # can only be built from GET5_URL_OVERRIDE or SERVER_NAME.
+    return (has_request_context() or app.config.get('GET5_URL_OVERRIDE') or
+            app.config.get('SERVER_NAME'))
+
+
+def release(server):
+    # Frees a server and hands it to the next queued match, if any
+    if server is None:
+        return None
+    server.in_use = False
+    server.lease_match_id = None
+    server.lease_expires = None
+    db.session.commit()
+    if not can_dispatch():
+        return None
+    return dispatch(server)
+
+
+def renew_lease(match):
+    """Extends the lease on the server of match, called on api traffic.
+
+    Renewals are written at most every tenth of SERVER_LEASE_TIMEOUT per
+    server, so a live match costs an update every few minutes rather than
+    one per round. The caller commits.
+    """
+    timeout = config_setting('SERVER_LEASE_TIMEOUT')
+    if not timeout or not match.server_id:
+        return
+    if not cache.cache.add('server_lease_{}'.format(match.server_id), True,
+                           timeout=max(timeout // 10, 1)):
+        return
+
+    # Only the match holding the lease renews it, a match whose server was
+    # reclaimed and handed to another one must not keep it reserved.
+    GameServer.query.filter(
+        GameServer.id == match.server_id,
+        GameServer.in_use == True,
+        db.or_(GameServer.lease_match_id == match.id,
+               GameServer.lease_match_id == None)).update(
+                   {'lease_expires': GameServer.lease_expiry()},
+                   synchronize_session=False)
+
+
+def reap_leases():
+    """Frees servers whose lease ran out, e.g. after a plugin never reported
+    the end of its match, and hands them to queued matches.
+
+    Only servers whose plugin has no match loaded are freed. The others may
+    still be in a long warmup or veto, which sends no api calls, so their
+    lease is extended instead. Returns the reclaimed servers.
+    """
+    now = datetime.datetime.utcnow()
+    expired = GameServer.query.filter(
+        GameServer.in_use == True, GameServer.lease_expires < now).all()
+    if not expired:
+        return []
+
+    idle = set(s.id for s in idle_servers(expired))
+    reclaimed = []
+    for server in expired:
+        if server.id not in idle:
+            GameServer.query.filter(
+                GameServer.id == server.id, GameServer.in_use == True,
+                GameServer.lease_expires < now).update(
+                    {'lease_expires': GameServer.lease_expiry()},
+                    synchronize_session=False)
+            db.session.commit()
+            continue
+
+        match_id = server.lease_match_id
+        # Somebody else may be reaping, or the lease was just renewed
+        count = GameServer.query.filter(
+            GameServer.id == server.id, GameServer.in_use == True,
+            GameServer.lease_expires < now).update(
+                {'in_use': False, 'lease_match_id': None,
+                 'lease_expires': None}, synchronize_session=False)
+        db.session.commit()
+        if count != 1:
+            continue
+
+        app.logger.warning('Reclaimed {} from match {}, its lease expired'
+                           .format(server, match_id))
+        db.session.refresh(server)
+        reclaimed.append(server)
+        if can_dispatch():
+            dispatch(server)
+
+    return reclaimed
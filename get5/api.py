@@ -1,18 +1,43 @@
-from get5 import app, limiter, db, BadRequestError
-from util import as_int
-from models import Match, MapStats, PlayerStats, GameServer
+from get5 import app, limiter, db, cache, BadRequestError, config_setting
+from util import as_int, TTLCache
+from models import Match, MapStats, PlayerStats, MatchEvent
+import allocation
 
-from flask import Blueprint, request
+from flask import Blueprint, request, g
 import flask_limiter
 
 import re
 import datetime
+import time
 
 api_blueprint = Blueprint('api', __name__)
 
 
 _matchid_re = re.compile('/match/(\d*)/.*')
 
+# Process-local matchid -> api_key cache, so rate limit keys can usually be
+# picked without a database query. Api keys never change once a match is
+# created, the timeout only bounds how long unused entries are kept.
+_api_key_cache = TTLCache(maxsize=1000, timeout=10 * 60)
+
+
+def get_api_match(matchid):
+    # The match is loaded at most once per request and shared between the
+    # rate limit key function and the view.
+    match = getattr(g, 'api_match', None)
+    if match is None or match.id != matchid:
+        match = Match.query.get_or_404(matchid)
+        g.api_match = match
+        _api_key_cache.set(matchid, match.api_key)
+    return match
+
+
+def get_api_key(matchid):
+    api_key = _api_key_cache.get(matchid)
+    if api_key is None:
+        api_key = get_api_match(matchid).api_key
+    return api_key
+
 
 def rate_limit_key():
     try:
@@ -20,7 +45,7 @@ def rate_limit_key():
         matchid = int(match.group(1))
         if matchid:
             # If the key matches, rate limit by the api key
-            api_key = Match.query.get_or_404(matchid).api_key
+            api_key = get_api_key(matchid)
             if api_key == request.values.get('key'):
                 return api_key
 
@@ -31,6 +56,75 @@ def rate_limit_key():
     return flask_limiter.util.get_remote_address()
 
 
+def _score_cache_key(map_stats):
+    return 'score_update_{}'.format(map_stats.id)
+
+
+def update_map_score(map_stats, team1_score, team2_score):
+    # With SCORE_UPDATE_FLUSH_INTERVAL set, live score updates are kept in the
+    # shared cache and only written to the database once per interval (and
+    # always on map/match finish), instead of once per round.
+    interval = config_setting('SCORE_UPDATE_FLUSH_INTERVAL')
+    if not interval:
+        map_stats.team1_score = team1_score
+        map_stats.team2_score = team2_score
+        return
+
+    key = _score_cache_key(map_stats)
+    pending = cache.get(key)
+    last_flush = pending['flushed_at'] if pending else 0
+    now = time.time()
+
+    if now - last_flush >= interval:
+        map_stats.team1_score = team1_score
+        map_stats.team2_score = team2_score
+        pending = {'scores': None, 'flushed_at': now}
+    else:
+        pending = {'scores': (team1_score, team2_score),
+                   'flushed_at': last_flush}
+
+    cache.set(key, pending, timeout=24 * 60 * 60)
+
+
+def flush_map_score(map_stats):
+    # Applies any buffered score to map_stats, the caller commits.
+    key = _score_cache_key(map_stats)
+    pending = cache.get(key)
+    if pending and pending['scores']:
+        map_stats.team1_score, map_stats.team2_score = pending['scores']
+    cache.delete(key)
+
+
+def flush_stale_map_scores():
+    """Writes buffered scores held for longer than SCORE_UPDATE_FLUSH_INTERVAL.
+
+    Updates normally write the buffer themselves, this covers maps whose
+    plugin went quiet mid-map. Run periodically by "manager.py
+    poll_servers". Returns the maps written to, the caller commits.
+    """
+    interval = config_setting('SCORE_UPDATE_FLUSH_INTERVAL')
+    if not interval:
+        return []
+
+    live_maps = MapStats.query.join(Match, Match.id == MapStats.match_id).filter(
+        MapStats.end_time == None, Match.end_time == None,
+        Match.cancelled == False).all()
+    if not live_maps:
+        return []
+
+    now = time.time()
+    flushed = []
+    keys = [_score_cache_key(map_stats) for map_stats in live_maps]
+    for map_stats, key, pending in zip(live_maps, keys, cache.get_many(*keys)):
+        if (pending and pending['scores'] and
+                now - pending['flushed_at'] >= interval):
+            map_stats.team1_score, map_stats.team2_score = pending['scores']
+            cache.set(key, {'scores': None, 'flushed_at': now},
+                      timeout=24 * 60 * 60)
+            flushed.append(map_stats)
+    return flushed
+
+
 def match_api_check(request, match):
     if match.api_key != request.values.get('key'):
         raise BadRequestError('Wrong API key')
@@ -38,14 +132,53 @@ def match_api_check(request, match):
     if match.finalized():
         raise BadRequestError('Match already finalized')
 
+    allocation.renew_lease(match)
+
+
+def record_event(match, event_type, event_time, map_number=None, data=None):
+    if config_setting('MATCH_EVENT_JOURNAL'):
+        MatchEvent.create(match.id, event_type, event_time, map_number, data)
+
+
+# Live match pages are sent the plugin events of their match through the
+# shared cache rather than the database, see match.match_stream. Each match
+# has a version counter, and the event published as each version is kept
+# under a key of its own for a while.
+MATCH_STREAM_EVENT_TIMEOUT = 10 * 60
 
-@api_blueprint.route('/match/<int:matchid>/finish', methods=['POST'])
-@limiter.limit('60 per hour', key_func=rate_limit_key)
-def match_finish(matchid):
-    match = Match.query.get_or_404(matchid)
-    match_api_check(request, match)
 
-    winner = request.values.get('winner')
+def match_stream_version_key(matchid):
+    return 'match_stream_{}'.format(matchid)
+
+
+def match_stream_event_key(matchid, version):
+    return 'match_stream_{}_{}'.format(matchid, version)
+
+
+def publish_event(matchid, event_type, map_number=None, data=None):
+    # Called once the event is committed. Concurrent updates for the same
+    # match take the next free version.
+    version_key = match_stream_version_key(matchid)
+    version = (cache.get(version_key) or 0) + 1
+    event = {'type': event_type, 'map_number': map_number, 'data': data}
+    while not cache.cache.add(match_stream_event_key(matchid, version),
+                              event, timeout=MATCH_STREAM_EVENT_TIMEOUT):
+        version += 1
+    cache.set(version_key, version, timeout=24 * 60 * 60)
+
+
+def request_data():
+    data = request.values.to_dict()
+    data.pop('key', None)
+    return data
+
+
+# The apply_* functions hold the effect of each plugin event on the match
+# data. They are shared by the api views and replay_match_events, so a
+# replayed journal rebuilds exactly what the live api would have written.
+
+def apply_series_finish(match, data, event_time):
+    winner = data.get('winner')
     if winner == 'team1':
         match.winner = match.team1_id
     elif winner == 'team2':
@@ -53,7 +186,7 @@ def match_finish(matchid):
     else:
         match.winner = None
 
-    forfeit = request.values.get('forfeit', 0)
+    forfeit = data.get('forfeit', 0)
     if forfeit == 1:
         match.forfeit = True
         # Reassign scores
@@ -64,13 +197,176 @@ def match_finish(matchid):
             match.team1_score = 0
             match.team2_score = 1
 
-    match.end_time = datetime.datetime.utcnow()
-    server = GameServer.query.get(match.server_id)
-    if server:
-        server.in_use = False
+    match.end_time = event_time
+
+
+def apply_map_start(match, map_number, data, event_time):
+    if match.start_time is None:
+        match.start_time = event_time
+
+    # Create mapstats object if needed
+    return MapStats.get_or_create(match.id, map_number, data.get('mapname'),
+                                  start_time=event_time)
+
+
+def get_map_scores(data):
+    t1 = as_int(data.get('team1score'))
+    t2 = as_int(data.get('team2score'))
+    if t1 != -1 and t2 != -1:
+        return t1, t2
+    return None
+
+
+def apply_map_finish(match, map_stats, data, event_time):
+    map_stats.end_time = event_time
+
+    winner = data.get('winner')
+    if winner == 'team1':
+        map_stats.winner = match.team1_id
+        match.team1_score += 1
+    elif winner == 'team2':
+        map_stats.winner = match.team2_id
+        match.team2_score += 1
+    else:
+        map_stats.winner = None
+
+
+# PlayerStats columns and the plugin fields they are read from
+PLAYER_STAT_FIELDS = [
+    ('kills', 'kills'),
+    ('assists', 'assists'),
+    ('deaths', 'deaths'),
+    ('flashbang_assists', 'flashbang_assists'),
+    ('teamkills', 'teamkills'),
+    ('suicides', 'suicides'),
+    ('damage', 'damage'),
+    ('headshot_kills', 'headshot_kills'),
+    ('roundsplayed', 'roundsplayed'),
+    ('bomb_plants', 'bomb_plants'),
+    ('bomb_defuses', 'bomb_defuses'),
+    ('k1', '1kill_rounds'),
+    ('k2', '2kill_rounds'),
+    ('k3', '3kill_rounds'),
+    ('k4', '4kill_rounds'),
+    ('k5', '5kill_rounds'),
+    ('v1', 'v1'),
+    ('v2', 'v2'),
+    ('v3', 'v3'),
+    ('v4', 'v4'),
+    ('v5', 'v5'),
+    ('firstkill_t', 'firstkill_t'),
+    ('firstkill_ct', 'firstkill_ct'),
+    ('firstdeath_t', 'firstdeath_t'),
+    ('firstdeath_ct', 'firstdeath_ct'),
+]
+
+
+def player_stat_values(values):
+    # The stats of a plugin player update as a dict of PlayerStats columns
+    return dict((column, as_int(values.get(field)))
+                for column, field in PLAYER_STAT_FIELDS)
+
+
+def update_player_stats(player_stats, match, values):
+    player_stats.name = values.get('name')
+    team = values.get('team')
+    if team == 'team1':
+        player_stats.team_id = match.team1_id
+    elif team == 'team2':
+        player_stats.team_id = match.team2_id
+
+    for column, value in player_stat_values(values).items():
+        setattr(player_stats, column, value)
+
+
+def apply_player_update(match, map_stats, steam_id, data):
+    player_stats = PlayerStats.get_or_create(map_stats, steam_id)
+    if player_stats:
+        update_player_stats(player_stats, match, data)
+
+
+def apply_players_update(match, map_stats, players):
+    player_stats_dict = PlayerStats.get_or_create_many(
+        map_stats, players.keys())
+    for steam_id, player_stats in player_stats_dict.items():
+        update_player_stats(player_stats, match, players[steam_id])
+
+
+def apply_event(match, event):
+    data = event.get_data()
+    if event.event_type == MatchEvent.SERIES_FINISH:
+        apply_series_finish(match, data, event.event_time)
+        return
+
+    if event.event_type == MatchEvent.MAP_START:
+        apply_map_start(match, event.map_number, data, event.event_time)
+        return
+
+    map_stats = match.map_stats.filter_by(
+        map_number=event.map_number).first()
+    if not map_stats:
+        return
+
+    if event.event_type == MatchEvent.MAP_UPDATE:
+        scores = get_map_scores(data)
+        if scores:
+            map_stats.team1_score, map_stats.team2_score = scores
+    elif event.event_type == MatchEvent.MAP_FINISH:
+        apply_map_finish(match, map_stats, data, event.event_time)
+    elif event.event_type == MatchEvent.PLAYER_UPDATE:
+        apply_player_update(match, map_stats, data.get('steamid64'), data)
+    elif event.event_type == MatchEvent.PLAYERS_UPDATE:
+        apply_players_update(match, map_stats, data['players'])
+
+
+def replay_match_events(match):
+    """Rebuilds the stats of a match from its event journal.
+
+    All MapStats and PlayerStats rows of the match and the stats fields of
+    the match itself are dropped and recreated by applying each journaled
+    event in order. The caller commits.
+    """
+    PlayerStats.query.filter_by(match_id=match.id).delete()
+    MapStats.query.filter_by(match_id=match.id).delete()
+    match.start_time = None
+    match.end_time = None
+    match.winner = None
+    match.forfeit = False
+    match.team1_score = 0
+    match.team2_score = 0
+
+    events = MatchEvent.query.filter_by(
+        match_id=match.id).order_by(MatchEvent.id)
+    for event in events:
+        apply_event(match, event)
+
+
+@api_blueprint.route('/match/<int:matchid>/finish', methods=['POST'])
+@limiter.limit('60 per hour', key_func=rate_limit_key)
+def match_finish(matchid):
+    match = get_api_match(matchid)
+    match_api_check(request, match)
+
+    data = request_data()
+    now = datetime.datetime.utcnow()
+    record_event(match, MatchEvent.SERIES_FINISH, now, data=data)
 
+    for map_stats in match.map_stats:
+        flush_map_score(map_stats)
+
+    apply_series_finish(match, data, now)
     db.session.commit()
-    app.logger.info('Finished match {}, winner={}'.format(match, winner))
+    publish_event(matchid, MatchEvent.SERIES_FINISH)
+    app.logger.info('Finished match {}, winner={}'.format(
+        match, data.get('winner')))
+
+    server = match.get_server()
+    next_match = None
+    if server and server.leased_by(match):
+        next_match = allocation.release(server)
+    if next_match:
+        app.logger.info('Dispatched queued match {} to server {}'.format(
+            next_match.id, next_match.server_id))
 
     return 'Success'
 
@@ -78,17 +374,15 @@ def match_finish(matchid):
 @api_blueprint.route('/match/<int:matchid>/map/<int:mapnumber>/start', methods=['POST'])
 @limiter.limit('60 per hour', key_func=rate_limit_key)
 def match_map_start(matchid, mapnumber):
-    match = Match.query.get_or_404(matchid)
+    match = get_api_match(matchid)
     match_api_check(request, match)
 
-    if match.start_time is None:
-        match.start_time = datetime.datetime.utcnow()
-
-    map_name = request.values.get('mapname')
-
-    # Create mapstats object if needed
-    MapStats.get_or_create(matchid, mapnumber, map_name)
+    data = request_data()
+    now = datetime.datetime.utcnow()
+    record_event(match, MatchEvent.MAP_START, now, mapnumber, data)
+    apply_map_start(match, mapnumber, data, now)
     db.session.commit()
+    publish_event(matchid, MatchEvent.MAP_START, mapnumber)
 
     return 'Success'
 
@@ -96,17 +390,21 @@ def match_map_start(matchid, mapnumber):
 @api_blueprint.route('/match/<int:matchid>/map/<int:mapnumber>/update', methods=['POST'])
 @limiter.limit('1000 per hour', key_func=rate_limit_key)
 def match_map_update(matchid, mapnumber):
-    match = Match.query.get_or_404(matchid)
+    match = get_api_match(matchid)
     match_api_check(request, match)
 
     map_stats = match.map_stats.filter_by(map_number=mapnumber).first()
     if map_stats:
-        t1 = as_int(request.values.get('team1score'))
-        t2 = as_int(request.values.get('team2score'))
-        if t1 != -1 and t2 != -1:
-            map_stats.team1_score = t1
-            map_stats.team2_score = t2
-            db.session.commit()
+        data = request_data()
+        record_event(match, MatchEvent.MAP_UPDATE,
+                     datetime.datetime.utcnow(), mapnumber, data)
+        scores = get_map_scores(data)
+        if scores:
+            update_map_score(map_stats, scores[0], scores[1])
+        db.session.commit()
+        if scores:
+            publish_event(matchid, MatchEvent.MAP_UPDATE, mapnumber,
+                          {'team1score': scores[0], 'team2score': scores[1]})
     else:
         return 'Failed to find map stats object', 400
 
@@ -116,24 +414,18 @@ def match_map_update(matchid, mapnumber):
 @api_blueprint.route('/match/<int:matchid>/map/<int:mapnumber>/finish', methods=['POST'])
 @limiter.limit('60 per hour', key_func=rate_limit_key)
 def match_map_finish(matchid, mapnumber):
-    match = Match.query.get_or_404(matchid)
+    match = get_api_match(matchid)
     match_api_check(request, match)
 
     map_stats = match.map_stats.filter_by(map_number=mapnumber).first()
     if map_stats:
-        map_stats.end_time = datetime.datetime.utcnow()
-
-        winner = request.values.get('winner')
-        if winner == 'team1':
-            map_stats.winner = match.team1_id
-            match.team1_score += 1
-        elif winner == 'team2':
-            map_stats.winner = match.team2_id
-            match.team2_score += 1
-        else:
-            map_stats.winner = None
-
+        data = request_data()
+        now = datetime.datetime.utcnow()
+        record_event(match, MatchEvent.MAP_FINISH, now, mapnumber, data)
+        flush_map_score(map_stats)
+        apply_map_finish(match, map_stats, data, now)
         db.session.commit()
+        publish_event(matchid, MatchEvent.MAP_FINISH, mapnumber)
     else:
         return 'Failed to find map stats object', 404
 
@@ -145,58 +437,68 @@ def match_map_finish(matchid, mapnumber):
     methods=['POST'])
 @limiter.limit('100 per minute', key_func=rate_limit_key)
 def match_map_update_player(matchid, mapnumber, steamid64):
-    match = Match.query.get_or_404(matchid)
+    match = get_api_match(matchid)
     api_key = request.values.get('key')
     if match.api_key != api_key:
         return 'Wrong API key', 400
+    allocation.renew_lease(match)
 
     map_stats = match.map_stats.filter_by(map_number=mapnumber).first()
     if map_stats:
-        player_stats = PlayerStats.get_or_create(matchid, mapnumber, steamid64)
-        if player_stats:
-            player_stats.name = request.values.get('name')
-            team = request.values.get('team')
-            if team == 'team1':
-                player_stats.team_id = match.team1_id
-            elif team == 'team2':
-                player_stats.team_id = match.team2_id
-
-            player_stats.kills = as_int(request.values.get('kills'))
-            player_stats.assists = as_int(request.values.get('assists'))
-            player_stats.deaths = as_int(request.values.get('deaths'))
-            player_stats.flashbang_assists = as_int(
-                request.values.get('flashbang_assists'))
-            player_stats.teamkills = as_int(request.values.get('teamkills'))
-            player_stats.suicides = as_int(request.values.get('suicides'))
-            player_stats.damage = as_int(request.values.get('damage'))
-            player_stats.headshot_kills = as_int(
-                request.values.get('headshot_kills'))
-            player_stats.roundsplayed = as_int(
-                request.values.get('roundsplayed'))
-            player_stats.bomb_plants = as_int(
-                request.values.get('bomb_plants'))
-            player_stats.bomb_defuses = as_int(
-                request.values.get('bomb_defuses'))
-            player_stats.k1 = as_int(request.values.get('1kill_rounds'))
-            player_stats.k2 = as_int(request.values.get('2kill_rounds'))
-            player_stats.k3 = as_int(request.values.get('3kill_rounds'))
-            player_stats.k4 = as_int(request.values.get('4kill_rounds'))
-            player_stats.k5 = as_int(request.values.get('5kill_rounds'))
-            player_stats.v1 = as_int(request.values.get('v1'))
-            player_stats.v2 = as_int(request.values.get('v2'))
-            player_stats.v3 = as_int(request.values.get('v3'))
-            player_stats.v4 = as_int(request.values.get('v4'))
-            player_stats.v5 = as_int(request.values.get('v5'))
-            player_stats.firstkill_t = as_int(
-                request.values.get('firstkill_t'))
-            player_stats.firstkill_ct = as_int(
-                request.values.get('firstkill_ct'))
-            player_stats.firstdeath_t = as_int(
-                request.values.get('firstdeath_t'))
-            player_stats.firstdeath_ct = as_int(
-                request.values.get('firstdeath_ct'))
-
-            db.session.commit()
+        data = request_data()
+        data['steamid64'] = steamid64
+        record_event(match, MatchEvent.PLAYER_UPDATE,
+                     datetime.datetime.utcnow(), mapnumber, data)
+        apply_player_update(match, map_stats, steamid64, data)
+        db.session.commit()
+        publish_event(matchid, MatchEvent.PLAYERS_UPDATE, mapnumber,
+                      {'players': {steamid64: data}})
+        if match.finalized():
+            Match.invalidate_page_cache(match.id)
+    else:
+        return 'Failed to find map stats object', 404
+
+    return 'Success'
+
+
+# Takes the whole scoreboard for a map in a single request. The body is a json
+# object mapping each player's steamid64 to the same stat fields accepted by
+# the single player update above, e.g.:
+#   {"players": {"76561198053858673": {"name": "splewis", "team": "team1",
+#                                      "kills": 5, ...}, ...}}
+@api_blueprint.route(
+    '/match/<int:matchid>/map/<int:mapnumber>/players/update',
+    methods=['POST'])
+@limiter.limit('100 per minute', key_func=rate_limit_key)
+def match_map_update_players(matchid, mapnumber):
+    match = get_api_match(matchid)
+    api_key = request.values.get('key')
+    if match.api_key != api_key:
+        return 'Wrong API key', 400
+    allocation.renew_lease(match)
+
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('players'), dict):
+        return 'Invalid player stats data', 400
+
+    players = data['players']
+    for values in players.values():
+        if not isinstance(values, dict):
+            return 'Invalid player stats data', 400
+        for value in values.values():
+            if not isinstance(value, (basestring, int, long, float, type(None))):
+                return 'Invalid player stats data', 400
+
+    map_stats = match.map_stats.filter_by(map_number=mapnumber).first()
+    if map_stats:
+        record_event(match, MatchEvent.PLAYERS_UPDATE,
+                     datetime.datetime.utcnow(), mapnumber, {'players': players})
+        apply_players_update(match, map_stats, players)
+        db.session.commit()
+        publish_event(matchid, MatchEvent.PLAYERS_UPDATE, mapnumber,
+                      {'players': players})
+        if match.finalized():
+            Match.invalidate_page_cache(match.id)
     else:
         return 'Failed to find map stats object', 404
 
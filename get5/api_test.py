@@ -1,7 +1,13 @@
+import json
+import re
+import time
 import unittest
 
+import api
+import get5
 import get5_test
-from models import Match, MapStats, PlayerStats, GameServer
+from get5 import db
+from models import Match, MapStats, PlayerStats, GameServer, MatchEvent
 
 
 class ApiTests(get5_test.Get5Test):
@@ -116,6 +122,346 @@ class ApiTests(get5_test.Get5Test):
         self.assertEqual(self.app.get('/matches').status_code, 200)
         self.assertEqual(self.app.get('/matches/1').status_code, 200)
 
+    def test_match_players_update(self):
+        match = Match.query.get(1)
+        matchkey = match.api_key
+
+        response = self.app.post('/match/1/map/0/start',
+                                 data={
+                                     'mapname': 'de_dust2',
+                                     'key': matchkey,
+                                 })
+        self.assertEqual(response.status_code, 200)
+
+        # One request with the whole scoreboard
+        players = {
+            '76561198053858673': {
+                'name': 'player1',
+                'team': 'team1',
+                'roundsplayed': 5,
+                'kills': 5,
+                'deaths': 3,
+            },
+            '76561198064755913': {
+                'name': 'player2',
+                'team': 'team2',
+                'roundsplayed': '5',
+                'kills': '2',
+                'deaths': '4',
+            },
+        }
+        response = self.app.post('/match/1/map/0/players/update?key=' + matchkey,
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(), 2)
+        playerstats = PlayerStats.query.filter_by(
+            map_id=1, steam_id='76561198053858673').first()
+        self.assertEqual(playerstats.name, 'player1')
+        self.assertEqual(playerstats.kills, 5)
+        self.assertEqual(playerstats.team_id, 1)
+        playerstats = PlayerStats.query.filter_by(
+            map_id=1, steam_id='76561198064755913').first()
+        self.assertEqual(playerstats.kills, 2)
+        self.assertEqual(playerstats.deaths, 4)
+        self.assertEqual(playerstats.team_id, 2)
+
+        # A later update modifies the existing rows instead of adding new ones
+        players['76561198053858673']['kills'] = 9
+        response = self.app.post('/match/1/map/0/players/update?key=' + matchkey,
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(), 2)
+        playerstats = PlayerStats.query.filter_by(
+            map_id=1, steam_id='76561198053858673').first()
+        self.assertEqual(playerstats.kills, 9)
+
+        # Bad data and bad keys are rejected
+        response = self.app.post('/match/1/map/0/players/update?key=' + matchkey,
+                                 data='not json',
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for bad_values in [{'kills': [1]}, {'kills': {}}, {'name': ['a']}]:
+            response = self.app.post(
+                '/match/1/map/0/players/update?key=' + matchkey,
+                data=json.dumps({'players': {'76561198053858673': bad_values}}),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        response = self.app.post('/match/1/map/0/players/update?key=abc',
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Wrong API key', response.data)
+
+        # No map stats object for a map that hasn't started
+        response = self.app.post('/match/1/map/1/players/update?key=' + matchkey,
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    # The cost of a player update should not grow as the map fills up.
+    def test_player_update_query_count(self):
+        match = Match.query.get(1)
+        matchkey = match.api_key
+        response = self.app.post('/match/1/map/0/start',
+                                 data={
+                                     'mapname': 'de_dust2',
+                                     'key': matchkey,
+                                 })
+        self.assertEqual(response.status_code, 200)
+
+        def update(steamid, kills):
+            url = '/match/1/map/0/player/{}/update'.format(steamid)
+            with self.count_queries() as statements:
+                response = self.app.post(url, data={
+                    'roundsplayed': '5',
+                    'kills': kills,
+                    'team': 'team1',
+                    'key': matchkey,
+                })
+            self.assertEqual(response.status_code, 200)
+            return len(statements)
+
+        first_steamid = 76561198000000000
+        first_insert = update(first_steamid, 1)
+        first_update = update(first_steamid, 2)
+        for i in range(1, 30):
+            update(first_steamid + i, 1)
+        last_insert = update(first_steamid + 30, 1)
+        last_update = update(first_steamid + 30, 2)
+
+        self.assertEqual(first_insert, last_insert)
+        self.assertEqual(first_update, last_update)
+        self.assertTrue(first_update < first_insert)
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(), 31)
+
+    def test_player_update_cap(self):
+        match = Match.query.get(1)
+        matchkey = match.api_key
+        self.app.post('/match/1/map/0/start',
+                      data={'mapname': 'de_dust2', 'key': matchkey})
+
+        players = {}
+        for i in range(PlayerStats.MAXPLAYERS_PER_MAP + 5):
+            players[str(76561198000000000 + i)] = {'kills': 1}
+        response = self.app.post('/match/1/map/0/players/update?key=' + matchkey,
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(),
+                         PlayerStats.MAXPLAYERS_PER_MAP)
+
+        # No more players can be added one at a time either
+        response = self.app.post('/match/1/map/0/player/76561198100000000/update',
+                                 data={'kills': 1, 'key': matchkey})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(),
+                         PlayerStats.MAXPLAYERS_PER_MAP)
+
+    # Two updates adding the same player at once must not fail on the
+    # unique (map_id, steam_id) index.
+    def test_player_insert_race(self):
+        map_stats = MapStats.get_or_create(1, 0, 'de_dust2')
+        db.session.commit()
+        first = PlayerStats.get_or_create(map_stats, '76561198000000001')
+        first.kills = 3
+        db.session.commit()
+
+        # The other request's row was added after this one looked
+        PlayerStats.insert_missing(
+            map_stats, ['76561198000000001', '76561198000000002'])
+        db.session.commit()
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(), 2)
+        self.assertEqual(PlayerStats.query.filter_by(
+            steam_id='76561198000000001').one().kills, 3)
+
+        rv = PlayerStats.get_or_create_many(
+            map_stats, [76561198000000002, 76561198000000003])
+        db.session.commit()
+        self.assertEqual(sorted(rv.keys()),
+                         ['76561198000000002', '76561198000000003'])
+        self.assertEqual(PlayerStats.query.filter_by(map_id=1).count(), 3)
+
+    # The match should only be loaded once per api call, and not at all by
+    # the rate limiter once its api key is cached.
+    def test_match_loaded_once(self):
+        match = Match.query.get(1)
+        data = {
+            'mapname': 'de_dust2',
+            'key': match.api_key,
+        }
+        db.session.remove()
+
+        def match_queries(statements):
+            return [s for s in statements if re.search(r'FROM "?match\b', s)]
+
+        with self.count_queries() as statements:
+            response = self.app.post('/match/1/map/0/start', data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(match_queries(statements)), 1)
+
+        # The limiter has the api key cached now, only the view loads it
+        db.session.remove()
+        with self.count_queries() as statements:
+            response = self.app.post('/match/1/map/0/update', data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(match_queries(statements)), 1)
+
+        # Wrong keys are still rejected when the api key is cached
+        data['key'] = 'abc'
+        response = self.app.post('/match/1/map/0/update', data=data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Wrong API key', response.data)
+
+    # With write-behind enabled, score updates are buffered but the final
+    # scores must always reach the database.
+    def test_score_write_behind(self):
+        get5.app.config['SCORE_UPDATE_FLUSH_INTERVAL'] = 60 * 60
+        try:
+            match = Match.query.get(1)
+            match.max_maps = 3
+            db.session.commit()
+            matchkey = match.api_key
+            response = self.app.post('/match/1/map/0/start',
+                                     data={
+                                         'mapname': 'de_dust2',
+                                         'key': matchkey,
+                                     })
+            self.assertEqual(response.status_code, 200)
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=0).first()
+            get5.cache.delete(api._score_cache_key(mapstat))
+
+            # The first update is written straight away, the rest are held
+            for t1, t2 in [(1, 0), (1, 1), (5, 3), (16, 3)]:
+                response = self.app.post('/match/1/map/0/update',
+                                         data={
+                                             'team1score': t1,
+                                             'team2score': t2,
+                                             'key': matchkey,
+                                         })
+                self.assertEqual(response.status_code, 200)
+
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=0).first()
+            self.assertEqual(mapstat.team1_score, 1)
+            self.assertEqual(mapstat.team2_score, 0)
+
+            # Buffered scores are written once they are older than the
+            # interval, even if the plugin goes quiet
+            self.assertEqual(api.flush_stale_map_scores(), [])
+            key = api._score_cache_key(mapstat)
+            pending = get5.cache.get(key)
+            get5.cache.set(key, {'scores': pending['scores'],
+                                 'flushed_at': time.time() - 60 * 60})
+            self.assertEqual(api.flush_stale_map_scores(), [mapstat])
+            db.session.commit()
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=0).first()
+            self.assertEqual(mapstat.team1_score, 16)
+            self.assertEqual(mapstat.team2_score, 3)
+            self.assertEqual(api.flush_stale_map_scores(), [])
+
+            # Finishing the map writes the last score
+            response = self.app.post('/match/1/map/0/finish',
+                                     data={
+                                         'winner': 'team1',
+                                         'key': matchkey,
+                                     })
+            self.assertEqual(response.status_code, 200)
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=0).first()
+            self.assertEqual(mapstat.team1_score, 16)
+            self.assertEqual(mapstat.team2_score, 3)
+
+            # Same for a map whose updates were only ever buffered, which is
+            # flushed by the series finish
+            response = self.app.post('/match/1/map/1/start',
+                                     data={
+                                         'mapname': 'de_cache',
+                                         'key': matchkey,
+                                     })
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=1).first()
+            get5.cache.set(api._score_cache_key(mapstat),
+                           {'scores': None, 'flushed_at': time.time()})
+            for t1, t2 in [(3, 0), (7, 9)]:
+                response = self.app.post('/match/1/map/1/update',
+                                         data={
+                                             'team1score': t1,
+                                             'team2score': t2,
+                                             'key': matchkey,
+                                         })
+                self.assertEqual(response.status_code, 200)
+
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=1).first()
+            self.assertEqual(mapstat.team1_score, 0)
+            self.assertEqual(mapstat.team2_score, 0)
+
+            response = self.app.post('/match/1/finish',
+                                     data={
+                                         'winner': 'team1',
+                                         'key': matchkey,
+                                     })
+            self.assertEqual(response.status_code, 200)
+            mapstat = MapStats.query.filter_by(match_id=1, map_number=1).first()
+            self.assertEqual(mapstat.team1_score, 7)
+            self.assertEqual(mapstat.team2_score, 9)
+            self.assertEqual(get5.cache.get(api._score_cache_key(mapstat)), None)
+
+        finally:
+            get5.app.config.pop('SCORE_UPDATE_FLUSH_INTERVAL')
+
+    # Replaying the event journal should rebuild the same stats the api wrote.
+    def test_replay_events(self):
+        get5.app.config['MATCH_EVENT_JOURNAL'] = True
+        self.addCleanup(get5.app.config.pop, 'MATCH_EVENT_JOURNAL', None)
+        match = Match.query.get(1)
+        match.max_maps = 3
+        db.session.commit()
+        matchkey = match.api_key
+
+        def post(url, **data):
+            data['key'] = matchkey
+            response = self.app.post(url, data=data)
+            self.assertEqual(response.status_code, 200)
+
+        post('/match/1/map/0/start', mapname='de_dust2')
+        post('/match/1/map/0/update', team1score=3, team2score=1)
+        post('/match/1/map/0/player/76561198053858673/update',
+             name='player1', team='team1', kills=8, deaths=2, roundsplayed=4)
+        post('/match/1/map/0/update', team1score=16, team2score=4)
+        post('/match/1/map/0/finish', winner='team1')
+
+        post('/match/1/map/1/start', mapname='de_cache')
+        players = {'76561198064755913': {'name': 'player2', 'team': 'team2',
+                                         'kills': 3, 'roundsplayed': 30}}
+        response = self.app.post('/match/1/map/1/players/update?key=' + matchkey,
+                                 data=json.dumps({'players': players}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        post('/match/1/map/1/update', team1score=14, team2score=16)
+        post('/match/1/map/1/finish', winner='team2')
+        post('/match/1/finish', winner='team1')
+
+        self.assertEqual(MatchEvent.query.filter_by(match_id=1).count(), 10)
+
+        def snapshot():
+            match = Match.query.get(1)
+            rv = [(match.start_time, match.end_time, match.winner,
+                   match.team1_score, match.team2_score)]
+            for m in MapStats.query.filter_by(match_id=1).order_by(MapStats.map_number):
+                rv.append((m.map_number, m.map_name, m.start_time, m.end_time,
+                           m.winner, m.team1_score, m.team2_score))
+            for p in PlayerStats.query.filter_by(match_id=1).order_by(PlayerStats.steam_id):
+                rv.append((p.steam_id, p.name, p.team_id, p.kills, p.deaths,
+                           p.roundsplayed))
+            return rv
+
+        expected = snapshot()
+        self.assertEqual(len(expected), 5)
+
+        api.replay_match_events(Match.query.get(1))
+        db.session.commit()
+        self.assertEqual(snapshot(), expected)
+
     def test_match_stats_wrong_api_key(self):
         self.assertEqual(self.app.get('/match/1').status_code, 200)
         self.assertEqual(self.app.get('/matches').status_code, 200)
@@ -0,0 +1,199 @@
+import csv
+import datetime
+import json
+
+from get5 import db, config_setting
+from models import Team, Match
+import allocation
+import scheduler
+
+SERIES_TYPES = ['bo1-preset', 'bo1', 'bo2', 'bo3', 'bo5', 'bo7']
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def parse_schedule(text, format='json'):
+    """Reads a list of match entries from a json or csv schedule.
+
+    Json is either a list of matches or an object with a "matches" list and
+    defaults for the other keys. Each match has team1 and team2 (team ids or
+    names) and optionally series_type, veto_mappool, match_title,
+    team1_string, team2_string and scheduled_start (UTC, as
+    "YYYY-MM-DD HH:MM"). Csv rows are team1,team2 optionally followed by
+    series_type, the maps separated by spaces, match_title and
+    scheduled_start, an optional header row starts with "team1".
+    """
+    if format == 'json':
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise ScheduleError('Invalid json')
+        if isinstance(data, list):
+            data = {'matches': data}
+        if not isinstance(data, dict) or not isinstance(data.get('matches'), list):
+            raise ScheduleError('Expected a list of matches')
+
+        defaults = dict((k, v) for k, v in data.items() if k != 'matches')
+        entries = []
+        for entry in data['matches']:
+            if not isinstance(entry, dict):
+                raise ScheduleError('Expected a list of matches')
+            entries.append(dict(defaults, **entry))
+        return entries
+
+    elif format == 'csv':
+        entries = []
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        lines = text.splitlines()
+        for row in csv.reader(lines):
+            row = [cell.strip().decode('utf-8') for cell in row]
+            if not any(row) or row[0].lower() == 'team1':
+                continue
+            entry = dict(zip(['team1', 'team2', 'series_type', 'veto_mappool',
+                              'match_title', 'scheduled_start'], row))
+            if entry.get('veto_mappool'):
+                entry['veto_mappool'] = entry['veto_mappool'].split()
+            entries.append(dict((k, v) for k, v in entry.items() if v))
+        return entries
+
+    raise ScheduleError('Unknown format {}'.format(format))
+
+
+def find_teams(user):
+    # Teams the user can create matches for, by id and by name. The user's
+    # own teams win over public ones of the same name.
+    teams = Team.query.filter(db.or_(
+        Team.user_id == user.id, Team.public_team == True)).all()
+    by_name = {}
+    for team in sorted(teams, key=lambda t: t.user_id == user.id):
+        by_name[team.name.lower()] = team
+    return dict((team.id, team) for team in teams), by_name
+
+
+def build_row(user, entry, teams_by_id, teams_by_name):
+    def lookup(key):
+        value = entry.get(key)
+        if value is None:
+            raise ScheduleError('Missing {}'.format(key))
+        team = None
+        try:
+            team = teams_by_id.get(int(value))
+        except (TypeError, ValueError):
+            pass
+        team = team or teams_by_name.get(unicode(value).lower())
+        if team is None:
+            raise ScheduleError('Unknown team {}'.format(value))
+        return team
+
+    team1 = lookup('team1')
+    team2 = lookup('team2')
+    if team1.id == team2.id:
+        raise ScheduleError('Teams cannot be equal')
+
+    series_type = entry.get('series_type', 'bo1')
+    if series_type not in SERIES_TYPES:
+        raise ScheduleError('Unknown series type {}'.format(series_type))
+    skip_veto = 'preset' in series_type
+    max_maps = int(series_type[2])
+
+    mappool = entry.get('veto_mappool') or config_setting('DEFAULT_MAPLIST')
+    if isinstance(mappool, basestring):
+        mappool = mappool.split()
+    if not isinstance(mappool, list):
+        raise ScheduleError('Invalid veto_mappool {}'.format(mappool))
+    for map_name in mappool:
+        if (not isinstance(map_name, basestring) or
+                map_name not in config_setting('MAPLIST')):
+            raise ScheduleError('Unknown map {}'.format(map_name))
+    if skip_veto and len(mappool) != 1:
+        raise ScheduleError(
+            'You must have exactly 1 map selected to do a bo1 with a preset map')
+    if len(mappool) < max_maps:
+        raise ScheduleError(
+            'You must have at least {} maps selected to do a Bo{}'.format(
+                max_maps, max_maps))
+
+    title = entry.get('match_title', 'Map {MAPNUMBER} of {MAXMAPS}')
+    team1_string = entry.get('team1_string', '')
+    team2_string = entry.get('team2_string', '')
+    for key, value, column in [('match_title', title, Match.title),
+                               ('team1_string', team1_string, Match.team1_string),
+                               ('team2_string', team2_string, Match.team2_string)]:
+        if not isinstance(value, basestring):
+            raise ScheduleError('Invalid {} {}'.format(key, value))
+        if len(value) > column.type.length:
+            raise ScheduleError('{} is too long'.format(value))
+
+    scheduled_start = None
+    if entry.get('scheduled_start'):
+        try:
+            scheduled_start = datetime.datetime.strptime(
+                entry['scheduled_start'].replace('T', ' ')[:16],
+                '%Y-%m-%d %H:%M')
+        except (AttributeError, ValueError):
+            raise ScheduleError('Invalid scheduled start {}'.format(
+                entry['scheduled_start']))
+
+    return {
+        'user_id': user.id,
+        'team1_id': team1.id,
+        'team2_id': team2.id,
+        'team1_string': team1_string,
+        'team2_string': team2_string,
+        'skip_veto': skip_veto,
+        'title': title,
+        'veto_mappool': ' '.join(mappool),
+        'max_maps': max_maps,
+        'api_key': Match.generate_api_key(),
+        'plugin_version': 'unknown',
+        'cancelled': False,
+        'forfeit': False,
+        'queued': True,
+        'scheduled_start': scheduled_start,
+    }
+
+
+def create_matches(user, entries):
+    """Creates queued matches for all schedule entries in one transaction.
+
+    Nothing is created if any entry is invalid, the ScheduleError names the
+    entry. The matches are inserted with a single executemany, their
+    configs are built when first fetched, and free servers are handed out
+    to them right away; the rest start as servers are released, scheduled
+    ones not before their scheduled_start. Returns the new matches.
+    """
+    if not entries:
+        raise ScheduleError('No matches given')
+
+    max_matches = config_setting('USER_MAX_MATCHES')
+    if (max_matches >= 0 and not user.admin and
+            user.matches.count() + len(entries) > max_matches):
+        raise ScheduleError('You can only have {} matches created'.format(
+            max_matches))
+
+    teams_by_id, teams_by_name = find_teams(user)
+    rows = []
+    for i, entry in enumerate(entries):
+        try:
+            rows.append(build_row(user, entry, teams_by_id, teams_by_name))
+        except ScheduleError as e:
+            raise ScheduleError('Match {}: {}'.format(i + 1, e))
+
+    db.session.bulk_insert_mappings(Match, rows)
+    db.session.commit()
+
+    # Bulk inserts don't return ids, the (indexed) api keys find the new
+    # rows again
+    matches = []
+    api_keys = [row['api_key'] for row in rows]
+    for i in range(0, len(api_keys), 500):
+        matches += Match.query.filter(
+            Match.api_key.in_(api_keys[i:i + 500])).all()
+    matches.sort(key=lambda m: m.id)
+    for match in matches:
+        scheduler.scheduler.add(match)
+    allocation.dispatch_free(user)
+    return matches
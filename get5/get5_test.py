@@ -1,7 +1,12 @@
+import contextlib
 import unittest
 import logging
 
+import sqlalchemy
+
+import api
 import get5
+import models
 from get5 import db
 from models import User, Team, GameServer, Match
 
@@ -15,9 +20,13 @@ class Get5Test(unittest.TestCase):
 
     def setUp(self):
         get5.app.config.from_pyfile('test_config.py')
+        # Each test gets its own empty in-memory cache
+        get5.cache.init_app(get5.app, config={'CACHE_TYPE': 'simple'})
         get5.app.logger.setLevel(logging.ERROR)
         self.app = get5.app.test_client()
         get5.register_blueprints()
+        api._api_key_cache.clear()
+        models._steam_names.clear()
         db.create_all()
         self.create_test_data()
 
@@ -25,6 +34,23 @@ class Get5Test(unittest.TestCase):
         db.session.remove()
         db.drop_all()
 
+    # Collects the sql statements run inside the block, for tests that
+    # pin a code path to a fixed number of queries.
+    @contextlib.contextmanager
+    def count_queries(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(
+            db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(
+                db.engine, 'before_cursor_execute', before_cursor_execute)
+
     def create_test_data(self):
         user = User.get_or_create(123)
         user.admin = True
@@ -0,0 +1,114 @@
+import datetime
+import threading
+
+from get5 import app, db, config_setting
+from models import GameServer, RconJob
+import util
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_workers = []
+
+# Jobs left running by a dead worker are queued again until they were
+# started this many times
+MAX_ATTEMPTS = 2
+
+
+def enqueue(match, server, action, commands, user=None):
+    job = RconJob.create(match, server, action, commands, user)
+    db.session.commit()
+    start_workers()
+    _wakeup.set()
+    return job
+
+
+def start_workers():
+    # Web processes run their own workers unless RCON_JOB_WORKERS is 0, in
+    # which case "manager.py run_jobs" has to be running somewhere.
+    num_workers = config_setting('RCON_JOB_WORKERS')
+    if config_setting('TESTING') or not num_workers:
+        return
+
+    with _lock:
+        while len(_workers) < num_workers:
+            t = threading.Thread(target=worker_loop)
+            t.daemon = True
+            t.start()
+            _workers.append(t)
+
+
+def worker_loop():
+    with app.app_context():
+        while True:
+            _wakeup.clear()
+            try:
+                run_pending()
+            except Exception:
+                app.logger.exception('Failed to run rcon jobs')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+            _wakeup.wait(config_setting('RCON_JOB_POLL_INTERVAL'))
+
+
+def run_pending(limit=None):
+    # Runs queued jobs oldest first, returns how many were run
+    expire_stale()
+    count = 0
+    while limit is None or count < limit:
+        job = RconJob.query.filter_by(status=RconJob.QUEUED).order_by(
+            RconJob.id).first()
+        if job is None:
+            break
+        if claim(job):
+            run_job(job)
+            count += 1
+    return count
+
+
+def claim(job):
+    # Other workers, maybe in other processes, may be after the same job
+    claimed = RconJob.query.filter_by(
+        id=job.id, status=RconJob.QUEUED).update({
+            'status': RconJob.RUNNING,
+            'started_at': datetime.datetime.utcnow(),
+            'attempts': db.func.coalesce(RconJob.attempts, 0) + 1,
+        }, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+
+def run_job(job):
+    server = GameServer.query.get(job.server_id)
+    try:
+        if not server:
+            raise util.RconError('Server not found')
+        responses = server.send_rcon_commands(
+            job.get_commands(), raise_errors=True)
+        if responses is None:
+            raise util.RconError('Invalid server port')
+        job.finish(responses)
+    except util.RconError as e:
+        job.fail(str(e) or 'Failed to connect to server')
+    db.session.commit()
+    app.logger.info('Ran {}'.format(job))
+
+
+def expire_stale():
+    # Jobs whose worker died while running them, e.g. in a crashed or
+    # restarted process, are run again, or failed once they were tried
+    # MAX_ATTEMPTS times
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=config_setting('RCON_JOB_TIMEOUT'))
+    stale = RconJob.query.filter(
+        RconJob.status == RconJob.RUNNING, RconJob.started_at < cutoff)
+    stale.filter(db.func.coalesce(RconJob.attempts, 0) < MAX_ATTEMPTS).update({
+        'status': RconJob.QUEUED,
+        'started_at': None,
+    }, synchronize_session=False)
+    stale.update({
+        'status': RconJob.FAILED,
+        'result': 'Timed out',
+        'finished_at': datetime.datetime.utcnow(),
+    }, synchronize_session=False)
+    db.session.commit()
@@ -1,14 +1,25 @@
-from flask import Blueprint, request, render_template, flash, g, redirect, jsonify, Markup
-
+from flask import (Blueprint, request, render_template, flash, g, redirect, jsonify,
+                   Response, make_response, session, stream_with_context)
+
+import allocation
+import api
+import bulk
+import jobs
+import scheduler
 import steamid
 import get5
-from get5 import app, db, BadRequestError, config_setting
-from models import User, Team, Match, GameServer
+from get5 import app, db, cache, BadRequestError, config_setting
+from models import User, Team, Match, GameServer, MapStats, MatchEvent, PlayerStats, RconJob, get_steam_names
 import util
 
+import datetime
+import hashlib
+import json
+import time
+
 from wtforms import (
     Form, widgets, validators,
-    StringField, RadioField,
+    StringField, RadioField, DateTimeField,
     SelectField, ValidationError, SelectMultipleField)
 
 match_blueprint = Blueprint('match', __name__)
@@ -41,8 +52,12 @@ def mappool_validator(form, field):
 
 
 class MatchForm(Form):
-    server_id = SelectField('Server', coerce=int,
-                            validators=[validators.required()])
+    # 0 lets get5.allocation pick a server, or queue the match
+    server_id = SelectField('Server', coerce=int, default=0)
+
+    scheduled_start = DateTimeField('Scheduled start (UTC)',
+                                    format='%Y-%m-%d %H:%M',
+                                    validators=[validators.Optional()])
 
     match_title = StringField('Match title text',
                               default='Map {MAPNUMBER} of {MAXMAPS}',
@@ -107,7 +122,7 @@ class MatchForm(Form):
 
     def add_servers(self, user):
         if self.server_id.choices is None:
-            self.server_id.choices = []
+            self.server_id.choices = [(0, 'Automatic')]
 
         server_ids = []
         for s in user.servers:
@@ -146,15 +161,31 @@ def match_create():
         if form.validate():
             mock = config_setting('TESTING')
 
-            server = GameServer.query.get_or_404(form.data['server_id'])
-
-            match_on_server = g.user.matches.filter_by(
-                server_id=server.id, end_time=None, cancelled=False).first()
+            server = None
+            match_on_server = None
+            if form.data['server_id']:
+                server = GameServer.query.get_or_404(form.data['server_id'])
+                if server.in_use:
+                    match_on_server = g.user.matches.filter_by(
+                        server_id=server.id, end_time=None,
+                        cancelled=False).first()
 
             server_avaliable = False
             json_reply = None
 
-            if g.user.id != server.user_id and not server.public_server:
+            scheduled_start = form.data['scheduled_start']
+            if scheduled_start and scheduled_start <= datetime.datetime.utcnow():
+                scheduled_start = None
+
+            if scheduled_start and server is not None:
+                message = 'Scheduled matches are assigned a server automatically'
+            elif server is None:
+                # No free server just means waiting in the queue
+                if not scheduled_start:
+                    server, json_reply = allocation.find_server(g.user)
+                server_avaliable = True
+                message = 'Success'
+            elif g.user.id != server.user_id and not server.public_server:
                 server_avaliable = False
                 message = 'This is not your server!'
             elif match_on_server is not None:
@@ -165,10 +196,16 @@ def match_create():
                 server_avaliable = True
                 message = 'Success'
             else:
-                json_reply, message = util.check_server_avaliability(
-                    server)
+                json_reply, message = server.check_availability()
                 server_avaliable = (json_reply is not None)
 
+            # A server picked by hand is claimed the same way as an automatic
+            # one, so two new matches can't both get it
+            if (server_avaliable and form.data['server_id'] and
+                    not allocation.claim_server(server)):
+                server_avaliable = False
+                message = 'Server is already in use'
+
             if server_avaliable:
                 skip_veto = 'preset' in form.data['series_type']
                 try:
@@ -180,7 +217,7 @@ def match_create():
                     g.user, form.data['team1_id'], form.data['team2_id'],
                     form.data['team1_string'], form.data['team2_string'],
                     max_maps, skip_veto, form.data['match_title'],
-                    form.data['veto_mappool'], form.data['server_id'])
+                    form.data['veto_mappool'], server.id if server else None)
 
                 # Save plugin version data if we have it
                 if json_reply and 'plugin_version' in json_reply:
@@ -188,8 +225,26 @@ def match_create():
                 else:
                     match.plugin_version = 'unknown'
 
-                server.in_use = True
+                if server is None:
+                    allocation.queue_match(match)
+                    match.scheduled_start = scheduled_start
+                    db.session.flush()
+                    match.update_config()
+                    db.session.commit()
+                    app.logger.info('User {} created match {}, queued'
+                                    .format(g.user.id, match.id))
+                    if scheduled_start:
+                        scheduler.scheduler.add(match)
+                        flash('Match {} will start at {:%Y-%m-%d %H:%M} UTC'
+                              .format(match.id, scheduled_start))
+                    else:
+                        flash('All servers are busy, match {} will start on '
+                              'the next free one'.format(match.id))
+                    return redirect('/mymatches')
 
+                db.session.flush()
+                server.lease_to(match)
+                match.update_config()
                 db.session.commit()
                 app.logger.info('User {} created match {}, assigned to server {}'
                                 .format(g.user.id, match.id, server.id))
@@ -209,12 +264,148 @@ def match_create():
                            match_text_option=config_setting('CREATE_MATCH_TITLE_TEXT'))
 
 
+@match_blueprint.route('/match/create/bulk', methods=['GET', 'POST'])
+def match_create_bulk():
+    # Creates every match of a bracket or schedule at once, see bulk.py. Json
+    # requests get a json reply.
+    if not g.user:
+        return redirect('/login')
+
+    json_request = request.get_json(silent=True)
+    schedule = request.values.get('schedule', '')
+    format = request.values.get('format', 'csv')
+
+    if request.method == 'POST':
+        try:
+            if json_request is not None:
+                entries = bulk.parse_schedule(json.dumps(json_request), 'json')
+            else:
+                entries = bulk.parse_schedule(schedule, format)
+            matches = bulk.create_matches(g.user, entries)
+        except bulk.ScheduleError as e:
+            if json_request is not None:
+                raise BadRequestError(str(e))
+            flash(str(e))
+        else:
+            app.logger.info('User {} created {} matches'.format(
+                g.user.id, len(matches)))
+            if json_request is not None:
+                return jsonify({'matches': [
+                    {'id': m.id, 'server_id': m.server_id, 'queued': m.queued}
+                    for m in matches]})
+
+            flash('Created {} matches'.format(len(matches)))
+            return redirect('/mymatches')
+
+    return render_template('match_bulk.html', user=g.user,
+                           schedule=schedule, format=format)
+
+
+@match_blueprint.before_app_first_request
+def start_job_workers():
+    # Jobs queued before a restart or by other processes are run without
+    # waiting for this process to queue one of its own
+    jobs.start_workers()
+
+
+@match_blueprint.before_app_first_request
+def start_scheduler():
+    # Scheduled matches are started by a thread of every web process,
+    # unless MATCH_SCHEDULER is off and "manager.py run_scheduler" runs them.
+    if config_setting('MATCH_SCHEDULER') and not config_setting('TESTING'):
+        scheduler.scheduler.start(request.host_url)
+
+
+def scoreboard_stats(stats):
+    # The stat columns of a match page scoreboard row, including the derived
+    # ones, from a dict of PlayerStats.STAT_COLUMNS values
+    rv = {}
+    for stat in ['kills', 'deaths', 'assists', 'flashbang_assists',
+                 'v1', 'v2', 'v3', 'roundsplayed']:
+        rv[stat] = stats[stat]
+
+    derived = PlayerStats.derived_stats(stats)
+    rv['rating'] = round(derived['rating'], 2)
+    rv['fpr'] = round(derived['fpr'], 2)
+    rv['adr'] = round(derived['adr'], 1)
+    rv['hsp'] = round(derived['hsp'], 2)
+    return rv
+
+
+def player_stats_row(player_stats, name=None):
+    # Plain data for one row of a match page scoreboard. name is the
+    # player's Steam name, if known, otherwise the in-game name the plugin
+    # reported is shown.
+    rv = scoreboard_stats(player_stats.stat_values())
+    rv['steam_id'] = player_stats.steam_id
+    rv['steam_url'] = player_stats.get_steam_url()
+    rv['name'] = name or player_stats.name
+    return rv
+
+
+def build_scoreboard(match, team1, team2):
+    """Returns the per-map scoreboards shown on a match page.
+
+    Every map, player and Steam name of the match is loaded with one query
+    each, and each map has a list of (team, player rows) entries for team1 and team2.
+    Players who haven't played a round yet are left out.
+    """
+    map_stat_list = match.map_stats.order_by(MapStats.map_number).all()
+    player_stat_list = PlayerStats.query.filter(
+        PlayerStats.match_id == match.id,
+        PlayerStats.roundsplayed > 0).order_by(PlayerStats.id).all()
+
+    # Players without a Player row yet get one from refresh_players
+    names = get_steam_names([p.steam_id for p in player_stat_list], fetch=False)
+
+    rows = {}
+    for player_stats in player_stat_list:
+        key = (player_stats.map_id, player_stats.team_id)
+        rows.setdefault(key, []).append(player_stats_row(
+            player_stats, names.get(str(player_stats.steam_id))))
+
+    scoreboard = []
+    for map_stats in map_stat_list:
+        scoreboard.append({
+            'map_number': map_stats.map_number,
+            'map_name': map_stats.map_name,
+            'start_time': map_stats.start_time,
+            'end_time': map_stats.end_time,
+            'team1_score': map_stats.team1_score,
+            'team2_score': map_stats.team2_score,
+            'teams': [(team, rows.get((map_stats.id, team.id), []))
+                      for team in (team1, team2)],
+        })
+
+    return scoreboard
+
+
+def match_page_response(page, logged_in):
+    response = make_response(page)
+    response.set_etag(hashlib.sha1(page.encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = '{}, max-age=60'.format(
+        'private' if logged_in else 'public')
+    return response.make_conditional(request)
+
+
 @match_blueprint.route('/match/<int:matchid>')
 def match(matchid):
+    # Pages of finalized matches never change on their own, so they are
+    # rendered once and served from the cache until a late api write or a
+    # team edit invalidates them. Pages with flashed messages are one-off.
+    logged_in = g.user is not None
+    cache_key = Match.page_cache_key(matchid, logged_in)
+    cache_timeout = config_setting('MATCH_PAGE_CACHE_TIMEOUT')
+    use_cache = cache_timeout and '_flashes' not in session
+    if use_cache:
+        page = cache.get(cache_key)
+        if page is not None:
+            return match_page_response(page, logged_in)
+
     match = Match.query.get_or_404(matchid)
     team1 = Team.query.get_or_404(match.team1_id)
     team2 = Team.query.get_or_404(match.team2_id)
-    map_stat_list = match.map_stats.all()
+    map_stat_list = build_scoreboard(match, team1, team2)
 
     is_owner = False
     has_admin_access = False
@@ -224,18 +415,138 @@ def match(matchid):
         has_admin_access = is_owner or (config_setting(
             'ADMINS_ACCESS_ALL_MATCHES') and g.user.admin)
 
-    return render_template(
+    recent_jobs = []
+    if has_admin_access and not match.finalized():
+        recent_jobs = RconJob.query.filter_by(match_id=match.id).order_by(
+            -RconJob.id).limit(5).all()
+
+    page = render_template(
         'match.html', user=g.user, admin_access=has_admin_access,
                            match=match, team1=team1, team2=team2,
-                           map_stat_list=map_stat_list)
+                           map_stat_list=map_stat_list, recent_jobs=recent_jobs)
+
+    if use_cache and match.finalized():
+        cache.set(cache_key, page, timeout=cache_timeout)
+        return match_page_response(page, logged_in)
+
+    return page
+
+
+def player_stream_data(steam_id, values):
+    rv = scoreboard_stats(api.player_stat_values(values))
+    rv['steam_id'] = steam_id
+    rv['name'] = values.get('name')
+    rv['team'] = values.get('team')
+    return rv
+
+
+def stream_message(version, event):
+    # event is as published by api.publish_event
+    data = event['data'] or {}
+    message = {
+        'type': event['type'],
+        'map_number': event['map_number'],
+    }
+
+    if event['type'] == MatchEvent.MAP_UPDATE:
+        message['team1_score'], message['team2_score'] = api.get_map_scores(data)
+
+    elif event['type'] == MatchEvent.PLAYERS_UPDATE:
+        message['players'] = [player_stream_data(steam_id, values)
+                              for steam_id, values in data['players'].items()]
+
+    return 'id: {}\ndata: {}\n\n'.format(version, json.dumps(message))
+
+
+# Server-sent events stream of the plugin api events for a live match, used by
+# match.html to update scores in place instead of reloading the page. The api
+# publishes the events in the shared cache, so streams never query the
+# database while they wait.
+@match_blueprint.route('/match/<int:matchid>/stream')
+def match_stream(matchid):
+    match = Match.query.get_or_404(matchid)
+    version_key = api.match_stream_version_key(matchid)
+
+    last_version = request.headers.get('Last-Event-ID')
+    if last_version is not None:
+        last_version = util.as_int(last_version)
+    elif match.finalized():
+        # Nothing more to send, a 204 tells the browser not to reconnect
+        return '', 204
+    else:
+        last_version = cache.get(version_key) or 0
+
+    db.session.remove()
+    timeout = config_setting('MATCH_STREAM_TIMEOUT')
+    poll_interval = 1.0
+    heartbeat_interval = 15.0
+    # Events are only kept for a while, a stream further behind than this
+    # has the page reloaded instead
+    max_behind = 100
+
+    def generate(last_version):
+        start_time = time.time()
+        last_send = start_time
+        while True:
+            version = cache.get(version_key) or 0
+            if version < last_version:
+                # The counter was lost from the cache and starts over
+                last_version = version
+
+            if version - last_version > max_behind:
+                last_version = version
+                last_send = time.time()
+                yield 'id: {}\ndata: {}\n\n'.format(
+                    version, json.dumps({'type': 'reload'}))
+
+            elif version > last_version:
+                versions = range(last_version + 1, version + 1)
+                events = cache.get_many(*[
+                    api.match_stream_event_key(matchid, v) for v in versions])
+                for v, event in zip(versions, events):
+                    last_version = v
+                    if event is None:
+                        continue
+                    last_send = time.time()
+                    yield stream_message(v, event)
+                    if event['type'] == MatchEvent.SERIES_FINISH:
+                        return
+
+            now = time.time()
+            if now - start_time >= timeout:
+                # The browser reconnects with a Last-Event-ID header
+                return
+            if now - last_send >= heartbeat_interval:
+                last_send = now
+                yield ':\n\n'
+
+            time.sleep(poll_interval)
+
+    return Response(stream_with_context(generate(last_version)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @match_blueprint.route('/match/<int:matchid>/config')
 def match_config(matchid):
     match = Match.query.get_or_404(matchid)
-    dict = match.build_match_dict()
-    json_text = jsonify(dict)
-    return json_text
+    config = match.get_config().encode('utf-8')
+    etag = hashlib.sha1(config).hexdigest()
+
+    use_gzip = (config_setting('MATCH_CONFIG_GZIP') and
+                'gzip' in request.accept_encodings)
+    if use_gzip:
+        etag += '-gzip'
+
+    response = make_response(config)
+    response.mimetype = 'application/json'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response = response.make_conditional(request)
+    if use_gzip and response.status_code == 200:
+        response.data = util.gzip_bytes(config)
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 def admintools_check(user, match):
@@ -254,22 +565,49 @@ def admintools_check(user, match):
         raise BadRequestError('Match is cancelled')
 
 
+def admintools_server(match):
+    # A match whose lease was reclaimed keeps its server_id, but the server
+    # may be running another match by now and must not get its commands.
+    # Returns None after flashing why when the lease is gone.
+    server = GameServer.query.get_or_404(match.server_id)
+    if not server.leased_by(match):
+        flash('Match {} no longer holds server {}'.format(
+            match.id, server.get_display()))
+        return None
+    return server
+
+
+def queue_admin_job(match, server, action, commands, message):
+    # Admin rcon actions run in the background, the request only queues them
+    job = jobs.enqueue(match, server, action, commands, g.user)
+    if util.as_int(request.values.get('json')):
+        return jsonify(job.to_dict())
+
+    flash('{} (job {})'.format(message, job.id))
+    return redirect('/match/{}'.format(match.id))
+
+
 @match_blueprint.route('/match/<int:matchid>/cancel')
 def match_cancel(matchid):
     match = Match.query.get_or_404(matchid)
     admintools_check(g.user, match)
 
     match.cancelled = True
-    server = GameServer.query.get(match.server_id)
-    if server:
-        server.in_use = False
-
+    match.queued = False
+    server = match.get_server()
+    if server and not server.leased_by(match):
+        # Reclaimed and maybe running another match by now
+        server = None
     db.session.commit()
 
-    try:
-        server.send_rcon_command('get5_endmatch', raise_errors=True)
-    except util.RconError as e:
-        flash('Failed to cancel match: ' + str(e))
+    # The next queued match's load job ends this one on the server
+    next_match = allocation.release(server)
+    if next_match:
+        flash('Ending match {} on the server, match {} takes its place'.format(
+            match.id, next_match.id))
+    elif server:
+        job = jobs.enqueue(match, server, 'cancel', ['get5_endmatch'], g.user)
+        flash('Ending match {} on the server (job {})'.format(match.id, job.id))
 
     return redirect('/mymatches')
 
@@ -280,77 +618,68 @@ def match_rcon(matchid):
     admintools_check(g.user, match)
 
     command = request.values.get('command')
-    server = GameServer.query.get_or_404(match.server_id)
+    server = admintools_server(match)
 
-    if command:
-        try:
-            rcon_response = server.send_rcon_command(
-                command, raise_errors=True)
-            if rcon_response:
-                rcon_response = Markup(rcon_response.replace('\n', '<br>'))
-            else:
-                rcon_response = 'No output'
-            flash(rcon_response)
-        except util.RconError as e:
-            print(e)
-            flash('Failed to send command: ' + str(e))
+    if not command or server is None:
+        return redirect('/match/{}'.format(matchid))
 
-    return redirect('/match/{}'.format(matchid))
+    return queue_admin_job(match, server, 'rcon', [command],
+                           'Sending command')
 
 
 @match_blueprint.route('/match/<int:matchid>/pause')
 def match_pause(matchid):
     match = Match.query.get_or_404(matchid)
     admintools_check(g.user, match)
-    server = GameServer.query.get_or_404(match.server_id)
+    server = admintools_server(match)
+    if server is None:
+        return redirect('/match/{}'.format(matchid))
 
-    try:
-        server.send_rcon_command('sm_pause', raise_errors=True)
-        flash('Paused match')
-    except util.RconError as e:
-        flash('Failed to send pause command: ' + str(e))
-
-    return redirect('/match/{}'.format(matchid))
+    return queue_admin_job(match, server, 'pause', ['sm_pause'],
+                           'Pausing match')
 
 
 @match_blueprint.route('/match/<int:matchid>/unpause')
 def match_unpause(matchid):
     match = Match.query.get_or_404(matchid)
     admintools_check(g.user, match)
-    server = GameServer.query.get_or_404(match.server_id)
-
-    try:
-        server.send_rcon_command('sm_unpause', raise_errors=True)
-        flash('Unpaused match')
-    except util.RconError as e:
-        flash('Failed to send unpause command: ' + str(e))
+    server = admintools_server(match)
+    if server is None:
+        return redirect('/match/{}'.format(matchid))
 
-    return redirect('/match/{}'.format(matchid))
+    return queue_admin_job(match, server, 'unpause', ['sm_unpause'],
+                           'Unpausing match')
 
 
 @match_blueprint.route('/match/<int:matchid>/adduser')
 def match_adduser(matchid):
     match = Match.query.get_or_404(matchid)
     admintools_check(g.user, match)
-    server = GameServer.query.get_or_404(match.server_id)
+    server = admintools_server(match)
+    if server is None:
+        return redirect('/match/{}'.format(matchid))
     team = request.values.get('team')
     if not team:
         raise BadRequestError('No team specified')
 
-    auth = request.values.get('auth')
-    suc, new_auth = steamid.auth_to_steam64(auth)
-    if suc:
-        try:
-            command = 'get5_addplayer {} {}'.format(new_auth, team)
-            response = server.send_rcon_command(command, raise_errors=True)
-            flash(response)
-        except util.RconError as e:
-            flash('Failed to send command: ' + str(e))
-
-    else:
-        flash('Invalid steamid: {}'.format(auth))
-
-    return redirect('/match/{}'.format(matchid))
+    # Several players can be added at once, separated by commas
+    commands = []
+    auths = request.values.get('auth', '').split(',')
+    if len(auths) > Team.MAXPLAYERS:
+        flash('At most {} players can be added at once'.format(Team.MAXPLAYERS))
+        return redirect('/match/{}'.format(matchid))
+    resolved = steamid.auth_to_steam64_many(
+        auths, deadline=config_setting('STEAM_LOOKUP_DEADLINE'),
+        max_workers=config_setting('STEAM_LOOKUP_WORKERS'))
+    for auth in auths:
+        suc, new_auth = resolved.get(auth, (False, ''))
+        if not suc:
+            flash('Invalid steamid: {}'.format(auth))
+            return redirect('/match/{}'.format(matchid))
+        commands.append('get5_addplayer {} {}'.format(new_auth, team))
+
+    return queue_admin_job(match, server, 'adduser', commands,
+                           'Adding players')
 
 
 # @match_blueprint.route('/match/<int:matchid>/sendconfig')
@@ -372,32 +701,37 @@ def match_adduser(matchid):
 def match_backup(matchid):
     match = Match.query.get_or_404(matchid)
     admintools_check(g.user, match)
-    server = GameServer.query.get_or_404(match.server_id)
+    server = admintools_server(match)
+    if server is None:
+        return redirect('/match/{}'.format(matchid))
     file = request.values.get('file')
 
     if not file:
-        # List backup files
-        backup_response = server.send_rcon_command(
-            'get5_listbackups ' + str(matchid))
-        if backup_response:
-            backup_files = sorted(backup_response.split('\n'))
-        else:
-            backup_files = []
+        # List backup files, the page shows them once the job is done
+        job = jobs.enqueue(match, server, 'listbackups',
+                           ['get5_listbackups ' + str(matchid)], g.user)
+        if util.as_int(request.values.get('json')):
+            return jsonify(job.to_dict())
 
         return render_template('match_backup.html', user=g.user,
-                               match=match, backup_files=backup_files)
+                               match=match, job=job)
 
     else:
         # Restore the backup file
         command = 'get5_loadbackup {}'.format(file)
-        response = server.send_rcon_command(command)
-        if response:
-            flash('Restored backup file {}'.format(file))
-        else:
-            flash('Failed to restore backup file {}'.format(file))
-            return redirect('match/{}/backup'.format(matchid))
+        return queue_admin_job(match, server, 'loadbackup', [command],
+                               'Restoring backup file {}'.format(file))
+
+
+@match_blueprint.route('/match/<int:matchid>/jobs/<int:jobid>')
+def match_job(matchid, jobid):
+    match = Match.query.get_or_404(matchid)
+    job = RconJob.query.filter_by(id=jobid, match_id=matchid).first_or_404()
+    if not g.user or not (g.user.id == match.user_id or (
+            g.user.admin and config_setting('ADMINS_ACCESS_ALL_MATCHES'))):
+        raise BadRequestError('You do not have access to this page')
 
-        return redirect('match/{}'.format(matchid))
+    return jsonify(job.to_dict())
 
 
 @match_blueprint.route("/matches")
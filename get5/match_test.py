@@ -1,8 +1,19 @@
+import datetime
+import gzip
+import json
 import unittest
+from cStringIO import StringIO
 
+import allocation
+import get5
 import get5_test
+import jobs
+import rcon
+import simulator
 from flask import url_for
-from models import User, Match, GameServer
+from get5 import db
+from models import (User, Team, Match, GameServer, MapStats, PlayerStats, RconJob,
+                    ServerStatus, MatchEvent)
 
 
 class MatchTests(get5_test.Get5Test):
@@ -101,6 +112,35 @@ class MatchTests(get5_test.Get5Test):
         self.assertEqual(self.app.get('/match/2/config').status_code, 200)
         self.assertTrue(GameServer.query.get(2).in_use)
 
+    # Another request claims the picked server while the form is handled
+    def test_match_create_server_taken(self):
+        claim_server = allocation.claim_server
+
+        def claim_first(server):
+            self.assertTrue(claim_server(GameServer.query.get(server.id)))
+            return claim_server(server)
+
+        allocation.claim_server = claim_first
+        try:
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+                response = c.post('/match/create', data={
+                    'server_id': 2,
+                    'team1_id': 1,
+                    'team2_id': 2,
+                    'match_title': 'Map {MAPNUMBER} of {MAXMAPS}',
+                    'series_type': 'bo1',
+                    'veto_mappool': ['de_dust2'],
+                })
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Server is already in use', response.data)
+        finally:
+            allocation.claim_server = claim_server
+
+        self.assertEqual(Match.query.count(), 1)
+        self.assertIsNone(GameServer.query.get(2).lease_match_id)
+
     # Try starting a match using someone else's public server
     def test_match_create_not_my_server(self):
         # Create a public server first, it will be id=3 (2 servers already exist)
@@ -150,6 +190,590 @@ class MatchTests(get5_test.Get5Test):
         self.assertEqual(self.app.get('/match/2/config').status_code, 200)
         self.assertTrue(GameServer.query.get(3).in_use)
 
+    def test_match_stream(self):
+        match = Match.query.get(1)
+        matchkey = match.api_key
+
+        # The live page hooks up the stream
+        self.assertIn('/match/1/stream', self.app.get('/match/1').data)
+
+        def post(url, **data):
+            data['key'] = matchkey
+            response = self.app.post(url, data=data)
+            self.assertEqual(response.status_code, 200)
+
+        post('/match/1/map/0/start', mapname='de_dust2')
+        post('/match/1/map/0/update', team1score=3, team2score=1)
+        post('/match/1/map/0/player/76561198053858673/update',
+             name='player1', team='team1', kills=8, deaths=2, roundsplayed=4)
+        post('/match/1/map/0/finish', winner='team1')
+        post('/match/1/finish', winner='team1')
+
+        # A finished match has nothing more to stream
+        response = self.app.get('/match/1/stream')
+        self.assertEqual(response.status_code, 204)
+
+        # Reconnecting streams every event since the last one seen, from
+        # the cache: the stream only loads the match, and nothing was
+        # journaled
+        with self.count_queries() as statements:
+            response = self.app.get('/match/1/stream',
+                                    headers={'Last-Event-ID': '1'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            data = response.data
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(MatchEvent.query.count(), 0)
+
+        messages = []
+        for chunk in data.split('\n\n'):
+            for line in chunk.splitlines():
+                if line.startswith('data: '):
+                    messages.append(json.loads(line[len('data: '):]))
+
+        self.assertEqual([m['type'] for m in messages],
+                         ['map_update', 'players_update', 'map_finish', 'series_finish'])
+        self.assertEqual(messages[0]['map_number'], 0)
+        self.assertEqual(messages[0]['team1_score'], 3)
+        self.assertEqual(messages[0]['team2_score'], 1)
+        player = messages[1]['players'][0]
+        self.assertEqual(player['steam_id'], '76561198053858673')
+        self.assertEqual(player['name'], 'player1')
+        self.assertEqual(player['team'], 'team1')
+        self.assertEqual(player['kills'], 8)
+        self.assertEqual(player['adr'], 0.0)
+        self.assertEqual(player['fpr'], 2.0)
+
+    # The match page should cost the same number of queries however many
+    # maps and players it shows.
+    def test_match_page_query_count(self):
+        match = Match.query.get(1)
+        match.max_maps = 5
+        db.session.commit()
+
+        def add_map(map_number):
+            map_stats = MapStats.get_or_create(1, map_number, 'de_dust2')
+            db.session.commit()
+            for i in range(10):
+                player_stats = PlayerStats.get_or_create(
+                    map_stats, str(76561198000000000 + i))
+                player_stats.name = 'player{}'.format(i)
+                player_stats.team_id = 1 if i < 5 else 2
+                player_stats.kills = i
+                player_stats.roundsplayed = 10
+            db.session.commit()
+
+        def render():
+            db.session.remove()
+            with self.count_queries() as statements:
+                response = self.app.get('/match/1')
+            self.assertEqual(response.status_code, 200)
+            return response, len(statements)
+
+        add_map(0)
+        response, one_map = render()
+        self.assertIn('player9', response.data)
+
+        for map_number in range(1, 5):
+            add_map(map_number)
+        response, five_maps = render()
+        self.assertEqual(response.data.count('player9'), 5)
+        self.assertEqual(one_map, five_maps)
+
+    def test_finished_match_page_cache(self):
+        match = Match.query.get(1)
+        matchkey = match.api_key
+
+        # Live matches are always rendered
+        response = self.app.get('/match/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('ETag'), None)
+
+        self.app.post('/match/1/map/0/start',
+                      data={'mapname': 'de_dust2', 'key': matchkey})
+        self.app.post('/match/1/finish', data={'winner': 'team1', 'key': matchkey})
+
+        db.session.remove()
+        response = self.app.get('/match/1')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIn('public', response.headers['Cache-Control'])
+
+        # Served from the cache without touching the database
+        db.session.remove()
+        with self.count_queries() as statements:
+            response = self.app.get('/match/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(statements, [])
+
+        response = self.app.get('/match/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Logged in users get their own copy
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            response = c.get('/match/1')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('private', response.headers['Cache-Control'])
+            self.assertIn('/logout', response.data)
+
+        # A late player stats update invalidates the page
+        response = self.app.post('/match/1/map/0/player/76561198053858673/update',
+                                 data={'name': 'lateplayer', 'team': 'team1',
+                                       'roundsplayed': 10, 'key': matchkey})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/match/1')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('lateplayer', response.data)
+
+        # So does renaming one of the teams
+        team = Team.query.get(1)
+        team.auths = ['76561198053858673'] + [''] * (Team.MAXPLAYERS - 1)
+        db.session.commit()
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            response = c.post('/team/1/edit', data={
+                'name': 'NewTeamName',
+                'tag': 'EnvyUs',
+                'country_flag': 'fr',
+                'logo': '',
+                'auth1': '76561198053858673',
+            })
+            self.assertEqual(response.status_code, 302)
+
+        response = self.app.get('/match/1')
+        self.assertIn('NewTeamName', response.data)
+
+    def test_match_config(self):
+        response = self.app.get('/match/1/config')
+        self.assertEqual(response.status_code, 200)
+        config = json.loads(response.data)
+        self.assertEqual(config['matchid'], '1')
+        self.assertEqual(config['team1']['name'], 'EnvyUs')
+        etag = response.headers['ETag']
+
+        # Later fetches are a single primary key read
+        db.session.remove()
+        with self.count_queries() as statements:
+            response = self.app.get('/match/1/config')
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = self.app.get('/match/1/config',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.app.get('/match/1/config',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotEqual(response.headers['ETag'], etag)
+        data = gzip.GzipFile(fileobj=StringIO(response.data)).read()
+        self.assertEqual(json.loads(data), config)
+
+        # Editing a team rebuilds the config
+        team = Team.query.get(1)
+        team.auths = ['76561198053858673'] + [''] * (Team.MAXPLAYERS - 1)
+        db.session.commit()
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            response = c.post('/team/1/edit', data={
+                'name': 'NewTeamName',
+                'tag': 'EnvyUs',
+                'country_flag': 'fr',
+                'logo': '',
+                'auth1': '76561198053858673',
+            })
+            self.assertEqual(response.status_code, 302)
+
+        response = self.app.get('/match/1/config',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        config = json.loads(response.data)
+        self.assertEqual(config['team1']['name'], 'NewTeamName')
+        self.assertEqual(config['team1']['players'], ['76561198053858673'])
+
+    def test_match_adduser(self):
+        fake = simulator.FakeRconServer(password='password')
+        try:
+            server = GameServer.query.get(1)
+            server.port = fake.port
+            db.session.commit()
+
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+                response = c.get('/match/1/adduser', query_string={
+                    'team': 'team1',
+                    'auth': '76561198053858673, STEAM_0:1:46796472',
+                })
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(jobs.run_pending(), 1)
+
+                # Nothing is sent if one of them is invalid
+                response = c.get('/match/1/adduser', query_string={
+                    'team': 'team2',
+                    'auth': '76561198053858673,[U:1:bad]',
+                })
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(jobs.run_pending(), 0)
+
+                # Nor are more players than a team holds looked up
+                response = c.get('/match/1/adduser', query_string={
+                    'team': 'team2',
+                    'auth': ','.join(['slowplayer'] * 8),
+                })
+                self.assertEqual(response.status_code, 302)
+                with c.session_transaction() as sess:
+                    self.assertIn('At most 7 players', str(sess.pop('_flashes')))
+                self.assertEqual(jobs.run_pending(), 0)
+
+            self.assertEqual(fake.commands, [
+                'get5_addplayer 76561198053858673 team1',
+                'get5_addplayer 76561198053858673 team1',
+            ])
+            self.assertEqual(fake.connections, 1)
+        finally:
+            rcon.pool.close_all()
+            fake.stop()
+
+    def test_admin_jobs(self):
+        fake = simulator.FakeRconServer(
+            password='password',
+            responses={'get5_listbackups 1': 'b.cfg\na.cfg',
+                       'sm_pause': 'Match paused'})
+        try:
+            server = GameServer.query.get(1)
+            server.port = fake.port
+            db.session.commit()
+
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+
+                # Actions are only queued by the request
+                response = c.get('/match/1/pause?json=1')
+                self.assertEqual(response.status_code, 200)
+                job = json.loads(response.data)
+                self.assertEqual(job['action'], 'pause')
+                self.assertEqual(job['status'], 'queued')
+                self.assertEqual(fake.commands, [])
+
+                response = c.get('/match/1')
+                self.assertIn('data-job="{}"'.format(job['id']), response.data)
+
+                self.assertEqual(jobs.run_pending(), 1)
+                self.assertEqual(fake.commands, ['sm_pause'])
+                response = c.get('/match/1/jobs/{}'.format(job['id']))
+                self.assertEqual(json.loads(response.data), {
+                    'id': job['id'],
+                    'match_id': 1,
+                    'action': 'pause',
+                    'status': 'done',
+                    'responses': ['Match paused'],
+                })
+
+                response = c.get('/match/1/backup')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Loading backup files', response.data)
+                jobs.run_pending()
+                job = RconJob.query.filter_by(action='listbackups').one()
+                self.assertEqual(job.get_responses(), ['b.cfg\na.cfg'])
+
+                response = c.get('/match/1/rcon?command=status')
+                self.assertEqual(response.status_code, 302)
+
+            # Other users can't see the results
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 2
+                response = c.get('/match/1/jobs/{}'.format(job.id))
+                self.assertEqual(response.status_code, 400)
+
+            # A job fails once its server can't be reached
+            fake.stop()
+            rcon.pool.close_all()
+            self.assertEqual(jobs.run_pending(), 1)
+            job = RconJob.query.filter_by(action='rcon').one()
+            self.assertEqual(job.status, RconJob.FAILED)
+            self.assertIn('Connection refused', job.result)
+
+            # Jobs left running by a dead worker are run again, and failed
+            # once they were started too often
+            def leave_running(job):
+                job.status = RconJob.RUNNING
+                job.started_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+                db.session.commit()
+
+            self.assertEqual(job.attempts, 1)
+            leave_running(job)
+            self.assertEqual(jobs.run_pending(), 1)
+            job = RconJob.query.get(job.id)
+            self.assertEqual(job.attempts, 2)
+            self.assertIn('Connection refused', job.result)
+            leave_running(job)
+            self.assertEqual(jobs.run_pending(), 0)
+            self.assertEqual(RconJob.query.get(job.id).result, 'Timed out')
+        finally:
+            rcon.pool.close_all()
+            fake.stop()
+
+    def test_match_queue(self):
+        # Both servers are free, the one without matches is picked
+        GameServer.query.get(1).in_use = False
+        db.session.commit()
+
+        def create_match():
+            return c.post('/match/create', data={
+                'server_id': 0,
+                'team1_id': 1,
+                'team2_id': 2,
+                'match_title': 'Map {MAPNUMBER} of {MAXMAPS}',
+                'series_type': 'bo1',
+                'veto_mappool': ['de_dust2'],
+            })
+
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+            self.assertEqual(create_match().status_code, 302)
+            self.assertEqual(Match.query.get(2).server_id, 2)
+            self.assertEqual(create_match().status_code, 302)
+            self.assertEqual(Match.query.get(3).server_id, 1)
+
+            # Then matches wait for one
+            self.assertEqual(create_match().status_code, 302)
+            self.assertEqual(create_match().status_code, 302)
+            match = Match.query.get(4)
+            self.assertTrue(match.queued)
+            self.assertIsNone(match.server_id)
+            self.assertEqual(match.get_status_string(), 'Queued')
+            with c.session_transaction() as sess:
+                self.assertIn('All servers are busy', str(sess['_flashes']))
+
+            # A queued match can be cancelled like any other
+            self.assertEqual(c.get('/match/5/cancel').status_code, 302)
+            self.assertFalse(Match.query.get(5).queued)
+            self.assertEqual(RconJob.query.count(), 0)
+
+        # Finishing a match hands its server to the oldest queued one
+        match = Match.query.get(2)
+        response = self.app.post('/match/2/finish',
+                                 data={'key': match.api_key, 'winner': 'team1'})
+        self.assertEqual(response.status_code, 200)
+        match = Match.query.get(4)
+        self.assertFalse(match.queued)
+        self.assertEqual(match.server_id, 2)
+        self.assertTrue(GameServer.query.get(2).in_use)
+        job = RconJob.query.one()
+        self.assertEqual(job.match_id, 4)
+        self.assertEqual(job.action, 'load')
+        self.assertEqual(job.get_commands(), [
+            'get5_endmatch',
+            'get5_loadmatch_url localhost/match/4/config',
+            'get5_web_api_key ' + match.api_key,
+        ])
+
+        # With nothing left in the queue the server is just freed
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            self.assertEqual(c.get('/match/3/cancel').status_code, 302)
+        self.assertFalse(GameServer.query.get(1).in_use)
+        self.assertEqual(RconJob.query.filter_by(action='cancel').count(), 1)
+
+    def test_server_lease(self):
+        def create_match():
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+                return c.post('/match/create', data={
+                    'server_id': 0,
+                    'team1_id': 1,
+                    'team2_id': 2,
+                    'match_title': 'Map {MAPNUMBER} of {MAXMAPS}',
+                    'series_type': 'bo1',
+                    'veto_mappool': ['de_dust2'],
+                })
+
+        def expire_lease():
+            server = GameServer.query.get(2)
+            server.lease_expires = datetime.datetime.utcnow() - \
+                datetime.timedelta(minutes=1)
+            db.session.commit()
+            get5.cache.clear()
+
+        def map_start(matchid):
+            response = self.app.post('/match/{}/map/0/start'.format(matchid),
+                                     data={'key': Match.query.get(matchid).api_key,
+                                           'mapname': 'de_dust2'})
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(create_match().status_code, 302)
+        server = GameServer.query.get(2)
+        self.assertTrue(server.leased_by(Match.query.get(2)))
+        self.assertGreater(server.lease_expires, datetime.datetime.utcnow())
+
+        # Plugin api traffic renews the lease
+        expire_lease()
+        map_start(2)
+        self.assertGreater(GameServer.query.get(2).lease_expires,
+                           datetime.datetime.utcnow())
+
+        # Player stats renew it as well
+        expire_lease()
+        response = self.app.post(
+            '/match/2/map/0/player/76561198064755913/update',
+            data={'key': Match.query.get(2).api_key, 'kills': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(GameServer.query.get(2).lease_expires,
+                           datetime.datetime.utcnow())
+
+        # A server still in warmup keeps its match, even without api calls
+        self.assertEqual(create_match().status_code, 302)
+        self.assertTrue(Match.query.get(3).queued)
+        expire_lease()
+        server = GameServer.query.get(2)
+        server.status = ServerStatus(server_id=2)
+        server.status.set_reply('{"gamestate": 1}', '', datetime.datetime.utcnow())
+        db.session.commit()
+        with get5.app.test_request_context():
+            self.assertEqual(allocation.reap_leases(), [])
+        self.assertGreater(GameServer.query.get(2).lease_expires,
+                           datetime.datetime.utcnow())
+        self.assertTrue(Match.query.get(3).queued)
+
+        # So does one whose status the poller didn't update lately, requests
+        # never contact the server themselves
+        expire_lease()
+        GameServer.query.get(2).status.set_reply(
+            '{"gamestate": 0}', '',
+            datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        db.session.commit()
+        with get5.app.test_request_context():
+            self.assertEqual(allocation.reap_leases(), [])
+        self.assertTrue(Match.query.get(3).queued)
+
+        # The plugin goes quiet and ends the match, the server is reclaimed
+        # for the next one
+        expire_lease()
+        GameServer.query.get(2).status.set_reply(
+            '{"gamestate": 0}', '', datetime.datetime.utcnow())
+        db.session.commit()
+        with get5.app.test_request_context():
+            self.assertEqual(allocation.reap_leases(), [GameServer.query.get(2)])
+        server = GameServer.query.get(2)
+        self.assertEqual(server.lease_match_id, 3)
+        self.assertEqual(Match.query.get(3).server_id, 2)
+        self.assertEqual(RconJob.query.one().action, 'load')
+
+        # Its owner can't reach the server through the admin tools either
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            for tool in ['rcon?command=status', 'pause', 'unpause',
+                         'adduser?team=team1&auth=76561198064755913',
+                         'backup', 'backup?file=backup.cfg']:
+                response = c.get('/match/2/' + tool)
+                self.assertEqual(response.status_code, 302)
+                with c.session_transaction() as sess:
+                    self.assertIn('no longer holds server',
+                                  str(sess.pop('_flashes')))
+        self.assertEqual(RconJob.query.count(), 1)
+
+        # The old match can neither renew nor release it anymore
+        expire_lease()
+        map_start(2)
+        self.assertLess(GameServer.query.get(2).lease_expires,
+                        datetime.datetime.utcnow())
+        response = self.app.post('/match/2/finish',
+                                 data={'key': Match.query.get(2).api_key,
+                                       'winner': 'team1'})
+        self.assertEqual(response.status_code, 200)
+        server = GameServer.query.get(2)
+        self.assertTrue(server.in_use)
+        self.assertEqual(server.lease_match_id, 3)
+
+    def test_match_create_bulk(self):
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+
+            self.assertEqual(c.get('/match/create/bulk').status_code, 200)
+
+            # Nothing is created if any match is invalid
+            response = c.post('/match/create/bulk', data={
+                'format': 'csv',
+                'schedule': 'team1,team2\nEnvyUs,Fnatic\nEnvyUs,Nobody\n',
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Match 2: Unknown team Nobody', response.data)
+            self.assertEqual(Match.query.count(), 1)
+
+            # Teams by name or id, one insert for all matches
+            with self.count_queries() as statements:
+                response = c.post('/match/create/bulk', data={
+                    'format': 'csv',
+                    'schedule': 'fnatic,1,bo3,de_dust2 de_cache de_mirage,Final\n'
+                                '1,2\n\n2,1,bo1-preset,de_cache\n',
+                })
+            self.assertEqual(response.status_code, 302)
+            inserts = [s for s in statements
+                       if s.startswith('INSERT INTO "match"')]
+            self.assertEqual(len(inserts), 1)
+
+        matches = Match.query.filter(Match.id > 1).order_by(Match.id).all()
+        self.assertEqual([(m.team1_id, m.team2_id, m.max_maps, m.skip_veto)
+                          for m in matches],
+                         [(2, 1, 3, False), (1, 2, 1, False), (2, 1, 1, True)])
+        self.assertEqual(matches[0].title, 'Final')
+        self.assertEqual(matches[2].veto_mappool, 'de_cache')
+
+        # The free server took the first match, the others wait for one
+        self.assertEqual(matches[0].server_id, 2)
+        self.assertFalse(matches[0].queued)
+        self.assertTrue(matches[1].queued and matches[2].queued)
+        self.assertEqual(RconJob.query.one().match_id, matches[0].id)
+        config = json.loads(self.app.get('/match/4/config').data)
+        self.assertEqual(config['maplist'], ['de_cache'])
+
+        # Json in, json out
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            response = c.post('/match/create/bulk', data=json.dumps({
+                'series_type': 'bo3',
+                'veto_mappool': ['de_dust2', 'de_cache', 'de_mirage'],
+                'matches': [{'team1': 1, 'team2': 2},
+                            {'team1': 2, 'team2': 1, 'series_type': 'bo2'}],
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), {'matches': [
+                {'id': 5, 'server_id': None, 'queued': True},
+                {'id': 6, 'server_id': None, 'queued': True},
+            ]})
+
+            response = c.post('/match/create/bulk', data=json.dumps({
+                'matches': [{'team1': 1, 'team2': 2, 'series_type': 'bo3',
+                             'veto_mappool': ['de_dust2']}],
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+            # Values of the wrong type are rejected, not a server error
+            for entry in [{'match_title': 5}, {'team2_string': ['x']},
+                          {'veto_mappool': ['de_dust2', 3]},
+                          {'veto_mappool': {'de_dust2': 1}}]:
+                entry.update({'team1': 1, 'team2': 2})
+                response = c.post('/match/create/bulk', data=json.dumps([entry]),
+                                  content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+            self.assertEqual(Match.query.count(), 6)
+        self.assertEqual(Match.query.get(6).max_maps, 2)
 
     def test_match_cancel(self):
         # Make sure someone else can't cancel my match when logged in
@@ -1,14 +1,19 @@
 from get5 import app, db, cache
 import countries
 import logos
+import steamid
 import util
 
 from flask import url_for, Markup
-import requests
+from sqlalchemy.exc import IntegrityError
 
+import calendar
 import datetime
+import json
 import string
 import random
+import threading
+import time
 
 
 class User(db.Model):
@@ -56,6 +61,11 @@ class GameServer(db.Model):
     rcon_password = db.Column(db.String(32))
     in_use = db.Column(db.Boolean, default=False)
     public_server = db.Column(db.Boolean, default=False, index=True)
+    status = db.relationship('ServerStatus', uselist=False)
+    # A server is reserved for a match until its lease expires, plugin api
+    # traffic keeps renewing it (see get5.allocation).
+    lease_match_id = db.Column(db.Integer)
+    lease_expires = db.Column(db.DateTime)
 
     @staticmethod
     def create(user, display_name, ip_string, port, rcon_password, public_server):
@@ -74,6 +84,56 @@ class GameServer(db.Model):
             self.ip_string, self.port, self.rcon_password,
                                       command, raise_errors, num_retries, timeout)
 
+    def send_rcon_commands(self, commands, raise_errors=False, num_retries=3, timeout=3.0):
+        return util.send_rcon_commands(
+            self.ip_string, self.port, self.rcon_password,
+            commands, raise_errors, num_retries, timeout)
+
+    @staticmethod
+    def send_rcon_command_many(servers, command, num_retries=1, timeout=3.0,
+                               deadline=None):
+        # Returns a dict of server id -> (response, error)
+        from get5 import config_setting
+        targets = [(s.id, s.ip_string, s.port, s.rcon_password) for s in servers]
+        return util.send_rcon_command_many(
+            targets, command,
+            deadline=deadline or config_setting('RCON_FANOUT_DEADLINE'),
+            max_workers=config_setting('RCON_FANOUT_WORKERS'),
+            num_retries=num_retries, timeout=timeout)
+
+    def check_availability(self):
+        # Uses the status stored by the server poller when it is recent
+        # enough, otherwise asks the server right away.
+        from get5 import config_setting
+        max_age = datetime.timedelta(
+            seconds=config_setting('SERVER_STATUS_MAX_AGE'))
+        if not self.status or not self.status.checked_since(
+                datetime.datetime.utcnow() - max_age):
+            ServerStatus.refresh([self])
+            db.session.commit()
+        return self.status.get_reply()
+
+    @staticmethod
+    def lease_expiry():
+        from get5 import config_setting
+        timeout = config_setting('SERVER_LEASE_TIMEOUT')
+        if not timeout:
+            return None
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=timeout)
+
+    def lease_to(self, match):
+        self.in_use = True
+        self.lease_match_id = match.id
+        self.lease_expires = GameServer.lease_expiry()
+
+    def leased_by(self, match):
+        # Servers reserved before leases existed have no lease_match_id
+        return self.in_use and self.lease_match_id in (None, match.id)
+
+    def get_rcon_state(self):
+        import rcon
+        return rcon.breaker.describe(self.ip_string, self.port)
+
     def get_hostport(self):
         return '{}:{}'.format(self.ip_string, self.port)
 
@@ -87,6 +147,65 @@ class GameServer(db.Model):
         return 'GameServer({})'.format(self.get_hostport())
 
 
+class ServerStatus(db.Model):
+    server_id = db.Column(
+        db.Integer, db.ForeignKey('game_server.id'), primary_key=True)
+    available = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(64), default='')
+    gamestate = db.Column(db.Integer)
+    plugin_version = db.Column(db.String(32))
+    last_checked = db.Column(db.DateTime)
+    last_seen = db.Column(db.DateTime)
+
+    @staticmethod
+    def refresh(servers, deadline=None):
+        servers = list(servers)
+        if not servers:
+            return
+
+        replies = GameServer.send_rcon_command_many(
+            servers, 'get5_web_available', deadline=deadline)
+        now = datetime.datetime.utcnow()
+        for server in servers:
+            if not server.status:
+                server.status = ServerStatus(server_id=server.id)
+            response, error = replies[server.id]
+            server.status.set_reply(response, error, now)
+
+    def set_reply(self, response, error, now):
+        self.last_checked = now
+        if error:
+            json_reply, message = None, error
+        else:
+            self.last_seen = now
+            json_reply, message = util.parse_server_avaliability(response)
+            try:
+                data = json.loads(response)
+                self.gamestate = data.get('gamestate')
+                self.plugin_version = data.get('plugin_version')
+            except (ValueError, AttributeError):
+                pass
+
+        self.available = json_reply is not None
+        self.status = (message or 'Available')[:64]
+
+    def get_reply(self):
+        # Same return values as util.check_server_avaliability
+        if not self.available:
+            return None, self.status
+        json_reply = {'gamestate': self.gamestate}
+        if self.plugin_version:
+            json_reply['plugin_version'] = self.plugin_version
+        return json_reply, ''
+
+    def checked_since(self, when):
+        return self.last_checked is not None and self.last_checked >= when
+
+    def __repr__(self):
+        return 'ServerStatus(server_id={}, status={})'.format(
+            self.server_id, self.status)
+
+
 class Team(db.Model):
     MAXPLAYERS = 7
 
@@ -123,10 +242,11 @@ class Team(db.Model):
         return False
 
     def get_players(self):
+        names = get_steam_names(self.auths)
         results = []
         for steam64 in self.auths:
             if steam64:
-                name = get_steam_name(steam64)
+                name = names.get(str(steam64))
                 if not name:
                     name = ''
 
@@ -215,6 +335,19 @@ class Team(db.Model):
     def get_name_url_html(self):
         return Markup('<a href="{}">{}</a>'.format(self.get_url(), self.name))
 
+    def invalidate_match_pages(self):
+        # Cached pages of finished matches show the team name, flag and logo
+        matches = Match.query.filter(
+            (Match.team1_id == self.id) | (Match.team2_id == self.id))
+        for matchid, in matches.with_entities(Match.id):
+            Match.invalidate_page_cache(matchid)
+
+    def clear_match_configs(self):
+        # Match configs embed the team data, they are rebuilt on next fetch
+        Match.query.filter(
+            (Match.team1_id == self.id) | (Match.team2_id == self.id)).update(
+            {Match.config_json: None}, synchronize_session=False)
+
     def get_logo_or_flag_html(self, scale=1.0, other_team=None):
         if logos.has_logo(self.logo) and (other_team is None or logos.has_logo(other_team.logo)):
             return self.get_logo_html(scale)
@@ -245,7 +378,13 @@ class Match(db.Model):
     max_maps = db.Column(db.Integer)
     title = db.Column(db.String(60), default='')
     skip_veto = db.Column(db.Boolean)
-    api_key = db.Column(db.String(32))
+    # Indexed so get5.bulk can find matches it inserted without ids
+    api_key = db.Column(db.String(32), index=True)
+    config_json = db.Column(db.Text)
+    # Waiting for a free server, see get5.allocation
+    queued = db.Column(db.Boolean, default=False, index=True)
+    # Queued matches with a scheduled start wait for it, see get5.scheduler
+    scheduled_start = db.Column(db.DateTime, index=True)
 
     veto_mappool = db.Column(db.String(500))
     map_stats = db.relationship('MapStats', backref='match', lazy='dynamic')
@@ -265,13 +404,34 @@ class Match(db.Model):
         rv.veto_mappool = ' '.join(veto_mappool)
         rv.server_id = server_id
         rv.max_maps = max_maps
-        rv.api_key = ''.join(random.SystemRandom().choice(
-            string.ascii_uppercase + string.digits) for _ in range(24))
+        rv.api_key = Match.generate_api_key()
         db.session.add(rv)
         return rv
 
+    @staticmethod
+    def generate_api_key():
+        return ''.join(random.SystemRandom().choice(
+            string.ascii_uppercase + string.digits) for _ in range(24))
+
+    @staticmethod
+    def page_cache_key(matchid, logged_in):
+        # Pages are only cached once a match is finalized, when the admin
+        # tools are no longer shown, so they only differ by the navbar.
+        return 'match_page_{}_{}'.format(matchid, 'user' if logged_in else 'anon')
+
+    @staticmethod
+    def invalidate_page_cache(matchid):
+        cache.delete_many(Match.page_cache_key(matchid, True),
+                          Match.page_cache_key(matchid, False))
+
     def get_status_string(self, show_winner=True):
-        if self.pending():
+        if self.queued and not self.cancelled:
+            if self.scheduled_start and \
+                    self.scheduled_start > datetime.datetime.utcnow():
+                return 'Scheduled for {:%Y-%m-%d %H:%M} UTC'.format(
+                    self.scheduled_start)
+            return 'Queued'
+        elif self.pending():
             return 'Pending'
         elif self.live():
             team1_score, team2_score = self.get_current_score()
@@ -330,15 +490,12 @@ class Match(db.Model):
         else:
             return (self.team1_score, self.team2_score)
 
-    def send_to_server(self):
-        server = GameServer.query.get(self.server_id)
-        if not server:
-            return False
-
-        get5UrlOverride = app.config['GET5_URL_OVERRIDE'];
+    def get_load_commands(self):
+        get5UrlOverride = app.config.get('GET5_URL_OVERRIDE')
 
+        url = None
         if get5UrlOverride:
-            url = get5UrlOverride + '/match/' + str(self.id) + '/config';
+            url = get5UrlOverride + '/match/' + str(self.id) + '/config'
 
         # If no URL Override is set in the config, use the serverName the server was called with
         if not url:
@@ -349,11 +506,18 @@ class Match(db.Model):
         url = url.replace("http://", "")
         url = url.replace("https://", "")
 
-        loadmatch_response = server.send_rcon_command(
-            'get5_loadmatch_url ' + url)
+        return [
+            'get5_loadmatch_url ' + url,
+            'get5_web_api_key ' + self.api_key,
+        ]
+
+    def send_to_server(self):
+        server = GameServer.query.get(self.server_id)
+        if not server:
+            return False
 
-        server.send_rcon_command(
-            'get5_web_api_key ' + self.api_key)
+        responses = server.send_rcon_commands(self.get_load_commands())
+        loadmatch_response = responses[0] if responses else None
 
         if loadmatch_response:  # There should be no response
             return False
@@ -437,6 +601,18 @@ class Match(db.Model):
 
         return d
 
+    def update_config(self):
+        self.config_json = json.dumps(self.build_match_dict())
+
+    def get_config(self):
+        # The stored config is rebuilt if an edit cleared it, or if it was
+        # built for a different host than the one it is now fetched from.
+        api_url = json.dumps(url_for('home', _external=True, _scheme='http'))
+        if not self.config_json or api_url not in self.config_json:
+            self.update_config()
+            db.session.commit()
+        return self.config_json
+
     def __repr__(self):
         return 'Match(id={})'.format(self.id)
 
@@ -455,7 +631,7 @@ class MapStats(db.Model):
         'PlayerStats', backref='mapstats', lazy='dynamic')
 
     @staticmethod
-    def get_or_create(match_id, map_number, map_name=''):
+    def get_or_create(match_id, map_number, map_name='', start_time=None):
         match = Match.query.get(match_id)
         if match is None or map_number >= match.max_maps:
             return None
@@ -467,7 +643,7 @@ class MapStats(db.Model):
             rv.match_id = match_id
             rv.map_number = map_number
             rv.map_name = map_name
-            rv.start_time = datetime.datetime.utcnow()
+            rv.start_time = start_time or datetime.datetime.utcnow()
             rv.team1_score = 0
             rv.team2_score = 0
             db.session.add(rv)
@@ -478,6 +654,19 @@ class MapStats(db.Model):
 
 
 class PlayerStats(db.Model):
+    MAXPLAYERS_PER_MAP = 40
+    # The counted stats the derived ones are computed from
+    STAT_COLUMNS = [
+        'kills', 'deaths', 'roundsplayed', 'assists', 'flashbang_assists',
+        'teamkills', 'suicides', 'headshot_kills', 'damage', 'bomb_plants',
+        'bomb_defuses', 'v1', 'v2', 'v3', 'v4', 'v5', 'k1', 'k2', 'k3', 'k4',
+        'k5',
+    ]
+    __table_args__ = (
+        db.Index('ix_player_stats_map_id_steam_id',
+                 'map_id', 'steam_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     match_id = db.Column(db.Integer, db.ForeignKey('match.id'))
     map_id = db.Column(db.Integer, db.ForeignKey('map_stats.id'))
@@ -513,74 +702,510 @@ class PlayerStats(db.Model):
     def get_steam_url(self):
         return 'http://steamcommunity.com/profiles/{}'.format(self.steam_id)
 
-    def get_rating(self):
+    def stat_values(self):
+        return dict((column, getattr(self, column))
+                    for column in PlayerStats.STAT_COLUMNS)
+
+    @staticmethod
+    def derived_stats(stats):
+        """Returns the rating, kdr, hsp, adr and fpr of stats.
+
+        stats is a dict of STAT_COLUMNS values, so plugin updates that are
+        not stored in a row can be shown too. Per round values are 0 before
+        the first round.
+        """
         AverageKPR = 0.679
         AverageSPR = 0.317
         AverageRMK = 1.277
-        KillRating = float(self.kills) / float(self.roundsplayed) / AverageKPR
-        SurvivalRating = float(self.roundsplayed -
-                               self.deaths) / self.roundsplayed / AverageSPR
-        killcount = float(self.k1 + 4 * self.k2 + 9 *
-                          self.k3 + 16 * self.k4 + 25 * self.k5)
-        RoundsWithMultipleKillsRating = killcount / \
-            self.roundsplayed / AverageRMK
-        rating = (KillRating + 0.7 * SurvivalRating +
-                  RoundsWithMultipleKillsRating) / 2.7
-        return rating
+        kills = stats['kills']
+        deaths = stats['deaths']
+        roundsplayed = stats['roundsplayed']
+
+        rv = {
+            'rating': 0.0,
+            'kdr': float(kills) / deaths if deaths else float(kills),
+            'hsp': float(stats['headshot_kills']) / kills if kills else 0.0,
+            'adr': 0.0,
+            'fpr': 0.0,
+        }
+        if roundsplayed > 0:
+            KillRating = float(kills) / float(roundsplayed) / AverageKPR
+            SurvivalRating = float(roundsplayed -
+                                   deaths) / roundsplayed / AverageSPR
+            killcount = float(stats['k1'] + 4 * stats['k2'] + 9 * stats['k3'] +
+                              16 * stats['k4'] + 25 * stats['k5'])
+            RoundsWithMultipleKillsRating = killcount / \
+                roundsplayed / AverageRMK
+            rv['rating'] = (KillRating + 0.7 * SurvivalRating +
+                            RoundsWithMultipleKillsRating) / 2.7
+            rv['adr'] = float(stats['damage']) / roundsplayed
+            rv['fpr'] = float(kills) / roundsplayed
+        return rv
+
+    def get_rating(self):
+        return PlayerStats.derived_stats(self.stat_values())['rating']
 
     def get_kdr(self):
-        if self.deaths == 0:
-            return float(self.kills)
-        else:
-            return float(self.kills) / self.deaths
+        return PlayerStats.derived_stats(self.stat_values())['kdr']
 
     def get_hsp(self):
-        if self.kills == 0:
-            return 0.0
-        else:
-            return float(self.headshot_kills) / self.kills
+        return PlayerStats.derived_stats(self.stat_values())['hsp']
 
     def get_adr(self):
-        if self.roundsplayed == 0:
-            return 0.0
-        else:
-            return float(self.damage) / self.roundsplayed
+        return PlayerStats.derived_stats(self.stat_values())['adr']
 
     def get_fpr(self):
-        if self.roundsplayed == 0:
-            return 0.0
-        else:
-            return float(self.kills) / self.roundsplayed
+        return PlayerStats.derived_stats(self.stat_values())['fpr']
 
     @staticmethod
-    def get_or_create(matchid, mapnumber, steam_id):
-        mapstats = MapStats.get_or_create(matchid, mapnumber)
-        if len(mapstats.player_stats.all()) >= 40:  # Cap on players per map
-            return None
-
-        rv = mapstats.player_stats.filter_by(steam_id=steam_id).first()
+    def get_or_create(mapstats, steam_id):
+        rv = PlayerStats.query.filter_by(
+            map_id=mapstats.id, steam_id=steam_id).first()
 
         if rv is None:
-            rv = PlayerStats()
-            rv.match_id = matchid
-            rv.map_number = mapstats.id
-            rv.steam_id = steam_id
-            rv.map_id = mapstats.id
-            db.session.add(rv)
+            # Cap on players per map, only checked when adding a new player
+            num_players = mapstats.player_stats.count()
+            if num_players >= PlayerStats.MAXPLAYERS_PER_MAP:
+                return None
+
+            PlayerStats.insert_missing(mapstats, [steam_id])
+            rv = PlayerStats.query.filter_by(
+                map_id=mapstats.id, steam_id=steam_id).first()
 
         return rv
 
+    @staticmethod
+    def insert_missing(mapstats, steam_ids):
+        # Another request for the same map may have added some of the
+        # players since they were looked up. Rows the unique (map_id,
+        # steam_id) index already has are skipped instead of failing the
+        # whole transaction with an IntegrityError.
+        insert = (PlayerStats.__table__.insert()
+                  .prefix_with('OR IGNORE', dialect='sqlite')
+                  .prefix_with('IGNORE', dialect='mysql'))
+        db.session.execute(insert, [
+            {'match_id': mapstats.match_id, 'map_id': mapstats.id,
+             'steam_id': steam_id} for steam_id in steam_ids])
+
+    @staticmethod
+    def get_or_create_many(mapstats, steam_ids):
+        # Loads every row for the map once and creates any missing ones,
+        # returning a dict of steam_id -> PlayerStats. Players past the
+        # per-map cap are left out of the result.
+        existing = {}
+        for player_stats in mapstats.player_stats:
+            existing[player_stats.steam_id] = player_stats
+
+        missing = []
+        num_players = len(existing)
+        for steam_id in steam_ids:
+            steam_id = str(steam_id)
+            if steam_id not in existing and steam_id not in missing:
+                if num_players >= PlayerStats.MAXPLAYERS_PER_MAP:
+                    continue
+                missing.append(steam_id)
+                num_players += 1
+
+        if missing:
+            PlayerStats.insert_missing(mapstats, missing)
+            for player_stats in mapstats.player_stats.filter(
+                    PlayerStats.steam_id.in_(missing)):
+                existing[player_stats.steam_id] = player_stats
+
+        rv = {}
+        for steam_id in steam_ids:
+            steam_id = str(steam_id)
+            if steam_id in existing:
+                rv[steam_id] = existing[steam_id]
+        return rv
+
+
+class MatchEvent(db.Model):
+    # Append-only journal of the plugin api events accepted for a match,
+    # see api.replay_match_events.
+    SERIES_FINISH = 'series_finish'
+    MAP_START = 'map_start'
+    MAP_UPDATE = 'map_update'
+    MAP_FINISH = 'map_finish'
+    PLAYER_UPDATE = 'player_update'
+    PLAYERS_UPDATE = 'players_update'
+
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), index=True)
+    map_number = db.Column(db.Integer)
+    event_type = db.Column(db.String(32))
+    event_time = db.Column(db.DateTime)
+    data = db.Column(db.Text)
+
+    @staticmethod
+    def create(match_id, event_type, event_time, map_number=None, data=None):
+        rv = MatchEvent()
+        rv.match_id = match_id
+        rv.map_number = map_number
+        rv.event_type = event_type
+        rv.event_time = event_time
+        rv.data = json.dumps(data or {}, separators=(',', ':'))
+        db.session.add(rv)
+        return rv
+
+    def get_data(self):
+        if not self.data:
+            return {}
+        return json.loads(self.data)
+
+    def __repr__(self):
+        return 'MatchEvent(id={}, match_id={}, map_number={}, type={})'.format(
+            self.id, self.match_id, self.map_number, self.event_type)
+
+
+class RconJob(db.Model):
+    # Admin rcon actions are queued here and run by get5.jobs workers, so
+    # slow game servers never hold up a web request.
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), index=True)
+    server_id = db.Column(db.Integer, db.ForeignKey('game_server.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    action = db.Column(db.String(32))
+    commands = db.Column(db.Text)
+    status = db.Column(db.String(16), default=QUEUED, index=True)
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Times a worker started the job, see jobs.expire_stale
+    attempts = db.Column(db.Integer, default=0)
+
+    @staticmethod
+    def create(match, server, action, commands, user=None):
+        rv = RconJob()
+        rv.match_id = match.id
+        rv.server_id = server.id
+        rv.user_id = user.id if user else None
+        rv.action = action
+        rv.commands = json.dumps(commands)
+        rv.status = RconJob.QUEUED
+        rv.attempts = 0
+        rv.created_at = datetime.datetime.utcnow()
+        db.session.add(rv)
+        return rv
+
+    def get_commands(self):
+        return json.loads(self.commands)
+
+    def get_responses(self):
+        if self.status != RconJob.DONE or not self.result:
+            return []
+        return json.loads(self.result)
+
+    def finish(self, responses):
+        self.status = RconJob.DONE
+        self.result = json.dumps(responses)
+        self.finished_at = datetime.datetime.utcnow()
+
+    def fail(self, error):
+        self.status = RconJob.FAILED
+        self.result = error
+        self.finished_at = datetime.datetime.utcnow()
+
+    def finished(self):
+        return self.status in (RconJob.DONE, RconJob.FAILED)
+
+    def to_dict(self):
+        d = {
+            'id': self.id,
+            'match_id': self.match_id,
+            'action': self.action,
+            'status': self.status,
+        }
+        if self.status == RconJob.DONE:
+            d['responses'] = self.get_responses()
+        elif self.status == RconJob.FAILED:
+            d['error'] = self.result
+        return d
+
+    def __repr__(self):
+        return 'RconJob(id={}, match_id={}, action={}, status={})'.format(
+            self.id, self.match_id, self.action, self.status)
+
+
+class Player(db.Model):
+    """The Steam profile of a player, keyed by steam64.
+
+    Pages read names from the caches in front of it, see get_steam_names,
+    rather than asking the Steam api. A row is created in the background the
+    first time a steamid is shown, and "manager.py refresh_players"
+    refetches rows older than STEAM_NAME_TTL in bulk.
+    Unknown profiles have no name and are retried after
+    STEAM_NAME_NEGATIVE_TTL, rows that could not be fetched yet have no
+    last_refreshed.
+    """
+    steam_id = db.Column(db.String(40), primary_key=True)
+    name = db.Column(db.String(64))
+    avatar = db.Column(db.String(256))
+    last_refreshed = db.Column(db.DateTime, index=True)
+
+    @staticmethod
+    def get_many(steam64s, session=None):
+        # Returns a dict of steam64 -> Player for the rows that exist
+        session = session or db.session
+        steam64s = sorted(set(str(s) for s in steam64s if s))
+        rv = {}
+        for i in range(0, len(steam64s), 500):
+            for player in session.query(Player).filter(
+                    Player.steam_id.in_(steam64s[i:i + 500])):
+                rv[player.steam_id] = player
+        return rv
+
+    @staticmethod
+    def refresh(steam64s, players=None, session=None):
+        """Fetches the profiles of steam64s, 100 per api call, and stores them.
+
+        players are the already loaded rows of steam64s, if any. Returns a
+        dict of steam64 -> Player, the caller commits session (by default
+        db.session).
+        """
+        from get5 import config_setting
+        session = session or db.session
+        steam64s = [str(s) for s in steam64s if s]
+        if players is None:
+            players = Player.get_many(steam64s, session)
+        summaries = steamid.get_player_summaries(
+            steam64s, app.config['STEAM_API_KEY'],
+            config_setting('STEAM_API_URL'))
+
+        now = datetime.datetime.utcnow()
+        for steam64 in steam64s:
+            player = players.get(steam64)
+            if player is None:
+                player = Player(steam_id=steam64)
+                session.add(player)
+                players[steam64] = player
+
+            if steam64 in summaries and summaries[steam64] is None:
+                # The api call failed, which says nothing about the profile
+                continue
+            summary = summaries.get(steam64, {})
+            player.name = summary.get('personaname', '')[:64] or None
+            player.avatar = summary.get('avatarmedium', '')[:256] or None
+            player.last_refreshed = now
+        return players
+
+    @staticmethod
+    def add_missing():
+        # Creates rows for every player with match stats but no row yet,
+        # they are fetched by the next refresh. Returns how many were added.
+        steam64s = [row[0] for row in db.session.query(
+            PlayerStats.steam_id).outerjoin(
+                Player, Player.steam_id == PlayerStats.steam_id).filter(
+                    Player.steam_id == None,
+                    PlayerStats.steam_id != None).distinct()]
+        if steam64s:
+            db.session.bulk_insert_mappings(
+                Player, [{'steam_id': s} for s in steam64s])
+        return len(steam64s)
+
+    @staticmethod
+    def refreshed_before():
+        # Rows with a name last refreshed before the first time, and unknown
+        # ones refreshed before the second, are due for a refresh
+        from get5 import config_setting
+        now = datetime.datetime.utcnow()
+        return (now - datetime.timedelta(seconds=config_setting('STEAM_NAME_TTL')),
+                now - datetime.timedelta(
+                    seconds=config_setting('STEAM_NAME_NEGATIVE_TTL')))
+
+    @staticmethod
+    def stale(limit=None):
+        # The rows due for a refresh, those never fetched first
+        found_before, not_found_before = Player.refreshed_before()
+        query = Player.query.filter(db.or_(
+            Player.last_refreshed == None,
+            Player.last_refreshed < found_before,
+            db.and_(Player.name == None,
+                    Player.last_refreshed < not_found_before))).order_by(
+                        Player.last_refreshed)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def is_stale(self):
+        # The same test as stale() for a loaded row
+        if self.last_refreshed is None:
+            return True
+        found_before, not_found_before = Player.refreshed_before()
+        if self.name is None:
+            return self.last_refreshed < not_found_before
+        return self.last_refreshed < found_before
+
+    def __repr__(self):
+        return 'Player(steam_id={}, name={}, last_refreshed={})'.format(
+            self.steam_id, self.name, self.last_refreshed)
+
+
+# Steam names are cached in two tiers in front of the Player table: a small
+# per-process LRU and the shared cache. Entries are (name, fetched_at) pairs.
+# Names older than STEAM_NAME_TTL, and unknown ones older than
+# STEAM_NAME_NEGATIVE_TTL, are still served while a background thread
+# refreshes them; only after STEAM_NAME_MAX_AGE are they no longer shown.
+# Steamids found in no tier are looked up in the background as well, pages
+# show them without a name until then.
+_steam_names = util.TTLCache(maxsize=5000, timeout=5 * 60)
+_steam_names_refreshing = set()
+_steam_names_lock = threading.Lock()
+
+
+def steam_name_cache_key(steam64):
+    return 'steam_name_{}'.format(steam64)
+
+
+def cache_steam_names(players):
+    # Stores the fetched ones of players in both tiers, returns their entries
+    from get5 import config_setting
+    negative_ttl = config_setting('STEAM_NAME_NEGATIVE_TTL')
+    entries = {}
+    found = {}
+    not_found = {}
+    for player in players:
+        if player.last_refreshed is None:
+            continue
+
+        entry = (player.name,
+                 calendar.timegm(player.last_refreshed.utctimetuple()))
+        entries[player.steam_id] = entry
+        if player.name is None:
+            _steam_names.set(player.steam_id, entry,
+                             timeout=min(negative_ttl, _steam_names.timeout))
+            not_found[steam_name_cache_key(player.steam_id)] = entry
+        else:
+            _steam_names.set(player.steam_id, entry)
+            found[steam_name_cache_key(player.steam_id)] = entry
+
+    if found:
+        cache.set_many(found, timeout=config_setting('STEAM_NAME_MAX_AGE'))
+    if not_found:
+        cache.set_many(not_found, timeout=negative_ttl)
+    return entries
+
 
-@cache.memoize(timeout=60 * 60 * 24)  # 1 day timeout
 def get_steam_name(steam64):
-    url = 'http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/?key={}&steamids={}'
-    url = url.format(app.config['STEAM_API_KEY'], steam64)
-    response = requests.get(url)
-    if response.status_code == 200:
-        try:
-            player_list = response.json()['response']['players']
-            return player_list[0]['personaname']
-        except (KeyError, IndexError):
-            return None
+    return get_steam_names([steam64]).get(str(steam64))
+
+
+def get_steam_names(steam64s, fetch=True):
+    """Returns a dict of steam64 -> persona name (None if unknown).
+
+    Names come from the process cache, then the shared cache, then the
+    Player table, in at most one call or query each. The Steam api is never
+    asked before returning: unless fetch is False, names that are stale or
+    found nowhere are refreshed in the background by refresh_steam_names.
+    """
+    from get5 import config_setting
+    steam64s = [str(s) for s in steam64s if s]
+    entries = {}
+    for steam64 in steam64s:
+        entry = _steam_names.get(steam64)
+        if entry is not None:
+            entries[steam64] = entry
+
+    not_local = [s for s in set(steam64s) if s not in entries]
+    if not_local:
+        cached = cache.get_many(*[steam_name_cache_key(s) for s in not_local])
+        for steam64, entry in zip(not_local, cached):
+            if entry is not None:
+                entries[steam64] = entry
+                _steam_names.set(steam64, entry)
+
+    not_cached = [s for s in not_local if s not in entries]
+    if not_cached:
+        # Pending changes of the caller stay unflushed
+        with db.session.no_autoflush:
+            players = Player.get_many(not_cached)
+        entries.update(cache_steam_names(players.values()))
+
+    now = time.time()
+    max_age = config_setting('STEAM_NAME_MAX_AGE')
+    soft_ttl = config_setting('STEAM_NAME_TTL')
+    negative_ttl = config_setting('STEAM_NAME_NEGATIVE_TTL')
+    names = {}
+    stale = []
+    for steam64 in set(steam64s):
+        if steam64 not in entries:
+            stale.append(steam64)
+            continue
+
+        name, fetched_at = entries[steam64]
+        if now - fetched_at < max_age:
+            names[steam64] = name
+        if now - fetched_at >= (soft_ttl if name is not None else negative_ttl):
+            stale.append(steam64)
+
+    if stale and fetch:
+        refresh_steam_names(stale)
+
+    return dict((s, names.get(s)) for s in steam64s)
+
+
+def refresh_steam_names(steam64s):
+    """Refreshes the Player rows and cached names of steam64s in a thread.
+
+    Rows refresh_players or another process brought up to date meanwhile
+    are only cached again, the others are fetched from the api. Each name
+    is refreshed by one thread at a time per process, and the shared cache
+    keeps other processes from doing the same. The rows are written in a
+    session of their own. Returns the thread, or None if there was nothing
+    left to refresh.
+    """
+    from get5 import config_setting
+    with _steam_names_lock:
+        steam64s = [s for s in steam64s if s not in _steam_names_refreshing]
+        _steam_names_refreshing.update(steam64s)
+
+    claimed = []
+    for steam64 in steam64s:
+        if cache.cache.add(steam_name_cache_key(steam64) + '_refresh', True,
+                           timeout=60):
+            claimed.append(steam64)
+        else:
+            with _steam_names_lock:
+                _steam_names_refreshing.discard(steam64)
+    if not claimed:
+        return None
 
-    return None
+    def refresh():
+        session = db.create_session({})
+        try:
+            players = Player.get_many(claimed, session)
+            stale = [s for s in claimed
+                     if s not in players or players[s].is_stale()]
+            if stale:
+                players = Player.refresh(stale, players, session)
+            cache_steam_names(players.values())
+            session.commit()
+        except IntegrityError:
+            # Another process added some of the same players first
+            session.rollback()
+        except Exception:
+            app.logger.exception('Failed to refresh steam names')
+            session.rollback()
+        finally:
+            session.close()
+            with _steam_names_lock:
+                _steam_names_refreshing.difference_update(claimed)
+
+    if config_setting('TESTING'):
+        refresh()
+        return None
+
+    def run():
+        with app.app_context():
+            refresh()
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return t
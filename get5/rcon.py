@@ -0,0 +1,233 @@
+import select
+import socket
+import threading
+import time
+
+from get5 import cache, config_setting
+from util import RconError
+
+
+class PooledConnection(object):
+
+    def __init__(self, key, rcon):
+        self.key = key
+        self.rcon = rcon
+        self.last_used = time.time()
+
+    def is_healthy(self):
+        # An idle connection should never be readable: if it is, the server
+        # either closed it or sent something nobody asked for.
+        try:
+            readable, _, _ = select.select([self.rcon._socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def reset(self):
+        self.rcon._active_requests.clear()
+        self.rcon._response = []
+
+    def close(self):
+        try:
+            self.rcon.disconnect()
+        except socket.error:
+            pass
+
+
+class RconPool(object):
+    """Authenticated rcon connections kept open per (host, port, password).
+
+    A connection is checked out by one command at a time and put back once
+    the response was read. Connections idle for longer than
+    RCON_POOL_IDLE_TIMEOUT seconds are closed, setting it to 0 opens a new
+    connection for every command.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._last_reap = time.time()
+
+    def execute(self, host, port, password, command, timeout=3.0):
+        return self.execute_many(host, port, password, [command], timeout)[0]
+
+    def execute_many(self, host, port, password, commands, timeout=3.0):
+        key = (host, port, password)
+        conn = self._checkout(key)
+        if conn is not None:
+            try:
+                return self._run(conn, commands, timeout)
+            except socket.error:
+                # The server dropped the connection while it sat in the
+                # pool, so the commands never made it there: try a new one.
+                pass
+
+        conn = self._connect(key, timeout)
+        return self._run(conn, commands, timeout)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _connect(self, key, timeout):
+        from valve.source.rcon import RCON
+
+        host, port, password = key
+        rcon = RCON((host, port), password, timeout=timeout)
+        try:
+            rcon.connect()
+            # Every command is written as two small packets (the command and
+            # the end-of-response marker), which Nagle's algorithm would hold
+            # back until the server acknowledges the first one.
+            rcon._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if password:
+                rcon.authenticate(password)
+        except:
+            if rcon._socket:
+                rcon._socket.close()
+            raise
+        return PooledConnection(key, rcon)
+
+    def _run(self, conn, commands, timeout):
+        conn.rcon.timeout = timeout
+        try:
+            # Every command is written before any response is read, so a
+            # batch costs a single round trip. srcds answers them in order.
+            requests = [conn.rcon.execute(command, block=False)
+                        for command in commands]
+            responses = []
+            for request in requests:
+                with conn.rcon.response_to(request) as response:
+                    responses.append(response.body)
+        except:
+            conn.close()
+            raise
+        self._release(conn)
+        return responses
+
+    def _checkout(self, key):
+        max_idle = config_setting('RCON_POOL_IDLE_TIMEOUT')
+        if not max_idle:
+            return None
+
+        now = time.time()
+        with self._lock:
+            if now - self._last_reap > max_idle:
+                self._reap(now, max_idle)
+
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.last_used < max_idle and conn.is_healthy():
+                    return conn
+                conn.close()
+        return None
+
+    def _release(self, conn):
+        conn.reset()
+        if (not config_setting('RCON_POOL_IDLE_TIMEOUT') or
+                conn.rcon._read_buffer):
+            conn.close()
+            return
+
+        conn.last_used = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(conn.key, [])
+            if len(idle) < config_setting('RCON_POOL_SIZE'):
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _reap(self, now, max_idle):
+        # Drop connections to servers that are no longer used at all,
+        # e.g. after an rcon password change.
+        for key, idle in self._idle.items():
+            for conn in idle:
+                if now - conn.last_used >= max_idle:
+                    conn.close()
+            idle[:] = [c for c in idle if now - c.last_used < max_idle]
+            if not idle:
+                del self._idle[key]
+        self._last_reap = now
+
+
+class ServerUnreachableError(RconError):
+    pass
+
+
+class CircuitBreaker(object):
+    """Stops sending commands to servers that keep failing.
+
+    After RCON_BREAKER_THRESHOLD failed commands in a row a server is skipped
+    for a cool-down that doubles with every further failure, up to
+    RCON_BREAKER_MAX_COOLDOWN seconds. Once it runs out a single command is
+    let through as a probe: success closes the breaker again, failure starts a
+    longer cool-down. The state lives in the shared cache so all workers
+    agree on which servers are down.
+    """
+
+    def key(self, host, port):
+        return 'rcon_breaker_{}_{}'.format(host, port)
+
+    def get_state(self, host, port):
+        return cache.get(self.key(host, port))
+
+    def before_send(self, host, port):
+        # Returns the current state (None for a healthy server) and whether
+        # this command is the probe. Raises ServerUnreachableError when the
+        # breaker is open.
+        threshold = config_setting('RCON_BREAKER_THRESHOLD')
+        state = self.get_state(host, port)
+        if not threshold or not state or state['failures'] < threshold:
+            return state, False
+
+        # Half-open: the first caller to claim the probe key gets through.
+        # (Flask-Cache's own add() proxy drops the backend's return value.)
+        wait = state['open_until'] - time.time()
+        if wait <= 0 and cache.cache.add(
+                self.key(host, port) + '_probe', True,
+                timeout=config_setting('RCON_BREAKER_COOLDOWN')):
+            return state, True
+
+        raise ServerUnreachableError(
+            'Server unreachable, retrying in {} seconds'.format(
+                int(max(wait, 0)) + 1))
+
+    def succeeded(self, host, port, state):
+        if state:
+            key = self.key(host, port)
+            cache.delete_many(key, key + '_probe')
+
+    def failed(self, host, port, state):
+        state = dict(state or {'failures': 0, 'open_until': 0})
+        state['failures'] += 1
+
+        threshold = config_setting('RCON_BREAKER_THRESHOLD')
+        max_cooldown = config_setting('RCON_BREAKER_MAX_COOLDOWN')
+        if threshold and state['failures'] >= threshold:
+            backoff = 2 ** min(state['failures'] - threshold, 16)
+            cooldown = min(max_cooldown,
+                           config_setting('RCON_BREAKER_COOLDOWN') * backoff)
+            state['open_until'] = time.time() + cooldown
+
+        key = self.key(host, port)
+        cache.set(key, state, timeout=max_cooldown * 2)
+        cache.delete(key + '_probe')
+
+    def describe(self, host, port):
+        state = self.get_state(host, port)
+        if not state:
+            return ''
+
+        threshold = config_setting('RCON_BREAKER_THRESHOLD')
+        wait = state['open_until'] - time.time()
+        if threshold and state['failures'] >= threshold and wait > 0:
+            return 'Unreachable, retrying in {} seconds'.format(int(wait) + 1)
+        return '{} failed rcon command(s)'.format(state['failures'])
+
+
+pool = RconPool()
+breaker = CircuitBreaker()
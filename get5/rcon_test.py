@@ -0,0 +1,180 @@
+import socket
+import time
+import unittest
+
+import get5
+import get5_test
+import rcon
+import util
+from get5 import db
+from models import GameServer, Match
+from simulator import FakeRconServer
+
+
+class RconTests(get5_test.Get5Test):
+
+    def setUp(self):
+        super(RconTests, self).setUp()
+        self.server = FakeRconServer(responses={'status': 'hostname: test'})
+        rcon.pool.close_all()
+
+    def tearDown(self):
+        rcon.pool.close_all()
+        self.server.stop()
+        get5.app.config.pop('RCON_POOL_IDLE_TIMEOUT', None)
+        get5.app.config.pop('GET5_URL_OVERRIDE', None)
+        get5.app.config.pop('RCON_BREAKER_THRESHOLD', None)
+        super(RconTests, self).tearDown()
+
+    def send(self, command, password='rcon_password', **kwargs):
+        return util.send_rcon_command('127.0.0.1', self.server.port, password,
+                                      command, **kwargs)
+
+    def test_connection_reused(self):
+        for _ in range(5):
+            self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.commands, ['status'] * 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.auths, 1)
+
+    def test_send_commands(self):
+        self.assertEqual(
+            util.send_rcon_commands('127.0.0.1', self.server.port,
+                                    'rcon_password', ['status', 'echo', 'status']),
+            ['hostname: test', '', 'hostname: test'])
+        self.assertEqual(self.server.commands, ['status', 'echo', 'status'])
+        self.assertEqual(self.server.connections, 1)
+
+        # The connection is still usable afterwards
+        self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_pool_disabled(self):
+        get5.app.config['RCON_POOL_IDLE_TIMEOUT'] = 0
+        for _ in range(5):
+            self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.connections, 5)
+        self.assertEqual(self.server.auths, 5)
+
+    def test_reconnect(self):
+        self.assertEqual(self.send('status'), 'hostname: test')
+
+        # A connection closed by the server is replaced
+        self.server.drop_connections()
+        time.sleep(0.1)
+        self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.connections, 2)
+
+        # So is one that sat idle for too long
+        get5.app.config['RCON_POOL_IDLE_TIMEOUT'] = 60
+        for conn in rcon.pool._idle[('127.0.0.1', self.server.port, 'rcon_password')]:
+            conn.last_used -= 61
+        self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.commands, ['status'] * 3)
+
+    def test_wrong_password(self):
+        with self.assertRaises(util.RconError):
+            self.send('status', password='wrong')
+        self.assertEqual(self.server.commands, [])
+
+        # Failed logins are never pooled
+        self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_send_to_server(self):
+        server = GameServer.query.get(1)
+        server.ip_string = '127.0.0.1'
+        server.port = self.server.port
+        server.rcon_password = 'rcon_password'
+        db.session.commit()
+
+        match = Match.query.get(1)
+        get5.app.config['GET5_URL_OVERRIDE'] = 'localhost'
+        self.assertTrue(match.send_to_server())
+        self.assertEqual(self.server.commands, [
+            'get5_loadmatch_url localhost/match/1/config',
+            'get5_web_api_key ' + match.api_key,
+        ])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_send_many(self):
+        # Accepts connections but never answers them
+        blackhole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        blackhole.bind(('127.0.0.1', 0))
+        blackhole.listen(5)
+        try:
+            targets = [(i, '127.0.0.1', self.server.port, 'rcon_password')
+                       for i in range(10)]
+            targets.append(('slow', '127.0.0.1', blackhole.getsockname()[1],
+                            'rcon_password'))
+            targets.append(('badpass', '127.0.0.1', self.server.port, 'wrong'))
+
+            start = time.time()
+            results = util.send_rcon_command_many(
+                targets, 'status', deadline=0.5, timeout=3.0)
+            self.assertLess(time.time() - start, 2.0)
+        finally:
+            blackhole.close()
+
+        self.assertEqual(len(results), 12)
+        for i in range(10):
+            self.assertEqual(results[i], ('hostname: test', ''))
+        self.assertEqual(results['slow'][0], None)
+        self.assertTrue(results['slow'][1])
+        self.assertEqual(results['badpass'],
+                         (None, 'Incorrect rcon password'))
+        self.assertEqual(self.server.commands, ['status'] * 10)
+
+    def test_circuit_breaker(self):
+        get5.app.config['RCON_BREAKER_THRESHOLD'] = 2
+        server = GameServer.query.get(1)
+        server.port = self.server.port
+        server.rcon_password = 'rcon_password'
+        db.session.commit()
+
+        def reopen():
+            # Skips the rest of the cool-down
+            state = rcon.breaker.get_state('127.0.0.1', self.server.port)
+            state['open_until'] = 0
+            get5.cache.set(rcon.breaker.key('127.0.0.1', self.server.port), state)
+
+        self.server.silent = True
+        for _ in range(2):
+            with self.assertRaises(util.RconError):
+                self.send('status', raise_errors=True, num_retries=1, timeout=0.2)
+
+        # Open: fails straight away without contacting the server
+        start = time.time()
+        with self.assertRaises(rcon.ServerUnreachableError):
+            self.send('status', raise_errors=True, timeout=0.2)
+        self.assertEqual(self.send('status', timeout=0.2), None)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(server.get_rcon_state(),
+                         'Unreachable, retrying in 15 seconds')
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            self.assertIn('Unreachable, retrying in 15 seconds',
+                          c.get('/myservers').data)
+
+        # Half-open: a single attempt is let through, failing doubles the
+        # cool-down
+        reopen()
+        start = time.time()
+        with self.assertRaises(util.RconError):
+            self.send('status', raise_errors=True, num_retries=3, timeout=0.2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(server.get_rcon_state(),
+                         'Unreachable, retrying in 30 seconds')
+
+        # A successful probe closes it again
+        self.server.silent = False
+        reopen()
+        self.assertEqual(self.send('status'), 'hostname: test')
+        self.assertEqual(server.get_rcon_state(), '')
+        self.assertEqual(self.send('status'), 'hostname: test')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import datetime
+import heapq
+import threading
+
+from get5 import app, db, cache, config_setting
+from models import GameServer, Match, ServerStatus
+import allocation
+import api
+
+
+class Scheduler(object):
+    """Starts queued matches at their scheduled_start.
+
+    Pending (time, match id) entries are kept in a heap, so the thread only
+    ever looks at the earliest one and sleeps until it is due. The heap is
+    rebuilt from the database on start and every
+    MATCH_SCHEDULER_RELOAD_INTERVAL seconds, which picks up matches
+    scheduled by other processes and survives restarts. Entries of matches
+    that were cancelled, started or rescheduled in the meantime are dropped
+    once they come up.
+
+    The same thread polls the game servers every SERVER_POLL_INTERVAL
+    seconds, see poll_servers.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._thread = None
+        self._last_poll = None
+        self.base_url = None
+
+    def add(self, match):
+        if match.scheduled_start is None:
+            return
+        with self._cond:
+            heapq.heappush(self._heap, (match.scheduled_start, match.id))
+            self._cond.notify()
+
+    def reload(self):
+        rows = db.session.query(Match.scheduled_start, Match.id).filter(
+            Match.queued == True, Match.cancelled == False,
+            Match.scheduled_start != None).all()
+        heap = [tuple(row) for row in rows]
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._cond.notify()
+        return len(heap)
+
+    def next_due(self):
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def run_due(self, now=None):
+        # Returns the matches that got a server, the others stay queued and
+        # start as soon as one is released.
+        now = now or datetime.datetime.utcnow()
+        started = []
+        for matchid in self.pop_due(now):
+            match = Match.query.get(matchid)
+            if (match is None or not match.queued or match.cancelled or
+                    match.scheduled_start is None or
+                    match.scheduled_start > now):
+                continue
+            if allocation.start_match(match):
+                started.append(match)
+        return started
+
+    def poll(self, now=None):
+        # Only one process sharing the cache polls per interval. Returns
+        # whether this one did.
+        now = now or datetime.datetime.utcnow()
+        interval = config_setting('SERVER_POLL_INTERVAL')
+        if not interval or (self._last_poll is not None and
+                            (now - self._last_poll).total_seconds() < interval):
+            return False
+        self._last_poll = now
+        if not cache.cache.add('server_poll', True, timeout=max(interval - 1, 1)):
+            return False
+        poll_servers()
+        return True
+
+    def start(self, base_url):
+        # base_url is used to build the config urls sent to the servers
+        with self._cond:
+            if self._thread is not None:
+                return
+            self.base_url = base_url
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        last_reload = None
+        while True:
+            interval = config_setting('MATCH_SCHEDULER_RELOAD_INTERVAL')
+            now = datetime.datetime.utcnow()
+            with app.test_request_context(base_url=self.base_url):
+                try:
+                    if (last_reload is None or
+                            (now - last_reload).total_seconds() >= interval):
+                        self.reload()
+                        last_reload = now
+                    for match in self.run_due(now):
+                        app.logger.info('Started scheduled match {} on server {}'
+                                        .format(match.id, match.server_id))
+                except Exception:
+                    app.logger.exception('Failed to start scheduled matches')
+                    db.session.rollback()
+
+                try:
+                    self.poll(now)
+                except Exception:
+                    app.logger.exception('Failed to poll game servers')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+            with self._cond:
+                wait = max(min(interval,
+                               config_setting('SERVER_POLL_INTERVAL') or interval), 1)
+                if self._heap:
+                    until_due = (self._heap[0][0] -
+                                 datetime.datetime.utcnow()).total_seconds()
+                    wait = min(wait, max(until_due, 0))
+                self._cond.wait(wait)
+
+
+def poll_servers(deadline=None):
+    """Stores the availability of every game server, all checked at once.
+
+    Also frees servers whose lease expired and writes buffered live scores
+    of maps whose plugin went quiet, see SCORE_UPDATE_FLUSH_INTERVAL.
+    Requests only ever read the statuses stored here.
+    """
+    servers = GameServer.query.options(db.joinedload(GameServer.status)).all()
+    ServerStatus.refresh(servers, deadline=deadline)
+    db.session.commit()
+    allocation.reap_leases()
+    api.flush_stale_map_scores()
+    db.session.commit()
+
+
+scheduler = Scheduler()
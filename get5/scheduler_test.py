@@ -0,0 +1,136 @@
+import datetime
+import unittest
+
+import allocation
+import bulk
+import get5
+import get5_test
+import rcon
+import simulator
+from get5 import db
+from models import User, Match, GameServer, RconJob, ServerStatus
+from scheduler import Scheduler
+
+
+class SchedulerTests(get5_test.Get5Test):
+
+    def test_scheduled_match(self):
+        start = datetime.datetime.utcnow().replace(second=0, microsecond=0) + \
+            datetime.timedelta(hours=1)
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            response = c.post('/match/create', data={
+                'server_id': 0,
+                'scheduled_start': start.strftime('%Y-%m-%d %H:%M'),
+                'team1_id': 1,
+                'team2_id': 2,
+                'match_title': 'Map {MAPNUMBER} of {MAXMAPS}',
+                'series_type': 'bo1',
+                'veto_mappool': ['de_dust2'],
+            })
+            self.assertEqual(response.status_code, 302)
+
+        # Server 2 is free, but the match waits for its start time
+        match = Match.query.get(2)
+        self.assertTrue(match.queued)
+        self.assertEqual(match.scheduled_start, start)
+        self.assertEqual(match.get_status_string(), start.strftime(
+            'Scheduled for %Y-%m-%d %H:%M UTC'))
+        self.assertIsNone(allocation.dispatch(GameServer.query.get(2)))
+        self.assertFalse(GameServer.query.get(2).in_use)
+
+        # A fresh scheduler, as after a restart, finds it in the database
+        scheduler = Scheduler()
+        self.assertEqual(scheduler.reload(), 1)
+        self.assertEqual(scheduler.next_due(), start)
+        with get5.app.test_request_context():
+            self.assertEqual(scheduler.run_due(), [])
+            self.assertEqual(scheduler.run_due(start), [Match.query.get(2)])
+
+        match = Match.query.get(2)
+        self.assertFalse(match.queued)
+        self.assertEqual(match.server_id, 2)
+        self.assertTrue(GameServer.query.get(2).leased_by(match))
+        self.assertEqual(RconJob.query.one().action, 'load')
+        self.assertIsNone(scheduler.next_due())
+
+    def test_many_scheduled_matches(self):
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        entries = []
+        for i in range(200):
+            start = now + datetime.timedelta(minutes=(i * 37) % 200 + 1)
+            entries.append({'team1': 1, 'team2': 2,
+                            'scheduled_start': start.strftime('%Y-%m-%d %H:%M')})
+        user = User.query.get(1)
+        with get5.app.test_request_context():
+            matches = bulk.create_matches(user, entries)
+        self.assertEqual(len(matches), 200)
+        self.assertTrue(all(m.queued for m in matches))
+
+        scheduler = Scheduler()
+        scheduler.reload()
+        due = scheduler.pop_due(now + datetime.timedelta(minutes=10))
+        self.assertEqual(len(due), 10)
+        self.assertEqual(
+            [Match.query.get(matchid).scheduled_start for matchid in due],
+            sorted(Match.query.get(matchid).scheduled_start for matchid in due))
+
+        # Only one server is free: the first due match gets it, a cancelled
+        # one is skipped and the others wait for the next free server
+        scheduler.reload()
+        first, second, third = [Match.query.get(matchid) for matchid in
+                                scheduler.pop_due(now + datetime.timedelta(minutes=3))]
+        second.cancelled = True
+        db.session.commit()
+        scheduler.reload()
+        with get5.app.test_request_context():
+            started = scheduler.run_due(now + datetime.timedelta(minutes=3))
+        self.assertEqual(started, [first])
+        self.assertTrue(Match.query.get(third.id).queued)
+
+        # Once due, queued matches are started by released servers too
+        third = Match.query.get(third.id)
+        third.scheduled_start = now - datetime.timedelta(minutes=1)
+        db.session.commit()
+        server = GameServer.query.get(2)
+        with get5.app.test_request_context():
+            self.assertEqual(allocation.release(server), third)
+
+    def test_poll_servers(self):
+        get5.cache.clear()
+        fake = simulator.FakeRconServer(
+            password='password',
+            responses={'get5_web_available': '{"gamestate": 0}'})
+        try:
+            server = GameServer.query.get(2)
+            server.port = fake.port
+            db.session.commit()
+
+            now = datetime.datetime.utcnow()
+            with get5.app.test_request_context():
+                self.assertTrue(Scheduler().poll(now))
+            self.assertEqual(fake.commands, ['get5_web_available'])
+            self.assertTrue(ServerStatus.query.get(2).available)
+            self.assertFalse(ServerStatus.query.get(1).available)
+            self.assertEqual(allocation.polled_status(GameServer.query.get(2)),
+                             ServerStatus.query.get(2))
+
+            # Once per interval, for every process sharing the cache
+            with get5.app.test_request_context():
+                self.assertFalse(Scheduler().poll(now))
+            self.assertEqual(len(fake.commands), 1)
+
+            # Until the next poll a status is trusted for SERVER_STATUS_MAX_AGE
+            status = ServerStatus.query.get(2)
+            status.last_checked -= datetime.timedelta(hours=1)
+            db.session.commit()
+            self.assertIsNone(allocation.polled_status(GameServer.query.get(2)))
+            self.assertEqual(len(fake.commands), 1)
+        finally:
+            rcon.pool.close_all()
+            fake.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
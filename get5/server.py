@@ -1,5 +1,5 @@
 from get5 import app, db, flash_errors, config_setting
-from models import GameServer
+from models import GameServer, RconJob, ServerStatus
 import util
 
 from flask import Blueprint, request, render_template, flash, g, redirect
@@ -96,6 +96,9 @@ def server_edit(serverid):
             server.port = data['port']
             server.rcon_password = data['rcon_password']
             server.public_server = (data['public_server'] and g.user.admin)
+            if server.status:
+                # Checked with the old address/password
+                db.session.delete(server.status)
 
             if mock or util.check_server_connection(server):
                 db.session.commit()
@@ -125,6 +128,8 @@ def server_delete(serverid):
     for m in matches:
         m.server_id = None
 
+    ServerStatus.query.filter_by(server_id=serverid).delete()
+    RconJob.query.filter_by(server_id=serverid).update({'server_id': None})
     GameServer.query.filter_by(id=serverid).delete()
     db.session.commit()
     return redirect('myservers')
@@ -135,7 +140,50 @@ def myservers():
     if not g.user:
         return redirect('/login')
 
-    servers = GameServer.query.filter_by(
-        user_id=g.user.id).order_by(-GameServer.id).limit(50)
+    return render_template('servers.html', user=g.user,
+                           servers=get_user_servers(g.user))
 
-    return render_template('servers.html', user=g.user, servers=servers)
+
+@server_blueprint.route('/myservers/check', methods=['POST'])
+def myservers_check():
+    if not g.user:
+        return redirect('/login')
+
+    servers = get_user_servers(g.user)
+    replies = GameServer.send_rcon_command_many(servers, 'get5_web_available')
+    results = {}
+    for server_id, (response, error) in replies.items():
+        if not error:
+            _, error = util.parse_server_avaliability(response)
+        results[server_id] = error or 'Available'
+
+    return render_template('servers.html', user=g.user, servers=servers,
+                           results=results)
+
+
+@server_blueprint.route('/myservers/broadcast', methods=['POST'])
+def myservers_broadcast():
+    if not g.user:
+        return redirect('/login')
+
+    command = request.form.get('command', '').strip()
+    if not command:
+        flash('No command given')
+        return redirect('/myservers')
+
+    servers = get_user_servers(g.user)
+    replies = GameServer.send_rcon_command_many(servers, command)
+    app.logger.info('User {} sent "{}" to {} servers'.format(
+        g.user.id, command, len(servers)))
+
+    results = {}
+    for server_id, (response, error) in replies.items():
+        results[server_id] = error or response or 'OK'
+
+    return render_template('servers.html', user=g.user, servers=servers,
+                           results=results, command=command)
+
+
+def get_user_servers(user):
+    return GameServer.query.filter_by(user_id=user.id).options(
+        db.joinedload(GameServer.status)).order_by(-GameServer.id).limit(50).all()
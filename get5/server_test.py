@@ -1,9 +1,14 @@
+import datetime
 import unittest
 
 from flask import url_for
 
+import get5
 import get5_test
-from models import User, GameServer
+import rcon
+import simulator
+from get5 import db
+from models import User, GameServer, ServerStatus
 
 
 # TODO: add a test for trying to create a public server as non-admin
@@ -124,6 +129,94 @@ class TeamTests(get5_test.Get5Test):
             response = c.post('/server/1/edit')
             self.assertEqual(response.status_code, 400)
 
+    def test_all_servers_actions(self):
+        fake = simulator.FakeRconServer(
+            password='password',
+            responses={'get5_web_available': '{"gamestate": 0}',
+                       'say hello': ''})
+        try:
+            server = GameServer.query.get(1)
+            server.port = fake.port
+            db.session.commit()
+
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+
+                response = c.post('/myservers/check')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Available', response.data)
+                # Nothing listens on the second server's port
+                self.assertIn('Connection refused', response.data)
+
+                response = c.post('/myservers/broadcast',
+                                  data={'command': 'say hello'})
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('OK', response.data)
+
+                response = c.post('/myservers/broadcast', data={'command': ''})
+                self.assertEqual(response.status_code, 302)
+
+            self.assertEqual(fake.commands, ['get5_web_available', 'say hello'])
+        finally:
+            rcon.pool.close_all()
+            fake.stop()
+
+        # Only logged in users can use them
+        response = get5.app.test_client().post('/myservers/check')
+        self.assertEqual(response.status_code, 302)
+
+    def test_server_status(self):
+        fake = simulator.FakeRconServer(
+            password='password',
+            responses={'get5_web_available':
+                       '{"gamestate": 0, "plugin_version": "0.5.0"}'})
+        try:
+            server = GameServer.query.get(1)
+            server.port = fake.port
+            db.session.commit()
+
+            ServerStatus.refresh(GameServer.query.all())
+            db.session.commit()
+
+            status = ServerStatus.query.get(1)
+            self.assertTrue(status.available)
+            self.assertEqual(status.status, 'Available')
+            self.assertEqual(status.gamestate, 0)
+            self.assertEqual(status.plugin_version, '0.5.0')
+            self.assertEqual(status.last_seen, status.last_checked)
+
+            # Nothing listens on the second server's port
+            status = ServerStatus.query.get(2)
+            self.assertFalse(status.available)
+            self.assertIn('Connection refused', status.status)
+            self.assertEqual(status.last_seen, None)
+
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+                response = c.get('/myservers')
+                self.assertIn('Available', response.data)
+                self.assertIn('Connection refused', response.data)
+
+            # A recent status is used without contacting the server
+            self.assertEqual(GameServer.query.get(1).check_availability(),
+                             ({'gamestate': 0, 'plugin_version': '0.5.0'}, ''))
+            self.assertEqual(len(fake.commands), 1)
+
+            # A stale one is checked again
+            status = ServerStatus.query.get(1)
+            status.last_checked -= datetime.timedelta(hours=1)
+            db.session.commit()
+            fake.responses['get5_web_available'] = '{"gamestate": 1}'
+            self.assertEqual(GameServer.query.get(1).check_availability(),
+                             (None, 'Server already has a get5 match setup'))
+            self.assertEqual(len(fake.commands), 2)
+            self.assertEqual(ServerStatus.query.get(1).gamestate, 1)
+        finally:
+            rcon.pool.close_all()
+            fake.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,457 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import socket
+import struct
+import threading
+import time
+import urllib
+import urlparse
+
+import requests
+
+# Local stand-ins for a CS:GO server running get5, used by the tests and the
+# benchmark commands in manager.py:
+#   FakeRconServer speaks the Source rcon protocol,
+#   Get5Server answers get5's commands on top of it, and
+#   PluginSimulator plays the loaded match against the web api the way the
+#   get5_apistats plugin does, and
+#   FakeSteamApi serves the parts of the Steam web api used by get5-web.
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+
+class FakeRconHandler(SocketServer.BaseRequestHandler):
+
+    def send(self, id, type, body=''):
+        self.request.sendall(
+            struct.pack('<iii', len(body) + 10, id, type) + body + '\x00\x00')
+
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with server.lock:
+            server.connections += 1
+            server.open_sockets.append(self.request)
+
+        buf = ''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except Exception:
+                return
+            if not data:
+                return
+            if server.silent:
+                continue
+            buf += data
+
+            while len(buf) >= 4:
+                size = struct.unpack('<i', buf[:4])[0]
+                if len(buf) < size + 4:
+                    break
+                id, type = struct.unpack('<ii', buf[4:12])
+                body = buf[12:size + 2]
+                buf = buf[size + 4:]
+
+                if type == SERVERDATA_AUTH:
+                    with server.lock:
+                        server.auths += 1
+                    server.delay()
+                    if body != server.password:
+                        id = -1
+                    self.send(id, SERVERDATA_RESPONSE_VALUE)
+                    self.send(id, SERVERDATA_AUTH_RESPONSE)
+                elif type == SERVERDATA_EXECCOMMAND:
+                    with server.lock:
+                        server.commands.append(body)
+                    if server.should_fail():
+                        # Dropped without an answer
+                        self.request.shutdown(socket.SHUT_RDWR)
+                        return
+                    server.delay()
+                    self.send(id, SERVERDATA_RESPONSE_VALUE,
+                              server.handle_command(body).encode('utf-8'))
+                else:
+                    # Mirrors the srcds reply used to find the end of a
+                    # multi-packet response.
+                    self.send(id, SERVERDATA_RESPONSE_VALUE)
+                    self.send(id, SERVERDATA_RESPONSE_VALUE,
+                              '\x00\x01\x00\x00')
+
+
+class FakeRconServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A Source rcon server on a local port.
+
+    latency is slept before every reply, failure_rate is the chance that a
+    command drops the connection instead of answering, and silent makes the
+    server accept connections but never answer. responses maps commands to
+    their replies, anything else gets an empty one.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password='rcon_password', responses=None, port=0,
+                 latency=0.0, failure_rate=0.0, seed=None):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', port), FakeRconHandler)
+        self.password = password
+        self.responses = responses or {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.silent = False
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.auths = 0
+        self.commands = []
+        self.open_sockets = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def handle_command(self, command):
+        return self.responses.get(command, '')
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self):
+        with self.lock:
+            return self.failure_rate and self.random.random() < self.failure_rate
+
+    def drop_connections(self):
+        with self.lock:
+            sockets, self.open_sockets = self.open_sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+
+def http_get_json(url):
+    response = requests.get(url, timeout=10)
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+class Get5Server(FakeRconServer):
+    """A FakeRconServer that answers get5's commands.
+
+    get5_loadmatch_url fetches the match config with fetch_config(url), which
+    by default is a plain http GET, and keeps it with the api key for a
+    PluginSimulator to play. Explicit entries in responses still win.
+    """
+
+    def __init__(self, password='rcon_password', plugin_version='0.5.0',
+                 fetch_config=None, **kwargs):
+        FakeRconServer.__init__(self, password, **kwargs)
+        self.plugin_version = plugin_version
+        self.fetch_config = fetch_config or http_get_json
+        self.state_lock = threading.Lock()
+        self.gamestate = 0
+        self.paused = False
+        self.match_config = None
+        self.api_key = None
+        self.backups = {}
+
+    def handle_command(self, command):
+        if command in self.responses:
+            return self.responses[command]
+
+        name, _, args = command.partition(' ')
+        args = args.strip().strip('"')
+        handler = getattr(self, 'cmd_' + name, None)
+        if handler is None:
+            return 'Unknown command "{}"'.format(name)
+        with self.state_lock:
+            return handler(args)
+
+    def cmd_status(self, args):
+        return 'hostname: get5 simulator\nmap     : de_dust2'
+
+    def cmd_get5_web_available(self, args):
+        return json.dumps({
+            'gamestate': self.gamestate,
+            'available': 1,
+            'plugin_version': self.plugin_version,
+        })
+
+    def cmd_get5_loadmatch_url(self, args):
+        if self.gamestate != 0:
+            return 'Cannot load a match config while a match is live'
+        try:
+            config = self.fetch_config('http://' + args)
+        except Exception:
+            config = None
+        if not config:
+            return 'Failed to load match config from {}'.format(args)
+
+        self.match_config = config
+        self.gamestate = 1
+        self.backups.setdefault(config['matchid'], []).append(
+            'get5_backup_match{}_map0_round0.cfg'.format(config['matchid']))
+        return ''
+
+    def cmd_get5_web_api_key(self, args):
+        self.api_key = args
+        return ''
+
+    def cmd_get5_endmatch(self, args):
+        self.gamestate = 0
+        self.match_config = None
+        self.paused = False
+        return ''
+
+    def cmd_get5_listbackups(self, args):
+        return '\n'.join(self.backups.get(args, []))
+
+    def cmd_get5_loadbackup(self, args):
+        for files in self.backups.values():
+            if args in files:
+                return 'Restored backup {}'.format(args)
+        return 'Failed to load backup {}'.format(args)
+
+    def cmd_get5_addplayer(self, args):
+        steam_id, _, team = args.partition(' ')
+        if not self.match_config or team not in ('team1', 'team2', 'spec'):
+            return 'Failed to add player {}'.format(steam_id)
+        if team != 'spec':
+            self.match_config[team].setdefault('players', []).append(steam_id)
+        return 'Added player {} to {}'.format(steam_id, team)
+
+    def cmd_sm_pause(self, args):
+        self.paused = True
+        return ''
+
+    def cmd_sm_unpause(self, args):
+        self.paused = False
+        return ''
+
+
+def http_poster(base_url):
+    base_url = base_url.rstrip('/')
+
+    def post(path, data=None, json_data=None):
+        response = requests.post(base_url + path, data=data, json=json_data,
+                                 timeout=10)
+        return response.status_code
+    return post
+
+
+def client_poster(client):
+    # Posts through a flask test client instead of over http
+    def post(path, data=None, json_data=None):
+        if json_data is not None:
+            return client.post(path, data=json.dumps(json_data),
+                               content_type='application/json').status_code
+        return client.post(path, data=data).status_code
+    return post
+
+
+class PluginSimulator(object):
+    """Plays the match loaded on a Get5Server against the web api.
+
+    Sends the same callbacks as the get5_apistats plugin: a map start, a
+    score update and player stats after every round, the map result and
+    finally the series result. With bulk_players the stats of a round go in
+    a single players/update request. Every request's status code and
+    duration is kept in self.requests.
+    """
+
+    def __init__(self, server, post=None, rounds_to_win=16, bulk_players=False,
+                 seed=None):
+        self.server = server
+        self.config = server.match_config
+        self.post = post or http_poster(self.config['cvars']['get5_web_api_url'])
+        self.rounds_to_win = rounds_to_win
+        self.bulk_players = bulk_players
+        self.random = random.Random(seed)
+        self.requests = []
+
+    def send(self, path, data=None, json_data=None):
+        path = '/match/{}{}'.format(self.config['matchid'], path)
+        if json_data is not None:
+            # The key goes in the query string next to a json body
+            path += '?key=' + self.server.api_key
+        else:
+            data = dict(data or {}, key=self.server.api_key)
+
+        start = time.time()
+        status = self.post(path, data=data, json_data=json_data)
+        self.requests.append((status, time.time() - start))
+        return status
+
+    def play(self):
+        maps_to_win = self.config.get('maps_to_win', 1)
+        maplist = self.config.get('maplist') or ['de_dust2']
+        wins = {'team1': 0, 'team2': 0}
+        map_number = 0
+        while max(wins.values()) < maps_to_win and map_number < len(maplist):
+            winner = self.play_map(map_number, maplist[map_number])
+            wins[winner] += 1
+            map_number += 1
+            if self.config.get('bo2_series') and map_number == 2:
+                break
+
+        if wins['team1'] == wins['team2']:
+            series_winner = 'none'
+        else:
+            series_winner = max(wins, key=wins.get)
+        self.send('/finish', {'winner': series_winner})
+        self.server.cmd_get5_endmatch('')
+        return self.requests
+
+    def play_map(self, map_number, mapname):
+        self.send('/map/{}/start'.format(map_number), {'mapname': mapname})
+
+        players = {}
+        for team in ('team1', 'team2'):
+            for steam_id in self.config.get(team, {}).get('players', []):
+                players[steam_id] = {'name': 'player_' + steam_id[-4:],
+                                     'team': team, 'kills': 0, 'deaths': 0,
+                                     'assists': 0, 'damage': 0,
+                                     'headshot_kills': 0, 'roundsplayed': 0}
+
+        score = {'team1': 0, 'team2': 0}
+        while max(score.values()) < self.rounds_to_win:
+            round_winner = self.random.choice(['team1', 'team2'])
+            score[round_winner] += 1
+            self.play_round(players, round_winner)
+            self.send('/map/{}/update'.format(map_number),
+                      {'team1score': score['team1'],
+                       'team2score': score['team2']})
+            self.send_players(map_number, players)
+
+        winner = max(score, key=score.get)
+        self.send('/map/{}/finish'.format(map_number), {'winner': winner})
+        return winner
+
+    def play_round(self, players, round_winner):
+        for stats in players.values():
+            stats['roundsplayed'] += 1
+            kills = self.random.randint(0, 2 if stats['team'] == round_winner else 1)
+            stats['kills'] += kills
+            stats['headshot_kills'] += self.random.randint(0, kills)
+            stats['damage'] += kills * 100 + self.random.randint(0, 50)
+            stats['deaths'] += int(self.random.random() < 0.4)
+
+    def send_players(self, map_number, players):
+        if self.bulk_players:
+            self.send('/map/{}/players/update'.format(map_number),
+                      json_data={'players': players})
+            return
+        for steam_id, stats in players.items():
+            self.send('/map/{}/player/{}/update'.format(map_number, steam_id),
+                      stats)
+
+
+class FakeSteamApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        server.delay()
+
+        if url.path == '/ISteamUser/GetPlayerSummaries/v0002/':
+            steam64s = query.get('steamids', [''])[0].split(',')
+            with server.lock:
+                server.requests.append(steam64s)
+            if len(steam64s) > 100:
+                return self.reply(400, 'Too many steamids')
+            players = []
+            for steam64 in steam64s:
+                profile = server.profiles.get(steam64)
+                if profile is not None:
+                    players.append(dict(profile, steamid=steam64))
+            return self.reply(200, json.dumps({'response': {'players': players}}),
+                              'application/json')
+
+        parts = url.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'id' and query.get('xml') == ['1']:
+            name = urllib.unquote(parts[1])
+            with server.lock:
+                server.custom_name_requests.append(name)
+            steam64 = server.custom_names.get(name.lower())
+            if steam64 is None:
+                body = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        '<response><error><![CDATA[The specified profile could '
+                        'not be found.]]></error></response>')
+            else:
+                body = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        '<profile><steamID64>{}</steamID64><steamID><![CDATA[{}]]>'
+                        '</steamID><onlineState>offline</onlineState>{}'
+                        '</profile>').format(steam64, name, ' ' * 10000)
+            return self.reply(200, body, 'text/xml')
+
+        self.reply(404, 'Not found')
+
+    def reply(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSteamApi(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local Steam web api, for STEAM_API_URL.
+
+    profiles maps steam64s to their GetPlayerSummaries entries, e.g.
+    {'personaname': 'splewis'}. Every call's steamids are kept in
+    self.requests, latency is slept before each reply. It also serves the
+    profile xml of the lowercase custom names in custom_names (name ->
+    steam64) for STEAM_COMMUNITY_URL, the names asked for are kept in
+    self.custom_name_requests.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, profiles=None, latency=0.0, port=0, custom_names=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeSteamApiHandler)
+        self.profiles = profiles or {}
+        self.custom_names = custom_names or {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = []
+        self.custom_name_requests = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def handle_error(self, request, client_address):
+        # Clients hang up early, e.g. once they read the steamID64
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
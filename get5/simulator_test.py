@@ -0,0 +1,131 @@
+import json
+import time
+import unittest
+import urlparse
+
+import get5
+import get5_test
+import jobs
+import rcon
+import util
+from get5 import db
+from models import GameServer, Match, MapStats, PlayerStats, RconJob
+from simulator import Get5Server, PluginSimulator, client_poster
+
+
+class SimulatorTests(get5_test.Get5Test):
+
+    def setUp(self):
+        super(SimulatorTests, self).setUp()
+        rcon.pool.close_all()
+        self.servers = []
+
+    def tearDown(self):
+        rcon.pool.close_all()
+        for server in self.servers:
+            server.stop()
+        get5.app.config.pop('GET5_URL_OVERRIDE', None)
+        super(SimulatorTests, self).tearDown()
+
+    def start_server(self, **kwargs):
+        # Configs are fetched through the test client instead of over http
+        client = get5.app.test_client()
+
+        def fetch_config(url):
+            response = client.get(urlparse.urlparse(url).path)
+            return json.loads(response.data)
+
+        server = Get5Server(password='password', fetch_config=fetch_config,
+                            **kwargs)
+        self.servers.append(server)
+
+        game_server = GameServer.query.get(1)
+        game_server.port = server.port
+        db.session.commit()
+        return server
+
+    def test_play_match(self):
+        server = self.start_server()
+        game_server = GameServer.query.get(1)
+        self.assertEqual(util.check_server_avaliability(game_server),
+                         ({'gamestate': 0, 'available': 1,
+                           'plugin_version': '0.5.0'}, ''))
+
+        get5.app.config['GET5_URL_OVERRIDE'] = 'localhost'
+        match = Match.query.get(1)
+        self.assertTrue(match.send_to_server())
+        self.assertEqual(server.match_config['matchid'], '1')
+        self.assertEqual(server.api_key, match.api_key)
+        self.assertEqual(util.check_server_avaliability(game_server),
+                         (None, 'Server already has a get5 match setup'))
+
+        simulator = PluginSimulator(server, post=client_poster(self.app),
+                                    rounds_to_win=3, seed=1)
+        statuses = [status for status, _ in simulator.play()]
+        self.assertEqual(set(statuses), set([200]))
+
+        match = Match.query.get(1)
+        self.assertTrue(match.finished())
+        map_stats = MapStats.query.filter_by(match_id=1).one()
+        self.assertEqual(max(map_stats.team1_score, map_stats.team2_score), 3)
+        player_stats = PlayerStats.query.filter_by(map_id=map_stats.id).one()
+        self.assertEqual(player_stats.roundsplayed,
+                         map_stats.team1_score + map_stats.team2_score)
+        self.assertEqual(server.gamestate, 0)
+
+    def test_bulk_players(self):
+        server = self.start_server()
+        get5.app.config['GET5_URL_OVERRIDE'] = 'localhost'
+        match = Match.query.get(1)
+        match.max_maps = 3
+        db.session.commit()
+        self.assertTrue(match.send_to_server())
+
+        simulator = PluginSimulator(server, post=client_poster(self.app),
+                                    rounds_to_win=2, bulk_players=True, seed=2)
+        statuses = [status for status, _ in simulator.play()]
+        self.assertEqual(set(statuses), set([200]))
+        self.assertTrue(Match.query.get(1).finished())
+        self.assertIn(MapStats.query.filter_by(match_id=1).count(), [2, 3])
+
+    def test_admin_tools(self):
+        server = self.start_server()
+        get5.app.config['GET5_URL_OVERRIDE'] = 'localhost'
+        self.assertTrue(Match.query.get(1).send_to_server())
+
+        with self.app as c:
+            with c.session_transaction() as sess:
+                sess['user_id'] = 1
+            c.get('/match/1/backup')
+            c.get('/match/1/backup?file=get5_backup_match1_map0_round0.cfg')
+            c.get('/match/1/adduser?team=team2&auth=76561198053858674')
+            c.get('/match/1/cancel')
+        self.assertEqual(jobs.run_pending(), 4)
+
+        results = [job.to_dict() for job in RconJob.query.order_by(RconJob.id)]
+        self.assertEqual([r['responses'] for r in results], [
+            ['get5_backup_match1_map0_round0.cfg'],
+            ['Restored backup get5_backup_match1_map0_round0.cfg'],
+            ['Added player 76561198053858674 to team2'],
+            [''],
+        ])
+        self.assertEqual(server.gamestate, 0)
+
+    def test_failure_injection(self):
+        server = self.start_server(failure_rate=1.0)
+        self.assertEqual(util.send_rcon_command(
+            '127.0.0.1', server.port, 'password', 'status', num_retries=1), None)
+        self.assertEqual(server.commands, ['status'])
+
+        server.failure_rate = 0
+        server.latency = 0.05
+        start = time.time()
+        self.assertEqual(util.send_rcon_command(
+            '127.0.0.1', server.port, 'password', 'status'),
+            'hostname: get5 simulator\nmap     : de_dust2')
+        # One reply for the login and one for the command
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
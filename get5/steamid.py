@@ -1,92 +1,276 @@
-from valve.steam.id import SteamID, SteamIDError
-
-import json
+import collections
 import re
+import threading
+import time
 import urllib
-import urllib2
-from xml.dom import minidom
-from xml.parsers.expat import ExpatError
+import urlparse
 
+import requests
 
-def steam2_to_steam64(steam2):
+# Individual accounts: steam64 = STEAM64_BASE + 2 * Z + Y for STEAM_X:Y:Z,
+# and STEAM64_BASE + W for [U:1:W].
+STEAM64_BASE = 0x0110000100000000
+MAX_ACCOUNT_NUMBER = 2 ** 32 - 1
+
+_steam2_re = re.compile(r'^STEAM_([0-5]):([01]):(\d+)$')
+_fast_auth_re = re.compile(r'^(?:STEAM_[0-5]:([01]):(\d+)|\[U:1:(\d+)\])$')
+_profile_url_re = re.compile(r'/profiles/(?:(\d+)|\[U:1:(\d+)\])$')
+
+# The profile xml is only searched for the steamID64 element, which comes
+# first in it, so the rest of the (large) document is never downloaded.
+_steam64_re = re.compile(r'<steamID64>\s*(\d+)\s*</steamID64>')
+_profile_end_re = re.compile(r'</steamID64>|</profile>|</response>')
+_custom_url_re = re.compile(r'steamcommunity\.com/id/([^/?#]+)', re.IGNORECASE)
+
+
+class SteamLookupError(Exception):
+    pass
+
+
+def _account_to_steam64(w):
+    # w is 2 * Z + Y, the account number and instance bit together
+    if w < 0 or w > 2 * MAX_ACCOUNT_NUMBER + 1:
+        return None
+    return str(STEAM64_BASE + w)
+
+
+def _steam2_to_steam64(steam2):
+    match = _steam2_re.match(steam2)
+    if match is None:
+        return None
+    return _account_to_steam64(2 * int(match.group(3)) + int(match.group(2)))
+
+
+def _steam3_to_steam64(steam3):
+    if '[U:1:' not in steam3:
+        return None
     try:
-        return True, SteamID.from_text(steam2).as_64()
-    except SteamIDError:
-        return False, ''
+        w = int(steam3[5: len(steam3) - 1])
+    except ValueError:
+        return None
+    if w == 0:
+        return None
+    return _account_to_steam64(w)
+
+
+def _profile_url_to_steam64(url):
+    match = _profile_url_re.search(urlparse.urlparse(url.rstrip('/')).path)
+    if match is None:
+        return None
+    if match.group(2) is not None:
+        return _account_to_steam64(int(match.group(2)))
+    return _account_to_steam64(int(match.group(1)) - STEAM64_BASE)
+
+
+def steam2_to_steam64(steam2):
+    steam64 = _steam2_to_steam64(steam2)
+    return steam64 is not None, steam64 or ''
 
 
 def steam3_to_steam2(steam3):
-    if '[U:1:' not in steam3:
+    steam64 = _steam3_to_steam64(steam3)
+    if steam64 is None:
         return False, ''
+    return steam64_to_steam2(steam64)
+
 
+def steam64_to_steam2(steam64):
     try:
-        x = int(steam3[5: len(steam3) - 1])
+        w = int(steam64) - STEAM64_BASE
     except ValueError:
         return False, ''
-
-    if x == 0:
+    if _account_to_steam64(w) is None:
         return False, ''
-
-    a = x % 2
-    b = (x - a) / 2
-    steam2 = 'STEAM_0:{}:{}'.format(a, b)
-    return True, steam2
+    return True, 'STEAM_0:{}:{}'.format(w & 1, w >> 1)
 
 
-def steam64_from_dom(dom):
-    elements = dom.getElementsByTagName('steamID64')
-    if len(elements) >= 1:
-        return True, str(elements[0].firstChild.data)
-    else:
+def steam64_to_steam3(steam64):
+    try:
+        w = int(steam64) - STEAM64_BASE
+    except ValueError:
         return False, ''
+    if _account_to_steam64(w) is None:
+        return False, ''
+    return True, '[U:1:{}]'.format(w)
 
 
-def custom_url_to_steam3(url):
-    if '?xml=1' not in url:
-        url += '?xml=1'
+def fetch_custom_name_steam64(name, base_url='http://steamcommunity.com',
+                              timeout=10):
+    """Returns the steam64 of a custom profile name, None if there is none.
 
+    Raises SteamLookupError when the profile could not be fetched.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    url = '{}/id/{}/'.format(base_url.rstrip('/'), urllib.quote(name, safe=''))
     try:
-        dom = minidom.parse(urllib2.urlopen(url))
-    except ExpatError:
-        return False, ''
+        response = requests.get(url, params={'xml': 1}, timeout=timeout,
+                                stream=True)
+        try:
+            response.raise_for_status()
+            data = ''
+            for chunk in response.iter_content(chunk_size=1024):
+                data += chunk
+                if _profile_end_re.search(data):
+                    break
+        finally:
+            response.close()
+    except requests.RequestException as e:
+        raise SteamLookupError(str(e))
 
-    return steam64_from_dom(dom)
+    match = _steam64_re.search(data)
+    return match.group(1) if match else None
 
 
-def custom_name_to_steam3(name):
-    url = re.sub("{USER}", name, 'http://steamcommunity.com/id/{USER}/?xml=1')
-    return custom_url_to_steam3(url)
+def custom_name_to_steam3(name, timeout=10):
+    # Results are cached, names without a profile for a shorter time. Failed
+    # lookups are not cached at all.
+    from get5 import cache, config_setting
+    name = name.strip()
+    if not name:
+        return False, ''
+    key = 'steam_custom_name_{}'.format(name.lower().encode('utf-8').encode('hex'))
+    steam64 = cache.get(key)
+    if steam64 is None:
+        try:
+            steam64 = fetch_custom_name_steam64(
+                name, config_setting('STEAM_COMMUNITY_URL'), timeout) or ''
+        except SteamLookupError:
+            return False, ''
+        cache.set(key, steam64, timeout=config_setting(
+            'STEAM_CUSTOM_NAME_TTL' if steam64 else 'STEAM_NAME_NEGATIVE_TTL'))
+    return bool(steam64), steam64
 
 
-def auth_to_steam64(auth):
+def custom_url_to_steam3(url, timeout=10):
+    match = _custom_url_re.search(url)
+    if not match:
+        return False, ''
+    return custom_name_to_steam3(urllib.unquote(match.group(1)), timeout)
+
+
+def needs_lookup(auth):
+    # Whether auth_to_steam64 has to ask Steam for auth
     auth = auth.strip()
     if 'steamcommunity.com/id/' in auth:
-        return custom_url_to_steam3(auth)
+        return True
+    return not ('steamcommunity.com/profiles/' in auth or
+                auth.startswith('1:0:') or auth.startswith('1:1') or
+                auth.startswith('STEAM_') or auth.startswith('[U:1:') or
+                (auth.startswith('7656119') and 'steam' not in auth))
 
-    elif 'steamcommunity.com/profiles/' in auth:
-        try:
-            return True, SteamID.from_community_url(auth.rstrip('/')).as_64()
-        except SteamIDError:
-            return False, ''
 
-    elif auth.startswith('1:0:') or auth.startswith('1:1'):
-        return steam2_to_steam64('STEAM_' + auth)
+def convert(auth):
+    """Returns the steam64 of a steam2, steam3, steam64 or profile url auth.
 
+    Returns None if auth is invalid or a custom name, see needs_lookup.
+    """
+    auth = auth.strip()
+    if 'steamcommunity.com/id/' in auth:
+        return None
+    elif 'steamcommunity.com/profiles/' in auth:
+        return _profile_url_to_steam64(auth)
+    elif auth.startswith('1:0:') or auth.startswith('1:1'):
+        return _steam2_to_steam64('STEAM_' + auth)
     elif auth.startswith('STEAM_'):
-        return steam2_to_steam64(auth)
-
+        return _steam2_to_steam64(auth)
     elif auth.startswith('7656119') and 'steam' not in auth:
-        return True, auth
-
+        return auth
     elif auth.startswith('[U:1:'):
-        suc, steam2 = steam3_to_steam2(auth)
-        if suc:
-            return steam2_to_steam64(steam2)
-        else:
-            return False, ''
+        return _steam3_to_steam64(auth)
+    return None
+
+
+def convert_many(auths):
+    """Converts many auths at once without asking Steam, e.g. a csv import.
 
-    else:
-        return custom_name_to_steam3(auth)
+    Returns a list of steam64s in the order of auths, with None for invalid
+    auths and for custom names. Repeated auths are only converted once.
+    """
+    converted = {}
+    rv = []
+    append = rv.append
+    fast_match = _fast_auth_re.match
+    base = STEAM64_BASE
+    max_w = 2 * MAX_ACCOUNT_NUMBER + 1
+    for auth in auths:
+        steam64 = converted.get(auth, False)
+        if steam64 is False:
+            # The usual steam2 and steam3 forms skip convert's dispatch
+            match = auth and fast_match(auth)
+            if not match:
+                steam64 = convert(auth) if auth else None
+            else:
+                y, z, w = match.groups()
+                w = 2 * int(z) + int(y) if w is None else int(w)
+                steam64 = str(base + w) if 0 < w <= max_w else convert(auth)
+            converted[auth] = steam64
+        append(steam64)
+    return rv
+
+
+def auth_to_steam64(auth, timeout=10):
+    auth = auth.strip()
+    if 'steamcommunity.com/id/' in auth:
+        return custom_url_to_steam3(auth, timeout)
+    elif needs_lookup(auth):
+        return custom_name_to_steam3(auth, timeout)
+
+    steam64 = convert(auth)
+    return steam64 is not None, steam64 or ''
+
+
+def auth_to_steam64_many(auths, deadline=5.0, max_workers=4):
+    """Converts many auths at once, e.g. the players of a team.
+
+    Custom names and urls are looked up by up to max_workers threads at the
+    same time. Returns a dict of auth -> (success, steam64); auths whose
+    lookup did not finish before the deadline (in seconds) are left out.
+    """
+    from get5 import app
+    auths = set(auths)
+    lookups = [auth for auth in auths if needs_lookup(auth)]
+    offline = [auth for auth in auths if not needs_lookup(auth)]
+    results = dict((auth, (steam64 is not None, steam64 or ''))
+                   for auth, steam64 in zip(offline, convert_many(offline)))
+    if not lookups:
+        return results
+
+    end_time = time.time() + deadline
+    pending = collections.deque(lookups)
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            with done:
+                if not pending:
+                    return
+                auth = pending.popleft()
+
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return
+            try:
+                with app.app_context():
+                    result = auth_to_steam64(auth, timeout=max(remaining, 0.1))
+            except Exception:
+                result = (False, '')
+            with done:
+                results[auth] = result
+                done.notify()
+
+    for _ in range(min(max_workers, len(lookups))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    with done:
+        while any(auth not in results for auth in lookups):
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            done.wait(remaining)
+        return dict(results)
 
 
 def is_valid_steamid(auth):
@@ -94,12 +278,28 @@ def is_valid_steamid(auth):
     return valid
 
 
-def get_steam_userinfo(steamid, api_key):
-    options = {
-        'key': api_key,
-        'steamids': steamid,
-    }
-    url = 'http://api.steampowered.com/ISteamUser/' \
-          'GetPlayerSummaries/v0001/?%s' % urllib.urlencode(options)
-    rv = json.load(urllib2.urlopen(url))
-    return rv['response']['players']['player'][0] or {}
+def get_player_summaries(steam64s, api_key, base_url='http://api.steampowered.com',
+                         timeout=10):
+    """Returns a dict of steam64 -> GetPlayerSummaries entry.
+
+    The api takes up to 100 ids per call. Unknown profiles are left out,
+    the ids of calls that failed map to None.
+    """
+    steam64s = sorted(set(str(s) for s in steam64s if s))
+    url = base_url.rstrip('/') + '/ISteamUser/GetPlayerSummaries/v0002/'
+    rv = {}
+    for i in range(0, len(steam64s), 100):
+        chunk = steam64s[i:i + 100]
+        try:
+            response = requests.get(url, timeout=timeout, params={
+                'key': api_key,
+                'steamids': ','.join(chunk),
+            })
+            response.raise_for_status()
+            players = response.json()['response']['players']
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            rv.update((steam64, None) for steam64 in chunk)
+            continue
+        for player in players:
+            rv[str(player.get('steamid'))] = player
+    return rv
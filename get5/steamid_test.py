@@ -1,7 +1,11 @@
+import random
 import unittest
 
-import steamid
+import get5
 import get5_test
+import simulator
+import steamid
+from get5 import cache
 
 
 class SteamIdTests(get5_test.Get5Test):
@@ -67,6 +71,109 @@ class SteamIdTests(get5_test.Get5Test):
         self.assertTrue(suc)
         self.assertEqual(actual, expected)
 
+    def test_conversion_properties(self):
+        from valve.steam.id import SteamID
+
+        rand = random.Random(5)
+        accounts = [0, 1, steamid.MAX_ACCOUNT_NUMBER] + [
+            rand.randint(0, steamid.MAX_ACCOUNT_NUMBER) for _ in range(500)]
+        for z in accounts:
+            for y in (0, 1):
+                expected = SteamID(z, y, 1, 0).as_64()
+                auths = ['STEAM_0:{}:{}'.format(y, z),
+                         'STEAM_1:{}:{}'.format(y, z),
+                         ' 1:{}:{} '.format(y, z),
+                         'https://steamcommunity.com/profiles/{}/'.format(expected),
+                         'steamcommunity.com/profiles/[U:1:{}]'.format(2 * z + y)]
+                if expected.startswith('7656119'):
+                    # Larger ones are taken for custom names
+                    auths.append(expected)
+                if z or y:
+                    auths.append('[U:1:{}]'.format(2 * z + y))
+                for auth in auths:
+                    self.assertEqual(steamid.auth_to_steam64(auth), (True, expected))
+                self.assertEqual(steamid.convert_many(auths), [expected] * len(auths))
+
+                self.assertEqual(steamid.steam64_to_steam2(expected),
+                                 (True, 'STEAM_0:{}:{}'.format(y, z)))
+                self.assertEqual(steamid.steam64_to_steam3(expected),
+                                 (True, '[U:1:{}]'.format(2 * z + y)))
+
+        invalid = ['STEAM_0:2:1', 'STEAM_6:0:1', 'STEAM_0:1:-1',
+                   'STEAM_0:0:{}'.format(steamid.MAX_ACCOUNT_NUMBER + 1),
+                   '[U:1:0]', '[U:1:abc]', '[U:1:{}]'.format(2 ** 33),
+                   'steamcommunity.com/profiles/1234', '1:2:3']
+        for auth in invalid:
+            self.assertEqual(steamid.auth_to_steam64(auth), (False, ''))
+        self.assertEqual(steamid.convert_many(invalid), [None] * len(invalid))
+        self.assertEqual(steamid.steam64_to_steam2('1234'), (False, ''))
+
+    def test_convert_many(self):
+        # The offline cases of test_auth_to_steam64
+        auths = ['STEAM_0:1:52245092', 'STEAM_1:1:52245092',
+                 '76561198064755913', '1:1:52245092', '[U:1:104490185]',
+                 'steamcommunity.com/profiles/76561198064755913',
+                 'http://steamcommunity.com/profiles/76561198064755913',
+                 'http://steamcommunity.com/profiles/76561198064755913/']
+        for auth in auths:
+            self.assertFalse(steamid.needs_lookup(auth))
+        self.assertEqual(steamid.convert_many(auths * 100),
+                         ['76561198064755913'] * len(auths) * 100)
+
+        # Custom names are left to auth_to_steam64
+        self.assertEqual(steamid.convert_many(
+            ['splewis', 'http://steamcommunity.com/id/splewis', '', None]),
+            [None] * 4)
+
+    def test_custom_names(self):
+        steam_api = simulator.FakeSteamApi(
+            custom_names={'splewis': '76561198064755913'})
+        get5.app.config['STEAM_COMMUNITY_URL'] = steam_api.url
+        try:
+            self.assertEqual(
+                steamid.auth_to_steam64('https://steamcommunity.com/id/splewis/'),
+                (True, '76561198064755913'))
+            self.assertEqual(steamid.auth_to_steam64('SPLEWIS'),
+                             (True, '76561198064755913'))
+            self.assertEqual(steamid.auth_to_steam64('nobody'), (False, ''))
+            self.assertEqual(steamid.auth_to_steam64('nobody'), (False, ''))
+            self.assertEqual(steam_api.custom_name_requests, ['splewis', 'nobody'])
+
+            # Failed lookups are tried again
+            steam_api.stop()
+            self.assertEqual(steamid.auth_to_steam64('other'), (False, ''))
+            self.assertIsNone(cache.get('steam_custom_name_{}'.format(
+                'other'.encode('hex'))))
+        finally:
+            get5.app.config.pop('STEAM_COMMUNITY_URL', None)
+            steam_api.stop()
+
+    def test_auth_to_steam64_many(self):
+        steam_api = simulator.FakeSteamApi(latency=0.5, custom_names={
+            'a': '76561198000000001', 'b': '76561198000000002'})
+        get5.app.config['STEAM_COMMUNITY_URL'] = steam_api.url
+        try:
+            results = steamid.auth_to_steam64_many(
+                ['a', 'b', 'STEAM_0:1:52245092'], deadline=0.2)
+            self.assertEqual(results, {
+                'STEAM_0:1:52245092': (True, '76561198064755913')})
+
+            results = steamid.auth_to_steam64_many(['a', 'b', 'c'], deadline=2)
+            self.assertEqual(results, {
+                'a': (True, '76561198000000001'),
+                'b': (True, '76561198000000002'),
+                'c': (False, ''),
+            })
+
+            # Only max_workers of them are looked up at the same time, one
+            # after another they don't all fit in the deadline
+            results = steamid.auth_to_steam64_many(
+                ['d', 'e', 'f'], deadline=0.8, max_workers=1)
+            self.assertLess(len(results), 3)
+        finally:
+            get5.app.config.pop('STEAM_COMMUNITY_URL', None)
+            steam_api.stop()
+
 
 if __name__ == '__main__':
     unittest.main()
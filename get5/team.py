@@ -1,5 +1,5 @@
 from get5 import app, db, flash_errors, config_setting
-from models import User, Team
+from models import User, Team, get_steam_names
 
 import countries
 import logos
@@ -21,8 +21,15 @@ def valid_auth(form, field):
     if field.data is None or field.data == '':
         return
 
-    # Otherwise validate and coerce to steam64
-    suc, newauth = steamid.auth_to_steam64(field.data)
+    # Otherwise validate and coerce to steam64, using the form's lookups
+    resolved = getattr(form, 'resolved_auths', None)
+    if resolved is None:
+        suc, newauth = steamid.auth_to_steam64(field.data)
+    elif field.data in resolved:
+        suc, newauth = resolved[field.data]
+    else:
+        raise ValidationError('Steam did not respond in time')
+
     if suc:
         field.data = newauth
     else:
@@ -53,6 +60,16 @@ class TeamForm(Form):
     auth7 = StringField('Player 7', validators=[valid_auth])
     public_team = BooleanField('Public Team')
 
+    def validate(self):
+        # The players' custom profile names are looked up at the same time
+        # rather than one field after another
+        auths = [self['auth{}'.format(i)].data for i in range(1, 8)]
+        self.resolved_auths = steamid.auth_to_steam64_many(
+            [auth for auth in auths if auth],
+            deadline=config_setting('STEAM_LOOKUP_DEADLINE'),
+            max_workers=config_setting('STEAM_LOOKUP_WORKERS'))
+        return Form.validate(self)
+
     def get_auth_list(self):
         auths = []
         for i in range(1, 8):
@@ -142,7 +159,9 @@ def team_edit(teamid):
                 team.set_data(data['name'], data['tag'], data['country_flag'],
                               data['logo'], form.get_auth_list(),
                               public_team)
+                team.clear_match_configs()
                 db.session.commit()
+                team.invalidate_match_pages()
                 return redirect('/teams/{}'.format(team.user_id))
             else:
                 flash_errors(form)
@@ -158,6 +177,7 @@ def team_delete(teamid):
     if not team.can_delete(g.user):
         return 'Cannot delete this team', 400
 
+    team.invalidate_match_pages()
     if Team.query.filter_by(id=teamid).delete():
         db.session.commit()
 
@@ -171,14 +191,21 @@ def teams_user(userid):
     json_data = util.as_int(request.values.get('json'), on_fail=0)
 
     if json_data:
+        teams = user.teams.all()
+        # The names of every team's players are looked up together
+        names = get_steam_names(
+            [auth for team in teams for auth in team.auths if auth])
+
         teams_dict = {}
-        for team in user.teams:
+        for team in teams:
             team_dict = {}
             team_dict['name'] = team.name
             team_dict['tag'] = team.tag
             team_dict['flag'] = team.flag
             team_dict['logo'] = team.logo
             team_dict['players'] = filter(lambda x: bool(x), team.auths)
+            team_dict['player_names'] = dict(
+                (auth, names.get(str(auth)) or '') for auth in team_dict['players'])
             teams_dict[team.id] = team_dict
         return jsonify(teams_dict)
 
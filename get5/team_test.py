@@ -1,9 +1,16 @@
+import datetime
+import json
+import time
 import unittest
 
 from flask import url_for
 
+import get5
 import get5_test
-from models import User, Team
+import models
+import simulator
+from get5 import db
+from models import User, Team, MapStats, PlayerStats, Player, get_steam_names
 
 
 class TeamTests(get5_test.Get5Test):
@@ -164,6 +171,174 @@ class TeamTests(get5_test.Get5Test):
         self.assertEqual(team.public_team, True)
         self.assertTrue(team in User.query.get(1).teams)
 
+    def test_player_names(self):
+        steam64s = [str(76561198000000000 + i) for i in range(300)]
+        steam_api = simulator.FakeSteamApi(profiles=dict(
+            (s, {'personaname': 'player' + s[-3:]}) for s in steam64s[:250]))
+        get5.app.config['STEAM_API_URL'] = steam_api.url
+        try:
+            team = Team.create(User.query.get(1), 'Roster', 'R', '', '',
+                               steam64s[:7])
+            db.session.commit()
+
+            # A whole roster takes a single api call in the background, the
+            # names are shown once it is done and no call is made after that
+            response = self.app.get('/team/{}'.format(team.id))
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('player006', response.data)
+            self.assertEqual(steam_api.requests, [sorted(steam64s[:7])])
+            self.assertIn('player006', self.app.get('/team/{}'.format(team.id)).data)
+            self.assertEqual(len(steam_api.requests), 1)
+
+            # Up to 100 players per call
+            get_steam_names(steam64s)
+            names = get_steam_names(steam64s)
+            self.assertEqual(names[steam64s[0]], 'player000')
+            self.assertEqual(names[steam64s[249]], 'player249')
+            self.assertIsNone(names[steam64s[299]])
+            self.assertEqual([len(r) for r in steam_api.requests], [7, 100, 100, 93])
+
+            # The json export names every team's players at once
+            del steam_api.requests[:]
+            teams = json.loads(self.app.get('/teams/1?json=1').data)
+            self.assertEqual(teams[str(team.id)]['player_names'][steam64s[3]],
+                             'player003')
+            self.assertEqual(len(steam_api.requests), 1)
+        finally:
+            get5.app.config.pop('STEAM_API_URL', None)
+            steam_api.stop()
+
+    def test_player_refresh(self):
+        steam64s = [str(76561198000000000 + i) for i in range(3)]
+        steam_api = simulator.FakeSteamApi(profiles={
+            steam64s[0]: {'personaname': 'old name', 'avatarmedium': 'a.jpg'},
+        })
+        get5.app.config['STEAM_API_URL'] = steam_api.url
+
+        def set_refreshed(steam64, seconds_ago):
+            # Ages the row, and drops the cached names so the row is read
+            Player.query.get(steam64).last_refreshed = \
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=seconds_ago)
+            db.session.commit()
+            models._steam_names.clear()
+            get5.cache.clear()
+
+        try:
+            self.assertEqual(get_steam_names(steam64s[:2]),
+                             {steam64s[0]: None, steam64s[1]: None})
+            self.assertEqual(get_steam_names(steam64s[:2]),
+                             {steam64s[0]: 'old name', steam64s[1]: None})
+            self.assertEqual(Player.query.get(steam64s[0]).avatar, 'a.jpg')
+            self.assertEqual(Player.stale(), [])
+
+            # Unknown steamids are remembered in the shared cache as well
+            models._steam_names.clear()
+            self.assertIsNone(get_steam_names(steam64s[1:2])[steam64s[1]])
+            self.assertEqual(len(steam_api.requests), 1)
+
+            # A stale name is shown once more while it is refetched
+            steam_api.profiles[steam64s[0]]['personaname'] = 'new name'
+            set_refreshed(steam64s[0], get5.config_setting('STEAM_NAME_TTL') + 1)
+            self.assertEqual(get_steam_names(steam64s[:1]), {steam64s[0]: 'old name'})
+            self.assertEqual(get_steam_names(steam64s[:1]), {steam64s[0]: 'new name'})
+            self.assertEqual(len(steam_api.requests), 2)
+
+            # refresh_players fetches unknown ones again sooner
+            set_refreshed(steam64s[1], get5.config_setting('STEAM_NAME_NEGATIVE_TTL') + 1)
+            self.assertEqual([p.steam_id for p in Player.stale()], steam64s[1:2])
+            Player.refresh(steam64s[1:2])
+            db.session.commit()
+            self.assertEqual(Player.stale(), [])
+
+            # Players seen in match stats get a row, without an api call
+            map_stats = MapStats.get_or_create(1, 0, 'de_dust2')
+            db.session.commit()
+            db.session.add(PlayerStats(match_id=1, map_id=map_stats.id,
+                                       team_id=1, steam_id=steam64s[2],
+                                       name='ingame', roundsplayed=1))
+            db.session.commit()
+            self.assertIn('ingame', self.app.get('/match/1').data)
+            self.assertEqual(Player.add_missing(), 1)
+            db.session.commit()
+
+            # Failed api calls leave the row to the next refresh
+            steam_api.stop()
+            self.assertEqual([p.steam_id for p in Player.stale()], steam64s[2:])
+            Player.refresh(steam64s[2:])
+            db.session.commit()
+            self.assertEqual([p.steam_id for p in Player.stale()], steam64s[2:])
+
+            # A name that could not be refreshed for too long isn't shown
+            set_refreshed(steam64s[0], get5.config_setting('STEAM_NAME_MAX_AGE') + 1)
+            self.assertEqual(get_steam_names(steam64s[:1]), {steam64s[0]: None})
+            self.assertEqual(Player.query.get(steam64s[0]).name, 'new name')
+        finally:
+            get5.app.config.pop('STEAM_API_URL', None)
+            steam_api.stop()
+
+    def test_player_names_keep_session(self):
+        steam64 = '76561198000000001'
+        steam_api = simulator.FakeSteamApi(
+            profiles={steam64: {'personaname': 'newcomer'}})
+        get5.app.config['STEAM_API_URL'] = steam_api.url
+        try:
+            # As on a first login: the new user is still pending while the
+            # name is fetched, and stays so
+            user = User.get_or_create(steam64)
+            self.assertEqual(get_steam_names([steam64]), {steam64: None})
+            self.assertEqual(get_steam_names([steam64]), {steam64: 'newcomer'})
+            self.assertIn(user, db.session.new)
+            db.session.rollback()
+            self.assertIsNone(User.query.filter_by(steam_id=steam64).first())
+            self.assertEqual(Player.query.get(steam64).name, 'newcomer')
+        finally:
+            get5.app.config.pop('STEAM_API_URL', None)
+            steam_api.stop()
+
+    def test_team_create_custom_names(self):
+        names = ['player{}'.format(i) for i in range(1, 8)]
+        steam_api = simulator.FakeSteamApi(latency=0.3, custom_names=dict(
+            (name, str(76561198000000000 + i)) for i, name in enumerate(names[:6])))
+        get5.app.config['STEAM_COMMUNITY_URL'] = steam_api.url
+        data = {'name': 'Vanity', 'tag': 'V'}
+        for i, name in enumerate(names[:6]):
+            data['auth{}'.format(i + 1)] = name
+        data['auth2'] = 'steamcommunity.com/id/PLAYER2/'
+        try:
+            with self.app as c:
+                with c.session_transaction() as sess:
+                    sess['user_id'] = 1
+
+                # The whole roster is looked up in about one request's time
+                start = time.time()
+                response = c.post('/team/create', data=data)
+                self.assertEqual(response.status_code, 302)
+                self.assertLess(time.time() - start, 1.2)
+                team = Team.query.filter_by(name='Vanity').first()
+                self.assertEqual(team.auths[:6], [
+                    str(76561198000000000 + i) for i in range(6)])
+                self.assertEqual(len(steam_api.custom_name_requests), 6)
+
+                # Names are cached, unknown ones as well
+                data['name'] = 'Vanity 2'
+                data['auth7'] = names[6]
+                response = c.post('/team/create', data=data)
+                self.assertEqual(response.status_code, 200)
+                response = c.post('/team/create', data=data)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(steam_api.custom_name_requests[6:], [names[6]])
+
+                # Lookups that miss the deadline fail the form
+                del data['auth7']
+                data['auth1'] = 'slowplayer'
+                get5.app.config['STEAM_LOOKUP_DEADLINE'] = 0.1
+                response = c.post('/team/create', data=data)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Steam did not respond in time', response.data)
+        finally:
+            get5.app.config.pop('STEAM_COMMUNITY_URL', None)
+            get5.app.config.pop('STEAM_LOOKUP_DEADLINE', None)
+            steam_api.stop()
 
 if __name__ == '__main__':
     unittest.main()
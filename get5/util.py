@@ -1,6 +1,11 @@
+import collections
+import gzip
 import os
 import socket
 import subprocess
+import threading
+import time
+from cStringIO import StringIO
 
 
 def as_int(val, on_fail=0):
@@ -8,10 +13,65 @@ def as_int(val, on_fail=0):
         return on_fail
     try:
         return int(val)
-    except ValueError:
+    except (TypeError, ValueError):
         return on_fail
 
 
+class TTLCache(object):
+    """A small thread-safe, process-local cache.
+
+    Entries expire after timeout seconds and the least recently used entry is
+    evicted once more than maxsize are stored.
+    """
+
+    def __init__(self, maxsize=1000, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires < time.time():
+                return default
+
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + timeout)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def gzip_bytes(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
 def format_mapname(mapname):
     formatted_names = {
         'de_cbble': 'Cobblestone',
@@ -34,17 +94,20 @@ def check_server_connection(server):
 
 
 def check_server_avaliability(server):
-    import json
-
     if not server:
         return None, 'Server not found'
 
     response = send_rcon_command(
         server.ip_string, server.port, server.rcon_password, 'get5_web_available')
+    return parse_server_avaliability(response)
 
+
+def parse_server_avaliability(response):
+    import json
+
+    json_error = False
+    already_live = False
     if response:
-        json_error = False
-        already_live = False
         try:
             json_reply = json.loads(response)
             already_live = json_reply['gamestate'] != 0
@@ -60,7 +123,7 @@ def check_server_avaliability(server):
     elif already_live:
         return None, 'Server already has a get5 match setup'
 
-    elif json_error:
+    elif json_error or not response:
         return None, 'Error reading get5_web_available response'
 
     else:
@@ -73,21 +136,43 @@ class RconError(ValueError):
 
 def send_rcon_command(host, port, rcon_password, command,
                       raise_errors=False, num_retries=3, timeout=3.0):
-    from valve.source.rcon import (RCON, IncompleteMessageError,
+    responses = send_rcon_commands(host, port, rcon_password, [command],
+                                   raise_errors, num_retries, timeout)
+    if responses is None:
+        return None
+    return responses[0]
+
+
+def send_rcon_commands(host, port, rcon_password, commands,
+                       raise_errors=False, num_retries=3, timeout=3.0):
+    # Sends the commands in order over one rcon session and returns the
+    # list of their responses.
+    from valve.source.rcon import (IncompleteMessageError,
                                    AuthenticationError, NoResponseError)
+    import rcon
 
     try:
         port = int(port)
     except ValueError:
         return None
 
+    try:
+        breaker_state, probe = rcon.breaker.before_send(host, port)
+    except RconError:
+        if raise_errors:
+            raise
+        return None
+    if probe:
+        num_retries = 1
+
     attempts = 0
     while attempts < num_retries:
         attempts += 1
         try:
-            with RCON((host, port), rcon_password, timeout=timeout) as rcon:
-                response = rcon(command)
-                return strip_rcon_logline(response)
+            responses = rcon.pool.execute_many(
+                host, port, rcon_password, commands, timeout=timeout)
+            rcon.breaker.succeeded(host, port, breaker_state)
+            return [strip_rcon_logline(r) for r in responses]
 
         except KeyError:
             # There seems to be a bug in python-vavle where a wrong password
@@ -98,12 +183,74 @@ def send_rcon_command(host, port, rcon_password, command,
         except (socket.error, socket.timeout,
                 IncompleteMessageError, AuthenticationError, NoResponseError) as e:
             if attempts >= num_retries:
+                rcon.breaker.failed(host, port, breaker_state)
                 if raise_errors:
                     raise RconError(str(e))
                 else:
                     return None
 
 
+def send_rcon_command_many(targets, command, deadline=10.0, max_workers=16,
+                           num_retries=1, timeout=3.0):
+    """Sends command to many servers at once.
+
+    targets is a list of (key, host, port, rcon_password) tuples. Returns a
+    dict of key -> (response, error), servers that did not answer before the
+    deadline (in seconds) get a timeout error instead of blocking the caller.
+    """
+    end_time = time.time() + deadline
+    pending = collections.deque(targets)
+    results = {}
+    done = threading.Condition()
+
+    def worker():
+        while True:
+            with done:
+                if not pending:
+                    return
+                key, host, port, rcon_password = pending.popleft()
+
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return
+            try:
+                response = send_rcon_command(
+                    host, port, rcon_password, command, raise_errors=True,
+                    num_retries=num_retries, timeout=min(timeout, remaining))
+                if response is None:
+                    result = (None, 'Invalid port')
+                else:
+                    result = (response, '')
+            except RconError as e:
+                result = (None, str(e) or 'Failed to connect to server')
+            except Exception:
+                result = (None, 'Failed to connect to server')
+
+            with done:
+                results[key] = result
+                done.notify()
+
+    for _ in range(min(max_workers, len(targets))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    with done:
+        while len(results) < len(targets):
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            done.wait(remaining)
+
+        pending.clear()
+        rv = dict(results)
+
+    for key, _, _, _ in targets:
+        if key not in rv:
+            rv[key] = (None, 'Timed out')
+    return rv
+
+
 def strip_rcon_logline(response):
     lines = response.splitlines()
     if len(lines) >= 1:
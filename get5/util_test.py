@@ -9,6 +9,8 @@ class UtilTest(get5_test.Get5Test):
     def test_as_int(self):
         self.assertEqual(util.as_int('abcdef'), 0)
         self.assertEqual(util.as_int('3'), 3)
+        self.assertEqual(util.as_int([1]), 0)
+        self.assertEqual(util.as_int({}, on_fail=-1), -1)
 
     def test_format_mapname(self):
         self.assertEqual(util.format_mapname('de_inferno'), 'Inferno')
@@ -16,6 +18,31 @@ class UtilTest(get5_test.Get5Test):
         self.assertEqual(util.format_mapname('de_dust2'), 'Dust II')
         self.assertEqual(util.format_mapname('de_cbble'), 'Cobblestone')
 
+    def test_ttl_cache(self):
+        cache = util.TTLCache(maxsize=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), 2)
+
+        # Adding a third entry evicts the least recently used one
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+        # Expired entries are not returned
+        cache.set('a', 1, timeout=-1)
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+
+        cache.delete('c')
+        self.assertEqual(cache.get('c'), None)
+        cache.set('d', 4)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python2.7
 
+import json
+
 import get5
 from get5 import db
 import get5.models
@@ -14,5 +16,343 @@ migrate = flask_migrate.Migrate(get5.app, get5.db)
 manager.add_command('db', flask_migrate.MigrateCommand)
 
 
+@manager.option('-m', '--match', dest='matchid', type=int, default=None,
+                help='only replay this match id (default: every match with events)')
+def replay_events(matchid=None):
+    """Rebuild match, map and player stats from the match event journal."""
+    from get5.models import Match, MatchEvent
+    from get5.api import replay_match_events
+
+    if matchid is not None:
+        matches = Match.query.filter_by(id=matchid)
+    else:
+        matchids = db.session.query(MatchEvent.match_id).distinct()
+        matches = Match.query.filter(Match.id.in_(matchids)).order_by(Match.id)
+
+    for match in matches:
+        replay_match_events(match)
+        db.session.commit()
+        Match.invalidate_page_cache(match.id)
+        print('Replayed events for match {}'.format(match.id))
+
+
+@manager.option('-i', '--interval', dest='interval', type=int, default=None,
+                help='seconds between checks (default: SERVER_POLL_INTERVAL)')
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='check every server once and exit')
+def poll_servers(interval=None, once=False):
+    """Keep the cached availability of every game server up to date.
+
+    Also frees servers whose lease expired and writes buffered live scores
+    of maps whose plugin went quiet, see SCORE_UPDATE_FLUSH_INTERVAL. The
+    scheduler thread (see MATCH_SCHEDULER and run_scheduler) does the same.
+    """
+    import time
+    from get5 import scheduler
+
+    if interval is None:
+        interval = get5.config_setting('SERVER_POLL_INTERVAL')
+
+    while True:
+        start = time.time()
+        try:
+            scheduler.poll_servers(deadline=max(interval, 1))
+        except Exception:
+            get5.app.logger.exception('Failed to poll game servers')
+            db.session.rollback()
+        db.session.remove()
+        if once:
+            break
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=4,
+                help='number of jobs run at the same time')
+def run_jobs(workers=4):
+    """Run queued admin rcon actions, for setups with RCON_JOB_WORKERS = 0."""
+    import threading
+    from get5 import jobs
+
+    threads = [threading.Thread(target=jobs.worker_loop) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(1)
+
+
+@manager.option('-u', '--url', dest='url', required=True,
+                help='base url of the web app, used in the config urls sent to servers')
+def run_scheduler(url):
+    """Start scheduled matches on time, for setups with MATCH_SCHEDULER = False."""
+    from get5.scheduler import scheduler
+
+    scheduler.base_url = url
+    scheduler.run()
+
+
+@manager.option('-i', '--interval', dest='interval', type=int, default=None,
+                help='seconds between runs (default: PLAYER_REFRESH_INTERVAL)')
+@manager.option('-b', '--batch', dest='batch', type=int, default=1000,
+                help='most players refreshed per run, 100 per api call')
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='refresh one batch and exit')
+def refresh_players(interval=None, batch=1000, once=False):
+    """Keep the Steam names and avatars in the player table up to date.
+
+    Players who only appear in match stats get their row here as well.
+    """
+    import time
+    from get5.models import Player, cache_steam_names
+
+    if interval is None:
+        interval = get5.config_setting('PLAYER_REFRESH_INTERVAL')
+
+    while True:
+        start = time.time()
+        try:
+            Player.add_missing()
+            db.session.commit()
+            players = Player.stale(limit=batch)
+            if players:
+                Player.refresh([p.steam_id for p in players],
+                               dict((p.steam_id, p) for p in players))
+                cache_steam_names(players)
+                db.session.commit()
+                get5.app.logger.info('Refreshed {} players'.format(len(players)))
+        except Exception:
+            get5.app.logger.exception('Failed to refresh players')
+            db.session.rollback()
+        db.session.remove()
+        if once:
+            break
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+@manager.option('schedule', help='json or csv file of the matches, see /match/create/bulk')
+@manager.option('-u', '--user', dest='userid', type=int, required=True,
+                help='id of the user creating the matches')
+@manager.option('-f', '--format', dest='format', default=None,
+                help='json or csv (default: from the file extension)')
+def create_matches(schedule, userid, format=None):
+    """Create every match of a bracket or schedule file at once.
+
+    The matches are queued and start as servers become free. Without
+    GET5_URL_OVERRIDE or SERVER_NAME set they all wait for the next server
+    released by the web app.
+    """
+    import os
+    from get5 import bulk
+    from get5.models import User
+
+    user = User.query.get(userid)
+    if user is None:
+        print('No user with id {}'.format(userid))
+        return
+    if format is None:
+        format = 'json' if os.path.splitext(schedule)[1] == '.json' else 'csv'
+
+    with open(schedule) as f:
+        text = f.read()
+    try:
+        matches = bulk.create_matches(user, bulk.parse_schedule(text, format))
+    except bulk.ScheduleError as e:
+        print(e)
+        return
+
+    for match in matches:
+        print('Created match {}{}'.format(
+            match.id, ', queued' if match.queued else
+            ' on server {}'.format(match.server_id)))
+
+
+@manager.option('-n', '--commands', dest='num_commands', type=int, default=200,
+                help='commands sent in each mode')
+@manager.option('-l', '--latency', dest='latency', type=float, default=0.005,
+                help='seconds the fake server waits before each reply')
+def rcon_benchmark(num_commands=200, latency=0.005):
+    """Time rcon commands against a local fake server, with and without pooling."""
+    import time
+    from get5 import rcon, simulator, util
+
+    server = simulator.Get5Server(latency=latency)
+    try:
+        for idle_timeout in (0, 60):
+            get5.app.config['RCON_POOL_IDLE_TIMEOUT'] = idle_timeout
+            rcon.pool.close_all()
+            connections = server.connections
+            start = time.time()
+            for _ in range(num_commands):
+                util.send_rcon_command('127.0.0.1', server.port,
+                                       server.password, 'get5_web_available')
+            elapsed = time.time() - start
+            print('{:<12} {:.2f} ms/command, {} connections'.format(
+                'pooled' if idle_timeout else 'unpooled',
+                1000 * elapsed / num_commands, server.connections - connections))
+    finally:
+        rcon.pool.close_all()
+        server.stop()
+
+
+@manager.option('-n', '--ids', dest='num_ids', type=int, default=100000,
+                help='steamids converted in each format')
+def steamid_benchmark(num_ids=100000):
+    """Time steamid conversions one at a time and in bulk, without network."""
+    import random
+    import time
+    from get5 import steamid
+
+    accounts = [random.randint(0, steamid.MAX_ACCOUNT_NUMBER)
+                for _ in range(num_ids)]
+    formats = [
+        ('steam2', lambda z: 'STEAM_0:{}:{}'.format(z & 1, z >> 1)),
+        ('steam3', lambda z: '[U:1:{}]'.format(z)),
+        ('url', lambda z: 'https://steamcommunity.com/profiles/{}/'.format(
+            steamid.STEAM64_BASE + z)),
+    ]
+    for name, make in formats:
+        auths = [make(z) for z in accounts]
+        start = time.time()
+        for auth in auths:
+            steamid.auth_to_steam64(auth)
+        single = time.time() - start
+        start = time.time()
+        steamid.convert_many(auths)
+        bulk = time.time() - start
+        print('{:<8} {:.2f} us/id one at a time, {:.2f} us/id convert_many'.format(
+            name, 1e6 * single / num_ids, 1e6 * bulk / num_ids))
+
+
+@manager.option('-n', '--matches', dest='num_matches', type=int, default=10,
+                help='number of matches to play')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=4,
+                help='matches played at the same time')
+@manager.option('-r', '--rounds', dest='rounds', type=int, default=16,
+                help='rounds needed to win a map')
+@manager.option('-u', '--url', dest='url', default=None,
+                help='base url of a running web panel, by default requests '
+                     'are handled in this process')
+@manager.option('--bulk', dest='bulk', action='store_true', default=False,
+                help='send the player stats of a round in one request')
+def simulate_matches(num_matches=10, concurrency=4, rounds=16, url=None,
+                     bulk=False):
+    """Play simulated matches against the api and report its throughput.
+
+    Creates a user, two teams and a fake get5 server per match in the
+    configured database, loads each match on its server over rcon and lets a
+    plugin simulator play it. Everything it created is deleted afterwards.
+    """
+    import Queue
+    import threading
+    import time
+    import urlparse
+    from get5 import rcon, simulator
+    from get5.models import (GameServer, Match, Team, User, MapStats,
+                             PlayerStats, MatchEvent, RconJob, ServerStatus)
+
+    # Needed to build the config and api urls sent to the servers
+    get5.register_blueprints()
+
+    if url:
+        fetch_config = simulator.http_get_json
+        make_poster = lambda: simulator.http_poster(url)
+    else:
+        # Rate limits are per match and a simulated map is far quicker
+        # than a real one
+        get5.limiter.enabled = False
+        url = 'http://localhost/'
+
+        def fetch_config(config_url):
+            response = get5.app.test_client().get(
+                urlparse.urlparse(config_url).path)
+            return json.loads(response.data)
+
+        def make_poster():
+            return simulator.client_poster(get5.app.test_client())
+
+    user = User.get_or_create('simulator')
+    db.session.flush()
+    steam_ids = [str(76561197960265728 + i) for i in range(1, 11)]
+    team1 = Team.create(user, 'Simulated 1', 'SIM1', '', '', steam_ids[:5])
+    team2 = Team.create(user, 'Simulated 2', 'SIM2', '', '', steam_ids[5:])
+    db.session.commit()
+    user_id = user.id
+
+    servers = []
+    queue = Queue.Queue()
+    try:
+        with get5.app.test_request_context(base_url=url):
+            for _ in range(num_matches):
+                server = simulator.Get5Server(fetch_config=fetch_config)
+                servers.append(server)
+                game_server = GameServer.create(
+                    user, 'simulator', '127.0.0.1', server.port,
+                    server.password, False)
+                db.session.flush()
+                match = Match.create(user, team1.id, team2.id, '', '', 1, False,
+                                     'Simulated match', ['de_dust2'],
+                                     game_server.id)
+                db.session.flush()
+                game_server.lease_to(match)
+                match.update_config()
+                db.session.commit()
+                if not match.send_to_server():
+                    print('Failed to load match {}'.format(match.id))
+                    continue
+                queue.put(server)
+
+        results = []
+
+        def play():
+            post = make_poster()
+            while True:
+                try:
+                    server = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results.extend(simulator.PluginSimulator(
+                    server, post=post, rounds_to_win=rounds,
+                    bulk_players=bulk).play())
+
+        start = time.time()
+        threads = [threading.Thread(target=play) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        latencies = sorted(duration for _, duration in results)
+        failed = len([status for status, _ in results if status != 200])
+        if latencies:
+            print('{} requests in {:.2f}s, {:.1f} requests/s, {} failed'.format(
+                len(results), elapsed, len(results) / elapsed, failed))
+            print('latency p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms'.format(
+                1000 * latencies[len(latencies) / 2],
+                1000 * latencies[int(len(latencies) * 0.95)],
+                1000 * latencies[-1]))
+    finally:
+        rcon.pool.close_all()
+        for server in servers:
+            server.stop()
+        db.session.remove()
+        match_ids = [m.id for m in Match.query.filter_by(user_id=user_id)]
+        server_ids = [s.id for s in GameServer.query.filter_by(user_id=user_id)]
+        for model in [PlayerStats, MapStats, MatchEvent, RconJob]:
+            model.query.filter(model.match_id.in_(match_ids)).delete(
+                synchronize_session=False)
+        Match.query.filter(Match.id.in_(match_ids)).delete(
+            synchronize_session=False)
+        RconJob.query.filter(RconJob.server_id.in_(server_ids)).delete(
+            synchronize_session=False)
+        ServerStatus.query.filter(ServerStatus.server_id.in_(server_ids)).delete(
+            synchronize_session=False)
+        GameServer.query.filter_by(user_id=user_id).delete()
+        Team.query.filter_by(user_id=user_id).delete()
+        User.query.filter_by(id=user_id).delete()
+        db.session.commit()
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file